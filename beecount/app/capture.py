@@ -0,0 +1,233 @@
+"""
+Threaded frame capture
+Decodes each source once on its own thread; every pipeline on that source takes the newest frame
+"""
+
+import threading
+import cv2
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+def build_capture_source(config: dict) -> Tuple[str, int, bool]:
+    """Fuente de captura para un stream: (source, api_preference, decode_crops).
+
+    Con capture_backend 'gstreamer' el recorte al ROI, el escalado (process_scale) y la
+    conversión a gris (grayscale_decode) se hacen en el decodificador. El recorte y escalado
+    necesitan frame_size [ancho, alto]; sin él sólo se decodifica en gris.
+    """
+    url = config['url']
+    if config.get('capture_backend', 'ffmpeg') != 'gstreamer':
+        return url, cv2.CAP_ANY, False
+
+    uri = url if '://' in url else f"file://{url}"
+    elements = [f"uridecodebin uri={uri}"]
+    roi = config.get('roi'); frame_size = config.get('frame_size')
+    decode_crops = bool(roi and frame_size)
+    if decode_crops:
+        x, y, w, h = roi; frame_w, frame_h = frame_size
+        scale = float(config.get('process_scale', 1.0))
+        elements.append(f"videocrop left={x} top={y} right={frame_w - x - w} bottom={frame_h - y - h}")
+        elements.append(f"videoscale ! video/x-raw,width={max(int(w * scale), 1)},height={max(int(h * scale), 1)}")
+    if config.get('grayscale_decode', False):
+        elements.append("videoconvert ! video/x-raw,format=GRAY8")
+    else:
+        elements.append("videoconvert ! video/x-raw,format=BGR")
+    elements.append("appsink drop=true max-buffers=1 sync=false")
+    return " ! ".join(elements), cv2.CAP_GSTREAMER, decode_crops
+
+def capture_key(config: dict) -> Tuple[str, int]:
+    """Clave de decodificación compartida: streams con la misma clave usan un solo decodificador"""
+    if config.get('algo') == 'yolo':
+        return config['url'], cv2.CAP_ANY # YOLOPipeline siempre decodifica el frame completo
+    source, api_preference, _ = build_capture_source(config)
+    return source, api_preference
+
+class FrameGrabber:
+    """Hilo de captura por stream con semántica latest-frame-wins y reconexión con backoff"""
+    def __init__(self, url: str, name: str, backoff_initial: float = 1.0, backoff_max: float = 30.0,
+                 api_preference: int = cv2.CAP_ANY):
+        self.url = url
+        self.name = name
+        self.api_preference = api_preference
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.cap = None
+        self._frame = None # Slot único: sólo se conserva el frame más reciente
+        self._seq = 0
+        self._consumed_seq = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Estadísticas
+        self.frames_grabbed = 0
+        self.frames_dropped = 0
+        self.reconnects = 0
+        self.connected = False
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"grabber-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                # Sigue bloqueado en cap.read(): liberar aquí sería release()/read() concurrentes;
+                # _run libera al salir
+                logger.warning(f"{self.name}: Grab thread still blocked after {timeout:.1f}s, deferring release")
+                return
+        self._release()
+
+    def _open(self) -> bool:
+        self._release()
+        self.cap = cv2.VideoCapture(self.url, self.api_preference)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return bool(self.cap.isOpened())
+
+    def _release(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+        self.connected = False
+
+    def _run(self):
+        backoff = self.backoff_initial
+        while not self._stop.is_set():
+            if not self.connected:
+                if not self._open():
+                    logger.warning(f"{self.name}: Capture unavailable, retrying in {backoff:.1f}s")
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, self.backoff_max)
+                    continue
+                if self.frames_grabbed:
+                    self.reconnects += 1
+                    logger.info(f"{self.name}: Capture reconnected")
+                self.connected = True
+
+            ret, frame = self.cap.read()
+            if not ret or frame is None:
+                logger.warning(f"{self.name}: Frame read failed, reconnecting")
+                self._release()
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+
+            backoff = self.backoff_initial
+            frame.flags.writeable = False # Compartido entre pipelines: los ROI son vistas de este arreglo
+            with self._cond:
+                if self._seq > self._consumed_seq:
+                    self.frames_dropped += 1 # El frame anterior nunca fue procesado
+                self._frame = frame
+                self._seq += 1
+                self.frames_grabbed += 1
+                self._cond.notify_all()
+        self._release()
+
+    def read(self, timeout: Optional[float] = 1.0) -> Optional[np.ndarray]:
+        """Devuelve el frame más reciente no procesado, o None si no llega a tiempo"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._consumed_seq or self._stop.is_set(), timeout):
+                return None
+            if self._seq == self._consumed_seq:
+                return None
+            self._consumed_seq = self._seq
+            return self._frame
+
+    def stats(self) -> dict:
+        return {
+            'connected': self.connected, 'frames': self.frames_grabbed,
+            'dropped': self.frames_dropped, 'reconnects': self.reconnects
+        }
+
+class FrameSubscription:
+    """Cursor de un pipeline sobre un FrameGrabber compartido: latest-frame-wins por consumidor"""
+    def __init__(self, grabber: FrameGrabber, name: str, registry: "CaptureRegistry", key: Tuple[str, int]):
+        self.grabber = grabber
+        self.name = name
+        self._registry = registry
+        self._key = key
+        self._released = False
+        with grabber._cond:
+            self._consumed_seq = grabber._seq
+        self.frames_dropped = 0
+
+    @property
+    def cap(self):
+        return self.grabber.cap
+
+    @property
+    def frames_grabbed(self) -> int:
+        return self.grabber.frames_grabbed
+
+    @property
+    def connected(self) -> bool:
+        return self.grabber.connected
+
+    def read(self, timeout: Optional[float] = 1.0) -> Optional[np.ndarray]:
+        """Frame más reciente que este consumidor no ha visto (sin copia, sólo lectura)"""
+        g = self.grabber
+        with g._cond:
+            if not g._cond.wait_for(lambda: g._seq > self._consumed_seq or g._stop.is_set(), timeout):
+                return None
+            if g._seq == self._consumed_seq:
+                return None
+            self.frames_dropped += g._seq - self._consumed_seq - 1
+            self._consumed_seq = g._seq
+            return g._frame
+
+    def stop(self, timeout: float = 2.0):
+        """Soltar la referencia; el decodificador se detiene con la última"""
+        if not self._released:
+            self._released = True
+            self._registry.release(self._key, timeout)
+
+    def stats(self) -> dict:
+        return dict(self.grabber.stats(), dropped=self.frames_dropped, shared=self._registry.refcount(self._key))
+
+class CaptureRegistry:
+    """Un FrameGrabber por fuente (URL o pipeline GStreamer) con conteo de referencias"""
+    def __init__(self):
+        self._entries: Dict[Tuple[str, int], List] = {} # key -> [grabber, refs]
+        self._lock = threading.Lock()
+
+    def acquire(self, source: str, name: str, api_preference: int = cv2.CAP_ANY) -> FrameSubscription:
+        key = (source, api_preference)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                grabber = FrameGrabber(source, name, api_preference=api_preference)
+                grabber.start()
+                entry = self._entries[key] = [grabber, 0]
+            else:
+                logger.info(f"{name}: Sharing capture with {entry[0].name}")
+            entry[1] += 1
+            return FrameSubscription(entry[0], name, self, key)
+
+    def release(self, key: Tuple[str, int], timeout: float = 2.0):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return
+            entry[1] -= 1
+            if entry[1] > 0: return
+            del self._entries[key]
+        entry[0].stop(timeout)
+
+    def refcount(self, key: Tuple[str, int]) -> int:
+        entry = self._entries.get(key)
+        return entry[1] if entry else 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+CAPTURES = CaptureRegistry()
@@ -0,0 +1,211 @@
+"""
+Shared YOLO inference service
+One model instance per process; frames from every YOLO stream are batched under a latency deadline
+"""
+
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+from .log import get_logger
+from .model_cache import export_model, resolve_model_path
+
+logger = get_logger(__name__)
+
+def boxes_to_centroids(xyxy: np.ndarray, conf: np.ndarray, conf_threshold: float,
+                       min_area: float, max_area: float) -> np.ndarray:
+    """Filtrar cajas por confianza y área y devolver centroides (N, 2) en una sola operación"""
+    xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+    conf = np.asarray(conf, dtype=np.float64).reshape(-1)
+    wh = xyxy[:, 2:] - xyxy[:, :2]
+    area = wh[:, 0] * wh[:, 1]
+    keep = (conf >= conf_threshold) & (area >= min_area) & (area <= max_area)
+    return ((xyxy[keep, :2] + xyxy[keep, 2:]) / 2).astype(int)
+
+BACKENDS = ('ultralytics', 'onnx', 'openvino')
+
+def letterbox_batch(frames: List[np.ndarray], imgsz: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Redimensionar con relleno a imgsz x imgsz; devuelve (NCHW float32 RGB, escalas, paddings)"""
+    batch = np.full((len(frames), imgsz, imgsz, 3), 114, dtype=np.uint8)
+    scales = np.empty(len(frames)); pads = np.empty((len(frames), 2))
+    for i, frame in enumerate(frames):
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        h, w = frame.shape[:2]
+        scale = min(imgsz / h, imgsz / w)
+        nh, nw = int(round(h * scale)), int(round(w * scale))
+        top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+        batch[i, top:top + nh, left:left + nw] = cv2.resize(frame, (nw, nh), interpolation=cv2.INTER_LINEAR)
+        scales[i] = scale; pads[i] = (left, top)
+    tensor = batch[..., ::-1].transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+    return np.ascontiguousarray(tensor), scales, pads
+
+def decode_yolov8(output: np.ndarray, scales: np.ndarray, pads: np.ndarray,
+                  conf_floor: float, nms_iou: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Salida cruda (B, 4 + clases, anchors) -> [(xyxy, conf)] por frame en coordenadas originales"""
+    results = []
+    for b, pred in enumerate(output.transpose(0, 2, 1)):
+        conf = pred[:, 4:].max(axis=1)
+        keep = conf >= conf_floor
+        xywh = pred[keep, :4]; conf = conf[keep]
+        if len(conf) == 0:
+            results.append((np.zeros((0, 4)), np.zeros(0))); continue
+        tl = xywh[:, :2] - xywh[:, 2:] / 2
+        idx = cv2.dnn.NMSBoxes(np.hstack([tl, xywh[:, 2:]]).tolist(), conf.tolist(), conf_floor, nms_iou)
+        idx = np.asarray(idx, dtype=int).reshape(-1)
+        xyxy = np.hstack([tl[idx], tl[idx] + xywh[idx, 2:]])
+        xyxy = (xyxy - np.tile(pads[b], 2)) / scales[b]
+        results.append((xyxy, conf[idx]))
+    return results
+
+class UltralyticsBackend:
+    """Modelo PyTorch de ultralytics (requiere torch)"""
+    def __init__(self, model):
+        self.model = model
+
+    @classmethod
+    def load(cls, model_path: str) -> 'UltralyticsBackend':
+        try:
+            from ultralytics import YOLO
+        except ImportError:
+            logger.error("ultralytics package not installed.")
+            raise
+        model = YOLO(resolve_model_path(model_path))
+        logger.info(f"Loaded YOLO model from {resolve_model_path(model_path)}")
+        model.fuse()
+        return cls(model)
+
+    def predict(self, frames: List[np.ndarray], conf_floor: float = 0.25) -> List[Tuple[np.ndarray, np.ndarray]]:
+        out = []
+        for result in self.model(frames, verbose=False, conf=conf_floor):
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                out.append((np.zeros((0, 4)), np.zeros(0))); continue
+            out.append((boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy()))
+        return out
+
+class ExportedBackend:
+    """Grafo exportado ejecutado con ONNX Runtime u OpenVINO en CPU"""
+    def __init__(self, run, imgsz: int, conf_floor: float = 0.25, nms_iou: float = 0.45):
+        self.run = run # (NCHW float32) -> salida cruda YOLOv8
+        self.imgsz = imgsz
+        self.conf_floor = conf_floor
+        self.nms_iou = nms_iou
+
+    @classmethod
+    def load(cls, model_path: str, backend: str, imgsz: int, **kwargs) -> 'ExportedBackend':
+        path = export_model(model_path, backend, imgsz)
+        if backend == 'onnx':
+            import onnxruntime as ort
+            session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+            input_name = session.get_inputs()[0].name
+            run = lambda x: session.run(None, {input_name: x})[0]
+        else:
+            import glob
+            import openvino as ov
+            core = ov.Core()
+            compiled = core.compile_model(core.read_model(glob.glob(f"{path}/*.xml")[0]), 'CPU')
+            output = compiled.output(0)
+            run = lambda x: compiled(x)[output]
+        logger.info(f"Loaded {backend} model {path}")
+        return cls(run, imgsz, **kwargs)
+
+    def predict(self, frames: List[np.ndarray], conf_floor: Optional[float] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        tensor, scales, pads = letterbox_batch(frames, self.imgsz)
+        conf_floor = self.conf_floor if conf_floor is None else conf_floor
+        return decode_yolov8(self.run(tensor), scales, pads, conf_floor, self.nms_iou)
+
+def load_backend(model_path: str, backend: str, imgsz: int, nms_iou: float = 0.45):
+    if backend == 'ultralytics':
+        return UltralyticsBackend.load(model_path)
+    if backend in ('onnx', 'openvino'):
+        return ExportedBackend.load(model_path, backend, imgsz, nms_iou=nms_iou)
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+class _Request:
+    __slots__ = ('frame', 'conf', 'min_area', 'max_area', 'future')
+    def __init__(self, frame, conf, min_area, max_area):
+        self.frame = frame; self.conf = conf
+        self.min_area = min_area; self.max_area = max_area
+        self.future = Future()
+
+class YOLOInferenceService:
+    """Servicio de inferencia compartido: un modelo, lotes con deadline de latencia"""
+    _shared: Dict[tuple, 'YOLOInferenceService'] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, model_path: str, max_batch: int = 8, max_latency: float = 0.02,
+                 backend: str = 'ultralytics', imgsz: int = 640, nms_iou: float = 0.45, model=None):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.nms_iou = nms_iou
+        self.model = model if model is not None else load_backend(model_path, backend, imgsz, nms_iou)
+        self._requests = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self.batches = 0
+        self.frames = 0
+        self._thread = threading.Thread(target=self._run, name="yolo-inference", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def shared(cls, model_path: str, backend: str = 'ultralytics', imgsz: int = 640,
+               **kwargs) -> 'YOLOInferenceService':
+        """Instancia única por (model_path, backend, imgsz) dentro del proceso; el primer stream fija el lote"""
+        key = (model_path, backend, imgsz)
+        with cls._shared_lock:
+            service = cls._shared.get(key)
+            if service is None:
+                service = cls._shared[key] = cls(model_path, backend=backend, imgsz=imgsz, **kwargs)
+                return service
+        ignored = {k: v for k, v in kwargs.items() if k in ('max_batch', 'max_latency', 'nms_iou')
+                   and getattr(service, k) != v}
+        if ignored:
+            current = {k: getattr(service, k) for k in ignored}
+            logger.warning(f"Shared YOLO service for {model_path} ({backend}, {imgsz}) already running with "
+                           f"{current}; ignoring {ignored}")
+        return service
+
+    def submit(self, frame: np.ndarray, conf: float, min_area: float, max_area: float) -> Future:
+        request = _Request(frame, conf, min_area, max_area)
+        self._requests.put(request)
+        return request.future
+
+    def detect(self, frame: np.ndarray, conf: float, min_area: float, max_area: float,
+               timeout: Optional[float] = 5.0) -> np.ndarray:
+        return self.submit(frame, conf, min_area, max_area).result(timeout)
+
+    def _collect(self) -> List[_Request]:
+        """Primer request bloqueante; el resto hasta max_batch o hasta el deadline"""
+        try: batch = [self._requests.get(timeout=0.5)]
+        except queue.Empty: return []
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: batch.append(self._requests.get(timeout=remaining))
+            except queue.Empty: break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch: continue
+            try:
+                # Umbral del modelo = el menor conf del lote; cada request filtra con el suyo. El NMS no cambia
+                # las cajas sobre un umbral más alto, así que todos los backends cuentan igual
+                results = self.model.predict([r.frame for r in batch], min(r.conf for r in batch))
+                for request, (xyxy, conf) in zip(batch, results):
+                    request.future.set_result(boxes_to_centroids(
+                        xyxy, conf, request.conf, request.min_area, request.max_area))
+                self.batches += 1; self.frames += len(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done(): request.future.set_exception(e)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
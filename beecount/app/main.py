@@ -8,29 +8,35 @@ Multi-stream bee counting with MQTT publishing
 import os
 import sys
 import time
-import json
+import queue
 import threading
 import signal
-from datetime import datetime, timezone
+import argparse
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import yaml
-import psutil
 import paho.mqtt.client as mqtt
 from .log import get_logger
 from .health import HealthServer
-from .pipeline_opencv import OpenCVPipeline
-from .pipeline_yolo import YOLOPipeline
+from .scheduler import CpuGovernor, StreamWorker
+from .workers import ProcessWorkerPool, build_pipeline
+from .publisher import MetricsPublisher
+from .outbox import CountOutbox
+from .metrics import REGISTRY, serve_metrics
+from .snapshot import SnapshotStore
 
 logger = get_logger(__name__)
 
 class BeeCountManager:
     """Manages multiple bee counting streams and MQTT publishing"""
-    def __init__(self, config_path: str = "app/roi_config.yaml"):
+    def __init__(self, config_path: str = "app/roi_config.yaml", workers: str = "thread", shards: int = None):
         self.config_path = config_path; self.config = self._load_config()
+        self.workers_mode = workers; self.shards = shards; self.process_pool = None
         self.mqtt_client = None; self.pipelines = {}
         self.metrics = defaultdict(lambda: {'bees_in': 0, 'bees_out': 0, 'fps': 0.0, 'cpu_pct': 0.0, 'algo': 'opencv'})
         self.running = True; self.publish_period = int(os.getenv('PUBLISH_PERIOD', '60'))
+        self.results = queue.SimpleQueue(); self.stop_event = threading.Event(); self.workers = []
+        self.metrics_lock = threading.Lock(); self.publisher = None; self.snapshots = None
+        self.metrics_registry = REGISTRY # /metrics lo sirve serve_metrics() en METRICS_PORT
         self.health_server = HealthServer(self)
         signal.signal(signal.SIGTERM, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -59,6 +65,9 @@ class BeeCountManager:
     def _on_mqtt_connect(self, client, userdata, flags, rc):
         if rc == 0: logger.info("MQTT connected successfully")
         else: logger.error(f"MQTT connection failed with code {rc}")
+
+    def _on_mqtt_disconnect(self, client, userdata, rc):
+        if rc != 0: logger.warning(f"MQTT disconnected unexpectedly (rc={rc}), reconnecting...")
     
     def _signal_handler(self, signum, frame):
         logger.info(f"Received signal {signum}, shutting down..."); self.running = False
@@ -66,68 +75,107 @@ class BeeCountManager:
     def _create_pipeline(self, stream_config: dict):
         algo = stream_config.get('algo', 'opencv'); hive_id = stream_config['hive_id']
         try:
-            if algo == 'opencv': pipeline = OpenCVPipeline(stream_config)
-            elif algo == 'yolo': pipeline = YOLOPipeline(stream_config)
-            else: logger.error(f"Unknown algorithm: {algo}"); return None
-        
+            pipeline = build_pipeline(stream_config)
             self.pipelines[hive_id] = pipeline; self.metrics[hive_id]['algo'] = algo
             logger.info(f"Created {algo} pipeline for {hive_id}"); return pipeline
         except Exception as e: logger.error(f"Failed to create pipeline for {hive_id}: {e}"); return None
 
-    def _process_stream(self, stream_config: dict):
-        hive_id = stream_config['hive_id']
-        if hive_id not in self.pipelines:
-            pipeline = self._create_pipeline(stream_config)
-            if not pipeline: return
-        else: pipeline = self.pipelines[hive_id]
-        
-        try:
-            counts = pipeline.process_frame()
-            if counts:
-                self.metrics[hive_id]['bees_in'] += counts['in']
-                self.metrics[hive_id]['bees_out'] += counts['out']
-                self.metrics[hive_id]['fps'] = counts.get('fps', 0.0)
-        except Exception as e: logger.error(f"Error processing {hive_id}: {e}")
-
-    def _publish_metrics(self):
+    def _apply_counts(self, hive_id: str, counts: dict):
+        with self.metrics_lock:
+            self.metrics[hive_id]['bees_in'] += counts['in']
+            self.metrics[hive_id]['bees_out'] += counts['out']
+            self.metrics[hive_id]['fps'] = counts.get('fps', 0.0)
+
+    def _drain_results(self, timeout: float):
+        """Consumir los conteos que publican los workers"""
         try:
-            cpu_pct = psutil.cpu_percent(interval=0.1)
+            hive_id, counts = self.results.get(timeout=timeout)
+            self._apply_counts(hive_id, counts)
+            while True:
+                hive_id, counts = self.results.get_nowait()
+                self._apply_counts(hive_id, counts)
+        except queue.Empty: pass
+
+    def _snapshot_metrics(self) -> dict:
+        """Copiar y reiniciar los conteos del intervalo (lo llama el hilo publicador)"""
+        snapshot = {}
+        with self.metrics_lock:
             for stream_config in self.config['streams']:
-                hive_id = stream_config['hive_id']; apiary_id = stream_config.get('apiary_id', 'A01')
+                hive_id = stream_config['hive_id']
                 if hive_id not in self.metrics: continue
-                metrics = self.metrics[hive_id]; net_count = metrics['bees_in'] - metrics['bees_out']
-                payload = {
-                    'ts': datetime.now(timezone.utc).isoformat(), 'apiary_id': apiary_id, 'hive_id': hive_id,
-                    'bees_in_1m': metrics['bees_in'], 'bees_out_1m': metrics['bees_out'], 'bees_net_1m': net_count,
-                    'fps': round(metrics['fps'], 1), 'cpu_pct': round(cpu_pct, 1), 'algo': metrics['algo']
-                }
-                topic = f"hives/{hive_id}/beecount"
-                self.mqtt_client.publish(topic, json.dumps(payload), qos=1)
-                logger.info(f"Published {hive_id}: in={metrics['bees_in']}, out={metrics['bees_out']}, net={net_count}")
+                metrics = self.metrics[hive_id]; snapshot[hive_id] = dict(metrics)
                 metrics['bees_in'] = 0; metrics['bees_out'] = 0
-        except Exception as e: logger.error(f"Failed to publish metrics: {e}")
+            self._save_partial_counts() # Lo ya publicado nunca queda en el archivo: sin doble conteo al reiniciar
+        return snapshot
+
+    def _save_partial_counts(self):
+        """Persistir los conteos del intervalo en curso (con metrics_lock tomado)"""
+        if not self.snapshots: return
+        try: self.snapshots.save_counts(self.metrics)
+        except OSError as e: logger.warning(f"Could not save partial counts: {e}")
+
+    def _restore_partial_counts(self):
+        restored = self.snapshots.load_counts() if self.snapshots else {}
+        with self.metrics_lock:
+            for hive_id, counts in restored.items():
+                self.metrics[hive_id]['bees_in'] += counts['bees_in']; self.metrics[hive_id]['bees_out'] += counts['bees_out']
+        if restored: logger.info(f"Restored unpublished counts for {len(restored)} hives")
 
     def run(self):
         logger.info("BeeCount Manager starting...")
+        self._setup_mqtt()
+        snapshot_config = self.config.get('snapshot', {})
+        self.snapshots = SnapshotStore.from_config(snapshot_config); self._restore_partial_counts()
+        publish_config = self.config.get('publish', {})
+        outbox = CountOutbox(os.getenv('OUTBOX_PATH', publish_config.get('outbox_path', '/app/data/outbox.db')),
+                             int(publish_config.get('outbox_max_rows', 100000)))
+        if len(outbox): logger.info(f"Outbox holds {len(outbox)} unacknowledged messages, replaying")
+        self.publisher = MetricsPublisher(self.mqtt_client, self.config['streams'], self._snapshot_metrics,
+                                          self.publish_period, publish_config, outbox)
+        self.publisher.start()
+        REGISTRY.register_gauge('beecount_results_queue_depth', "Count results waiting for the manager", self.results.qsize)
+        REGISTRY.register_gauge('beecount_outbox_depth', "Messages not yet acknowledged by the broker", lambda: len(outbox))
+        REGISTRY.register_gauge('beecount_publish_duration_seconds', "Duration of the last publish cycle",
+                                lambda: round(self.publisher.last_publish_seconds, 6))
+        if os.getenv('METRICS_PORT'): serve_metrics(int(os.getenv('METRICS_PORT')))
         health_thread = threading.Thread(target=self.health_server.run, daemon=True); health_thread.start()
-        last_publish = time.time()
-        with ThreadPoolExecutor(max_workers=len(self.config['streams'])) as executor:
-            while self.running:
-                try:
-                    futures = [executor.submit(self._process_stream, s) for s in self.config['streams']]
-                    for future in as_completed(futures, timeout=5):
-                        try: future.result()
-                        except Exception as e: logger.error(f"Stream processing error: {e}")
-                    
-                    if time.time() - last_publish >= self.publish_period:
-                        self._publish_metrics(); last_publish = time.time()
-                    time.sleep(0.1)
-                except KeyboardInterrupt: self.running = False
-                except Exception as e: logger.error(f"Main loop error: {e}"); time.sleep(1)
+        sched_config = self.config.get('scheduler', {})
+        governor = CpuGovernor(sched_config.get('cpu_high', 85.0), sched_config.get('cpu_low', 60.0))
+        if self.workers_mode == 'process':
+            for s in self.config['streams']: self.metrics[s['hive_id']]['algo'] = s.get('algo', 'opencv')
+            self.process_pool = ProcessWorkerPool(self.config['streams'], self.results, sched_config, self.shards,
+                                                  snapshot_config=snapshot_config if self.snapshots else None)
+            self.process_pool.start()
+        else:
+            self.workers = [StreamWorker(s, self._create_pipeline, self.results, self.stop_event, governor, self.snapshots)
+                            for s in self.config['streams']]
+            for worker in self.workers: worker.start()
+
+        last_sample = last_counts_save = time.time()
+        while self.running:
+            try:
+                self._drain_results(timeout=0.1)
+                if time.time() - last_sample >= 1.0 and not self.process_pool:
+                    governor.sample(); last_sample = time.time()
+                if self.snapshots and time.time() - last_counts_save >= self.snapshots.interval:
+                    with self.metrics_lock: self._save_partial_counts()
+                    last_counts_save = time.time()
+            except KeyboardInterrupt: self.running = False
+            except Exception as e: logger.error(f"Main loop error: {e}"); time.sleep(1)
         
         logger.info("Shutting down...")
+        self.stop_event.set()
+        if self.process_pool: self.process_pool.stop()
+        for worker in self.workers: worker.join(timeout=5)
         for pipeline in self.pipelines.values(): pipeline.cleanup()
+        self._drain_results(timeout=0.1); self.publisher.stop()
         self.mqtt_client.loop_stop(); self.mqtt_client.disconnect()
 
 if __name__ == "__main__":
-    manager = BeeCountManager(); manager.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="BeeCount multi-stream bee counter")
+    parser.add_argument('--config', default="app/roi_config.yaml")
+    parser.add_argument('--workers', choices=['thread', 'process'], default=os.getenv('BEECOUNT_WORKERS', 'thread'),
+                        help="thread: todos los streams en este proceso; process: shards en procesos worker")
+    parser.add_argument('--shards', type=int, default=None, help="Procesos worker (default: min(cámaras, CPUs))")
+    args = parser.parse_args()
+    manager = BeeCountManager(args.config, workers=args.workers, shards=args.shards); manager.run()
\ No newline at end of file
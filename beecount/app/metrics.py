@@ -0,0 +1,175 @@
+"""
+Pipeline performance metrics
+Per-stream stage latency histograms and counters, rendered in Prometheus text format
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SUB_BITS = 3 # 8 sub-buckets por potencia de 2: error relativo <= 12.5%
+SUB = 1 << SUB_BITS
+MAX_INDEX = SUB * 40 # Hasta ~2**40 ns (18 min)
+
+# Límites 'le' exportados (segundos); los percentiles se calculan con la resolución completa
+EXPORT_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUANTILES = (0.5, 0.9, 0.99)
+
+def bucket_index(ns: int) -> int:
+    """Índice log-lineal estilo HDR: sólo operaciones enteras"""
+    if ns < SUB:
+        return max(ns, 0)
+    k = ns.bit_length()
+    return min((k - SUB_BITS) * SUB + ((ns >> (k - 1 - SUB_BITS)) & (SUB - 1)), MAX_INDEX - 1)
+
+def bucket_upper(idx: int) -> int:
+    """Límite superior exclusivo (ns) del bucket"""
+    if idx < SUB:
+        return idx + 1
+    shift = idx // SUB - 1
+    return (SUB + idx % SUB + 1) << shift
+
+class LatencyHistogram:
+    """Histograma de latencias en ns; un único escritor (el hilo del stream), lectores sin lock"""
+    __slots__ = ('counts', 'count', 'sum_ns')
+
+    def __init__(self):
+        self.counts = [0] * MAX_INDEX
+        self.count = 0
+        self.sum_ns = 0
+
+    def record(self, ns: int):
+        self.counts[bucket_index(ns)] += 1
+        self.count += 1
+        self.sum_ns += ns
+
+    def snapshot(self) -> Tuple[List[int], int, int]:
+        return list(self.counts), self.count, self.sum_ns
+
+    @classmethod
+    def from_snapshot(cls, snap) -> "LatencyHistogram":
+        hist = cls(); hist.counts, hist.count, hist.sum_ns = list(snap[0]), snap[1], snap[2]
+        return hist
+
+def quantile(counts: List[int], total: int, q: float) -> float:
+    """Percentil en segundos (límite superior del bucket)"""
+    if total == 0:
+        return 0.0
+    rank = q * total; seen = 0
+    for idx, c in enumerate(counts):
+        seen += c
+        if c and seen >= rank:
+            return bucket_upper(idx) / 1e9
+    return bucket_upper(MAX_INDEX - 1) / 1e9
+
+class PipelineMetrics:
+    """Métricas de un stream: latencia por etapa, frames procesados y descartados"""
+    def __init__(self, hive_id: str):
+        self.hive_id = hive_id
+        self.stages: Dict[str, LatencyHistogram] = {}
+        self.frames = 0
+        self.dropped = 0 # Acumulado del FrameGrabber (latest-frame-wins)
+        self.skipped = 0 # Frames descartados por el MotionGate
+
+    def observe(self, stage: str, start_ns: int, end_ns: int):
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = LatencyHistogram()
+        hist.record(end_ns - start_ns)
+
+    def snapshot(self) -> dict:
+        """Copia serializable (para enviar desde los procesos worker)"""
+        return {'stages': {name: h.snapshot() for name, h in list(self.stages.items())},
+                'frames': self.frames, 'dropped': self.dropped, 'skipped': self.skipped}
+
+    @classmethod
+    def from_snapshot(cls, hive_id: str, snap: dict) -> "PipelineMetrics":
+        metrics = cls(hive_id); metrics.frames = snap['frames']; metrics.dropped = snap['dropped']
+        metrics.skipped = snap.get('skipped', 0)
+        metrics.stages = {name: LatencyHistogram.from_snapshot(s) for name, s in snap['stages'].items()}
+        return metrics
+
+class MetricsRegistry:
+    """Registro del proceso; render() sólo lee, nunca bloquea a los hilos de conteo"""
+    def __init__(self):
+        self.streams: Dict[str, PipelineMetrics] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+        self._lock = threading.Lock() # Sólo para altas de streams/gauges
+
+    def stream(self, hive_id: str) -> PipelineMetrics:
+        with self._lock:
+            if hive_id not in self.streams:
+                self.streams[hive_id] = PipelineMetrics(hive_id)
+            return self.streams[hive_id]
+
+    def register_gauge(self, name: str, help_text: str, fn: Callable[[], float]):
+        with self._lock: self.gauges[name] = (help_text, fn)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {hive_id: m.snapshot() for hive_id, m in list(self.streams.items())}
+
+    def merge(self, snapshots: Dict[str, dict]):
+        """Reemplazar con las métricas enviadas por un proceso worker"""
+        for hive_id, snap in snapshots.items():
+            self.streams[hive_id] = PipelineMetrics.from_snapshot(hive_id, snap)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP beecount_stage_latency_seconds Per-stage frame processing latency",
+            "# TYPE beecount_stage_latency_seconds histogram",
+        ]
+        quantile_lines = []
+        streams = list(self.streams.items())
+        for hive_id, metrics in streams:
+            for stage, hist in list(metrics.stages.items()):
+                counts, total, sum_ns = hist.snapshot()
+                labels = f'hive_id="{hive_id}",stage="{stage}"'
+                cumulative = 0; idx = 0
+                for bound in EXPORT_BOUNDS:
+                    while idx < MAX_INDEX and bucket_upper(idx) <= bound * 1e9:
+                        cumulative += counts[idx]; idx += 1
+                    lines.append(f'beecount_stage_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'beecount_stage_latency_seconds_bucket{{{labels},le="+Inf"}} {total}')
+                lines.append(f'beecount_stage_latency_seconds_sum{{{labels}}} {sum_ns / 1e9:.6f}')
+                lines.append(f'beecount_stage_latency_seconds_count{{{labels}}} {total}')
+                quantile_lines += [f'beecount_stage_latency_quantile_seconds{{{labels},quantile="{q}"}} '
+                                   f'{quantile(counts, sum(counts), q):.6f}' for q in QUANTILES]
+        lines += ["# HELP beecount_stage_latency_quantile_seconds Per-stage latency percentiles (HDR resolution)",
+                  "# TYPE beecount_stage_latency_quantile_seconds gauge"] + quantile_lines
+        lines += ["# HELP beecount_frames_processed_total Frames processed per stream",
+                  "# TYPE beecount_frames_processed_total counter"]
+        lines += [f'beecount_frames_processed_total{{hive_id="{h}"}} {m.frames}' for h, m in streams]
+        lines += ["# HELP beecount_frames_dropped_total Frames overwritten before processing",
+                  "# TYPE beecount_frames_dropped_total counter"]
+        lines += [f'beecount_frames_dropped_total{{hive_id="{h}"}} {m.dropped}' for h, m in streams]
+        lines += ["# HELP beecount_frames_idle_total Frames skipped by the motion gate",
+                  "# TYPE beecount_frames_idle_total counter"]
+        lines += [f'beecount_frames_idle_total{{hive_id="{h}"}} {m.skipped}' for h, m in streams]
+        for name, (help_text, fn) in list(self.gauges.items()):
+            try: value = fn()
+            except Exception: continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+def serve_metrics(port: int, registry: MetricsRegistry = REGISTRY) -> ThreadingHTTPServer:
+    """Endpoint /metrics independiente (hilo daemon) para despliegues sin HealthServer"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404); self.end_headers(); return
+            body = registry.render().encode()
+            self.send_response(200); self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body))); self.end_headers(); self.wfile.write(body)
+        def log_message(self, *args): pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Prometheus metrics on :{port}/metrics")
+    return server
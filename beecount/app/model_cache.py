@@ -0,0 +1,62 @@
+"""
+Exported model cache
+Converts a YOLO checkpoint once to an optimized CPU graph (ONNX / OpenVINO) and reuses it on later starts
+"""
+
+import os
+import shutil
+import hashlib
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_MODEL = 'yolov8n.pt'
+CACHE_DIR = os.getenv('MODEL_CACHE_DIR', '/app/models/cache')
+
+def resolve_model_path(model_path: str) -> str:
+    """Igual que antes: si el modelo custom no existe se usa el modelo por defecto"""
+    return model_path if os.path.exists(model_path) else DEFAULT_MODEL
+
+def model_hash(model_path: str) -> str:
+    """sha256 del checkpoint (o del nombre si ultralytics lo descarga por defecto)"""
+    digest = hashlib.sha256()
+    if os.path.exists(model_path):
+        with open(model_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        digest.update(model_path.encode())
+    return digest.hexdigest()
+
+def cached_model_path(model_path: str, backend: str, imgsz: int, cache_dir: str = CACHE_DIR) -> str:
+    """Ruta en cache indexada por hash del modelo y tamaño de entrada"""
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    key = f"{stem}-{model_hash(model_path)[:16]}-{imgsz}"
+    if backend == 'onnx':
+        return os.path.join(cache_dir, f"{key}.onnx")
+    if backend == 'openvino':
+        return os.path.join(cache_dir, f"{key}_openvino_model")
+    raise ValueError(f"Backend {backend} has no exported format")
+
+def export_model(model_path: str, backend: str, imgsz: int, cache_dir: str = CACHE_DIR) -> str:
+    """Devolver el grafo exportado en cache; exportar con ultralytics sólo si falta"""
+    model_path = resolve_model_path(model_path)
+    target = cached_model_path(model_path, backend, imgsz, cache_dir)
+    if os.path.exists(target):
+        logger.info(f"Using cached {backend} model {target}")
+        return target
+
+    try:
+        from ultralytics import YOLO
+    except ImportError:
+        logger.error(f"ultralytics package not installed; cannot export {model_path} to {backend}")
+        raise
+
+    logger.info(f"Exporting {model_path} to {backend} (imgsz={imgsz}), first start only")
+    exported = YOLO(model_path).export(format=backend, imgsz=imgsz, dynamic=True, half=False)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{target}.tmp"
+    if os.path.isdir(tmp): shutil.rmtree(tmp)
+    shutil.move(str(exported), tmp)
+    os.replace(tmp, target) # Publicación atómica para otros procesos
+    return target
@@ -0,0 +1,50 @@
+"""
+Motion gate
+Cheap pre-stage that detects idle entrances from a heavily downsampled frame difference
+"""
+
+import cv2
+import numpy as np
+from typing import Tuple
+
+class MotionGate:
+    """Pasa a modo inactivo tras idle_after frames quietos; vuelve a activo en el primer frame con movimiento"""
+    def __init__(self, threshold: float = 0.001, pixel_delta: int = 12, size: Tuple[int, int] = (80, 60),
+                 idle_after: int = 30):
+        self.threshold = threshold # Fracción de píxeles cambiados que cuenta como movimiento
+        self.pixel_delta = pixel_delta
+        self.size = tuple(size)
+        self.idle_after = idle_after # >= max_disappeared del tracker: las pistas se cierran antes de pausar
+        self.idle = False
+        self.still_frames = 0
+        self.motion_ratio = 0.0
+        self._prev = None
+
+    def _thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        tiny = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA) # Promedia: filtra el ruido del sensor
+        return cv2.cvtColor(tiny, cv2.COLOR_BGR2GRAY) if tiny.ndim == 3 else tiny
+
+    def update(self, frame: np.ndarray) -> bool:
+        """True si el frame debe procesarse completo"""
+        tiny = self._thumbnail(frame)
+        if self._prev is None or self._prev.shape != tiny.shape:
+            self._prev = tiny
+            return True
+        diff = cv2.absdiff(tiny, self._prev)
+        self._prev = tiny
+        self.motion_ratio = np.count_nonzero(diff > self.pixel_delta) / diff.size
+        if self.motion_ratio >= self.threshold:
+            self.still_frames = 0; self.idle = False
+        else:
+            self.still_frames += 1
+            if self.still_frames >= self.idle_after: self.idle = True
+        return not self.idle
+
+def build_motion_gate(config: dict):
+    """MotionGate según la configuración del stream, o None si motion_gate está desactivado"""
+    if not config.get('motion_gate', False):
+        return None
+    return MotionGate(threshold=float(config.get('motion_threshold', 0.001)),
+                      pixel_delta=int(config.get('motion_pixel_delta', 12)),
+                      size=tuple(config.get('motion_size', (80, 60))),
+                      idle_after=int(config.get('motion_idle_after', 30)))
@@ -0,0 +1,54 @@
+"""
+Store-and-forward outbox
+Disk-backed FIFO (SQLite WAL) for count messages the broker has not acknowledged yet
+"""
+
+import os
+import sqlite3
+import threading
+from typing import List, Tuple
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+class CountOutbox:
+    """Cola FIFO persistente: los intervalos sobreviven a cortes del enlace y reinicios"""
+    def __init__(self, path: str, max_rows: int = 100000):
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path; self.max_rows = max_rows; self.dropped = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL") # WAL: durable ante caída del proceso, barato en SD
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB NOT NULL)")
+
+    def append(self, messages: List[Tuple[str, bytes]]):
+        """Agregar un intervalo completo en una transacción; descarta lo más antiguo sobre max_rows"""
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT INTO outbox (topic, payload) VALUES (?, ?)", messages)
+            excess = self._count() - self.max_rows
+            if excess > 0:
+                self._db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (excess,))
+                self.dropped += excess
+                logger.warning(f"Outbox over {self.max_rows} messages, dropped {excess} oldest")
+            self._db.execute("COMMIT")
+
+    def peek(self, limit: int) -> List[Tuple[int, str, bytes]]:
+        """Los mensajes más antiguos, sin sacarlos de la cola"""
+        with self._lock:
+            return self._db.execute("SELECT id, topic, payload FROM outbox ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    def ack(self, upto_id: int):
+        """Confirmar todo hasta upto_id (los acks se aplican en orden)"""
+        with self._lock:
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", (upto_id,))
+
+    def _count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._lock: return self._count()
+
+    def close(self):
+        with self._lock: self._db.close()
@@ -4,76 +4,98 @@ Uses background subtraction, contour detection, and line crossing
 """
 
 import cv2
+import json
 import numpy as np
+from time import perf_counter_ns
 from datetime import datetime
 from collections import deque
 from typing import Dict, Optional, Tuple, List
 from .log import get_logger
 from .tracker import CentroidTracker
+from .crossing import LineCrossingCounter, scale_line_config
+from .capture import CAPTURES, build_capture_source
+from .metrics import REGISTRY
+from .motion import build_motion_gate
 
 logger = get_logger(__name__)
 
 class OpenCVPipeline:
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, capture: bool = True):
         self.config = config
         self.hive_id = config['hive_id']
         self.url = config['url']
         self.roi = config['roi'] # [x, y, width, height]
-        self.line_config = config['line'] # {axis: 'y', pos: 60 }
         self.direction_config = config['direction'] # { up_is_out: true }
-        self.min_area = config.get('min_area', 50)
-        self.max_area = config.get('max_area', 2000)
-        self.max_dist = config.get('max_dist', 40)
+
+        # Resolución de procesamiento: línea, áreas y distancias se reescalan
+        self.process_scale = float(config.get('process_scale', 1.0))
+        scale = self.process_scale
+        self.line_config = scale_line_config(config['line'], scale) # {axis: 'y', pos: 60 } o {points: [[x, y], ...]}
+        self.min_area = config.get('min_area', 50) * scale * scale
+        self.max_area = config.get('max_area', 2000) * scale * scale
+        self.max_dist = config.get('max_dist', 40) * scale
+        self.blur_ksize = max(int(round(5 * scale)), 1) | 1
+        self.detector = config.get('detector', 'contours') # contours | components
+        if self.detector not in ('contours', 'components'):
+            raise ValueError(f"Unknown detector backend: {self.detector}")
         
         # Background subtractor
-        self.bg_subtractor = cv2.createBackgroundSubtractor(
+        self.bg_subtractor = cv2.createBackgroundSubtractorMOG2(
             detectShadows=True,
             varThreshold=16,
             history=500
         )
+        self.bg_learning_rate = -1.0 # Automático; fijo en 1/history tras un arranque en caliente
+        self.warm_max_diff = float(config.get('warm_max_diff', 20)) # Diferencia media máxima frente al fondo guardado
+        self._pending_background = None
         
         # Tracker
         self.tracker = CentroidTracker(
             max_disappeared=20,
-            max_distance=self.max_dist
+            max_distance=self.max_dist,
+            solver=config.get('assignment', 'hungarian')
         )
         
         # Line crossing tracking
-        self.prev_positions = {}
+        self.crossing = LineCrossingCounter(self.line_config, self.direction_config)
         self.bee_counts = {'in': 0, 'out': 0}
+
+        # Sin movimiento: sólo se mantiene el modelo de fondo (tracker congelado), un frame de cada idle_bg_every
+        self.motion_gate = build_motion_gate(config)
+        self.idle_bg_every = max(int(config.get('idle_bg_every', 10)), 1)
+        self._idle_frames = 0
         
         # Performance metrics
+        self.metrics = REGISTRY.stream(self.hive_id)
         self.fps_deque = deque(maxlen=30)
         self.last_frame_time = datetime.now()
         
-        self.cap = cv2.VideoCapture(self.url)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-
-    def _init_capture(self):
-        """Initialize video capture with retry logic"""
-        self.cap.release()
-        self.cap = cv2.VideoCapture(self.url)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # Captura en hilo propio, compartida por los streams con la misma fuente (decodificación desacoplada)
+        self.read_timeout = config.get('read_timeout', 1.0)
+        self.grabber = None; self.decode_crops = False # capture=False: frames vía process() (replay)
+        if capture:
+            source, api_preference, self.decode_crops = build_capture_source(config)
+            self.grabber = CAPTURES.acquire(source, self.hive_id, api_preference) # Una decodificación por cámara
 
     def _extract_roi(self, frame: np.ndarray) -> np.ndarray:
         """Extract ROI from frame"""
+        if not self.roi:
+            return frame
         x, y, w, h = self.roi
         return frame[y:y+h, x:x+w]
     
     def _preprocess_frame(self, frame: np.ndarray) -> np.ndarray:
         """Preprocess frame for detection"""
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.process_scale != 1.0 and not self.decode_crops:
+            gray = cv2.resize(gray, None, fx=self.process_scale, fy=self.process_scale,
+                              interpolation=cv2.INTER_AREA)
+        blurred = cv2.GaussianBlur(gray, (self.blur_ksize, self.blur_ksize), 0)
         # Simplified morphology
         return blurred
     
-    def _detect_bees(self, frame: np.ndarray) -> List[Tuple[int, int]]:
-        """Detect bees in frame and return centroids"""
-        # Aplicar background subtraction
-        fg_mask = self.bg_subtractor.apply(frame)
-        fg_mask[fg_mask < 127] = 0
-        
-        # Encontrar y filtrar por contornos
+    def _centroids_from_contours(self, fg_mask: np.ndarray) -> np.ndarray:
+        """Backend 'contours': findContours + momentos por contorno"""
         contours, _ = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         centroids = []
@@ -86,37 +108,35 @@ class OpenCVPipeline:
                     cX = int(M["m10"] / M["m00"])
                     cY = int(M["m01"] / M["m00"])
                     centroids.append((cX, cY))
+        return np.array(centroids, dtype=int).reshape(-1, 2)
+
+    def _centroids_from_components(self, fg_mask: np.ndarray) -> np.ndarray:
+        """Backend 'components': áreas y centroides como arreglos, filtro de área en una máscara"""
+        _, _, stats, centroids = cv2.connectedComponentsWithStats(fg_mask, connectivity=8)
+        areas = stats[1:, cv2.CC_STAT_AREA] # La etiqueta 0 es el fondo
+        keep = (areas >= self.min_area) & (areas <= self.max_area)
+        return centroids[1:][keep].astype(int)
+
+    def _detect_bees(self, frame: np.ndarray) -> np.ndarray:
+        """Detect bees in frame and return centroids"""
+        # Aplicar background subtraction
+        t0 = perf_counter_ns()
+        fg_mask = self.bg_subtractor.apply(frame, learningRate=self.bg_learning_rate)
+        fg_mask[fg_mask < 127] = 0
+        t1 = perf_counter_ns(); self.metrics.observe('bgsub', t0, t1)
+        centroids = self._find_centroids(fg_mask)
+        self.metrics.observe('blobs', t1, perf_counter_ns())
         return centroids
 
+    def _find_centroids(self, fg_mask: np.ndarray) -> np.ndarray:
+        """Centroides de blobs dentro de [min_area, max_area] con el backend configurado"""
+        if self.detector == 'components':
+            return self._centroids_from_components(fg_mask)
+        return self._centroids_from_contours(fg_mask)
+
     def _check_line_crossing(self, object_id: int, prev_pos: Tuple[int, int], curr_pos: Tuple[int, int]) -> Optional[str]:
         """Check if object crossed the counting line"""
-        axis = self.line_config['axis']
-        line_pos = self.line_config['pos']
-        up_is_out = self.direction_config.get('up_is_out', True)
-        
-        if axis == 'y': # Horizontal line
-            prev_y = prev_pos
-            curr_y = curr_pos
-            
-            # Crossing from below to above
-            if prev_y < line_pos - 2 and curr_y >= line_pos + 2:
-                return 'out' if up_is_out else 'in'
-            # Crossing from above to below
-            elif prev_y > line_pos + 2 and curr_y <= line_pos - 2:
-                return 'in' if up_is_out else 'out'
-        
-        elif axis == 'x': # Vertical line
-            prev_x = prev_pos
-            curr_x = curr_pos
-            
-            # Crossing from left to right
-            if prev_x < line_pos - 2 and curr_x >= line_pos + 2:
-                return 'out' if up_is_out else 'in'
-            # Crossing from right to left
-            elif prev_x > line_pos + 2 and curr_x <= line_pos - 2:
-                return 'in' if up_is_out else 'out'
-        
-        return None
+        return self.crossing.check(prev_pos, curr_pos)
 
     def _calculate_fps(self):
         """Calculate current FPS"""
@@ -131,36 +151,44 @@ class OpenCVPipeline:
     
     def process_frame(self) -> Optional[Dict]:
         """Process a single frame and return counts"""
-        if not self.cap.isOpened():
-            self._init_capture()
+        t0 = perf_counter_ns()
+        frame = self.grabber.read(timeout=self.read_timeout)
+        if frame is None:
             return None
+        self.metrics.observe('capture_wait', t0, perf_counter_ns())
+        return self.process(frame)
 
-        ret, frame = self.cap.read()
-        if not ret or frame is None:
-            self._init_capture()
-            return None
+    def process(self, frame: np.ndarray) -> Dict:
+        """Contar sobre un frame ya decodificado (captura en vivo o replay)"""
+        t1 = perf_counter_ns(); m = self.metrics
+        dropped = self.grabber.frames_dropped if self.grabber else 0
         
         # Extracción y procesamiento
-        roi_frame = self._extract_roi(frame)
+        roi_frame = frame if self.decode_crops else self._extract_roi(frame)
+        active = self.motion_gate is None or self.motion_gate.update(roi_frame)
+        if not active:
+            self._idle_frames += 1
+            if self._idle_frames % self.idle_bg_every == 0: self._idle_background(roi_frame)
+            m.observe('idle', t1, perf_counter_ns()); m.skipped += 1; m.dropped = dropped
+            return {'in': 0, 'out': 0, 'fps': self._calculate_fps(), 'dropped': dropped, 'algo': 'opencv', 'idle': True}
+        self._idle_frames = 0
         preprocessed_frame = self._preprocess_frame(roi_frame)
+        if self._pending_background is not None: self._seed_background(preprocessed_frame)
+        t2 = perf_counter_ns(); m.observe('preprocess', t1, t2)
         centroids = self._detect_bees(preprocessed_frame)
-        objects = self.tracker.update(centroids)
+        t3 = perf_counter_ns()
+        self.tracker.update(centroids)
+        t4 = perf_counter_ns(); m.observe('track', t3, t4)
 
-        frame_counts = {'in': 0, 'out': 0}
-        
-        for object_id, centroid in objects.items():
-            if object_id in self.prev_positions:
-                prev_pos = self.prev_positions[object_id]
-                direction = self._check_line_crossing(object_id, prev_pos, centroid)
-                if direction:
-                    frame_counts[direction] += 1
-                    self.bee_counts[direction] += 1
-            self.prev_positions[object_id] = centroid
-
-        self.prev_positions = {
-            oid: pos for oid, pos in self.prev_positions.items()
-            if oid in objects
-        }
+        # Cruces evaluados sobre los arreglos del tracker (posición previa vs actual)
+        store = self.tracker.store; n = store.size
+        crossed_in, crossed_out = self.crossing.evaluate(
+            store.prev_positions[:n], store.positions[:n], store.side[:n])
+        t5 = perf_counter_ns(); m.observe('crossing', t4, t5); m.observe('total', t1, t5)
+        m.frames += 1; m.dropped = dropped
+        frame_counts = {'in': int(crossed_in.sum()), 'out': int(crossed_out.sum())}
+        self.bee_counts['in'] += frame_counts['in']
+        self.bee_counts['out'] += frame_counts['out']
         
         fps = self._calculate_fps()
 
@@ -168,11 +196,62 @@ class OpenCVPipeline:
             'in': frame_counts['in'],
             'out': frame_counts['out'],
             'fps': fps,
+            'dropped': dropped,
             'algo': 'opencv'
         }
     
+    def geometry(self) -> dict:
+        """Lo que invalida un snapshot si cambia: cámara, recorte, escala y línea"""
+        return json.loads(json.dumps({'url': self.url, 'roi': self.roi, 'process_scale': self.process_scale,
+                                      'line': self.config['line']}))
+
+    def _bg_params(self) -> dict:
+        sub = self.bg_subtractor
+        return {'history': sub.getHistory(), 'var_threshold': sub.getVarThreshold(), 'detect_shadows': sub.getDetectShadows()}
+
+    def snapshot_state(self) -> dict:
+        """Fondo aprendido, tracks abiertos y geometría para reinicio en caliente"""
+        state = dict(self.tracker.snapshot_state(), geometry=self.geometry(), bg_params=self._bg_params())
+        background = self.bg_subtractor.getBackgroundImage() # None antes del primer frame
+        if background is None: background = self._pending_background
+        if background is not None: state['background'] = background
+        return state
+
+    def restore_state(self, state: dict) -> bool:
+        if state.get('geometry') != self.geometry():
+            logger.info(f"{self.hive_id}: Camera geometry changed since snapshot, cold start")
+            return False
+        restored = []
+        if 'background' in state and state.get('bg_params') == self._bg_params():
+            self._pending_background = state['background']; restored.append('background') # Se siembra con el primer frame
+        if 'track_ids' in state:
+            self.tracker.restore_state(state); restored.append(f"{len(state['track_ids'])} tracks")
+        if restored:
+            logger.info(f"{self.hive_id}: Warm start from {state['age']:.0f}s old snapshot ({', '.join(restored)})")
+        return bool(restored)
+
+    def _seed_background(self, frame: np.ndarray):
+        """Sembrar MOG2 con el fondo guardado si la escena coincide (misma forma, sin cambio brusco de luz)"""
+        background = self._pending_background; self._pending_background = None
+        if background.shape != frame.shape or cv2.absdiff(background, frame).mean() > self.warm_max_diff:
+            logger.info(f"{self.hive_id}: Scene differs from snapshot, learning background from scratch")
+            return
+        self.bg_subtractor.apply(background, learningRate=1.0)
+        self.bg_learning_rate = 1.0 / self.bg_subtractor.getHistory() # El contador interno de MOG2 volvió a 0
+
+    def _idle_background(self, roi_frame: np.ndarray):
+        """El fondo sigue la luz sin blobs ni tracking; con la tasa escalada por los frames saltados"""
+        preprocessed_frame = self._preprocess_frame(roi_frame)
+        if self._pending_background is not None: self._seed_background(preprocessed_frame)
+        rate = self.bg_learning_rate if self.bg_learning_rate > 0 else 1.0 / self.bg_subtractor.getHistory()
+        self.bg_subtractor.apply(preprocessed_frame, learningRate=min(rate * self.idle_bg_every, 1.0))
+
+    @property
+    def idle(self) -> bool:
+        """Entrada sin movimiento: el scheduler baja a idle_fps"""
+        return self.motion_gate is not None and self.motion_gate.idle
+
     def cleanup(self):
         """Clean up resources"""
-        if self.cap.isOpened():
-            self.cap.release()
+        if self.grabber: self.grabber.stop()
         logger.info(f"{self.hive_id}: OpenCV pipeline cleaned up")
\ No newline at end of file
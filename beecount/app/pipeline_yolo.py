@@ -3,121 +3,101 @@ YOLO-based bee counting pipeline
 Uses YOLO model for object detection and centroid tracking
 """
 
-import os
 import cv2
+import json
 import numpy as np
+from time import perf_counter_ns
 from datetime import datetime
 from collections import deque
 from typing import Dict, Optional, Tuple, List
 from .log import get_logger
 from .tracker import CentroidTracker
-from ultralytics import YOLO # Importación necesaria para YOLO
+from .crossing import LineCrossingCounter
+from .capture import CAPTURES
+from .inference import YOLOInferenceService
+from .metrics import REGISTRY
+from .motion import build_motion_gate
 
 logger = get_logger(__name__)
 
 class YOLOPipeline:
     """YOLO-based bee detection and counting pipeline"""
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, capture: bool = True):
         self.config = config
         self.hive_id = config['hive_id']
         self.url = config['url']
         self.roi = config['roi'] # [x, y, width, height]
-        self.line_config = config['line'] # {axis: 'y', pos: 60}
+        self.line_config = config['line'] # {axis: 'y', pos: 60} o {points: [[x, y], ...]}
         self.direction_config = config['direction'] # {up_is_out: true}
         self.max_dist = config.get('max_dist', 40)
         
-        # Video capture
-        self.cap = None
-        self.reconnect_attempts = 0
-        self.max_reconnect_attempts = 5
+        # Captura en hilo propio, compartida por los streams con la misma fuente
+        self.read_timeout = config.get('read_timeout', 1.0)
+        self.grabber = None # Se adquiere tras cargar el modelo; sin captura: replay
         
-        # YOLO model
-        self.model = None
+        # YOLO model (instancia compartida entre todos los streams YOLO del proceso)
+        self.inference = None
         self.confidence_threshold = config.get('confidence', 0.5)
         self.nms_threshold = config.get('nms_threshold', 0.4)
+        self.min_box_area = config.get('min_box_area', 100) # Tamaño típico de abeja
+        self.max_box_area = config.get('max_box_area', 5000)
         
         # Tracker
         self.tracker = CentroidTracker(
             max_disappeared=20,
-            max_distance=self.max_dist
+            max_distance=self.max_dist,
+            solver=config.get('assignment', 'hungarian')
         )
         
         # Line crossing tracking
-        self.prev_positions = {}
+        self.crossing = LineCrossingCounter(self.line_config, self.direction_config)
         self.bee_counts = {'in': 0, 'out': 0}
+
+        # Sin movimiento no se llama al modelo (tracker congelado)
+        self.motion_gate = build_motion_gate(config)
         
         # Performance metrics
+        self.metrics = REGISTRY.stream(self.hive_id)
         self.fps_deque = deque(maxlen=30)
         self.last_frame_time = datetime.now()
         
         # Initialize components
-        self._init_capture()
         self._init_yolo()
+        if capture: self.grabber = CAPTURES.acquire(self.url, self.hive_id) # Una decodificación por cámara
 
-    def _init_capture(self) -> bool:
-        """Initialize video capture with retry logic"""
-        # (Lógica de inicialización de captura de video con cv2.VideoCapture y reintentos) [21–22]
-        return True # Placeholder
-    
     def _init_yolo(self):
-        """Initialize YOLO model"""
+        """Attach to the shared YOLO inference service"""
         try:
-            from ultralytics import YOLO
-            model_path = self.config.get('model_path', 'yolov8n.pt')
-            
-            if os.path.exists(model_path):
-                self.model = YOLO(model_path)
-                logger.info(f"{self.hive_id}: Loaded custom YOLO model from {model_path}")
-            else:
-                self.model = YOLO('yolov8n.pt')
-                logger.info(f"{self.hive_id}: Loaded default YOLO model")
-            self.model.fuse()
-        except ImportError:
-            logger.error(f"{self.hive_id}: ultralytics package not installed.")
-            raise
+            self.inference = YOLOInferenceService.shared(
+                self.config.get('model_path', 'yolov8n.pt'),
+                backend=self.config.get('inference_backend', 'ultralytics'),
+                imgsz=self.config.get('imgsz', 640),
+                max_batch=self.config.get('max_batch', 8),
+                max_latency=self.config.get('batch_latency', 0.02),
+                nms_iou=self.nms_threshold
+            )
         except Exception as e:
             logger.error(f"{self.hive_id}: Failed to initialize YOLO: {e}")
             raise
 
     def _extract_roi(self, frame: np.ndarray) -> np.ndarray:
         """Extract ROI from frame"""
+        if not self.roi:
+            return frame
         x, y, w, h = self.roi
         return frame[y:y+h, x:x+w]
 
-    def _detect_bees(self, frame: np.ndarray) -> List[Tuple[int, int]]:
+    def _detect_bees(self, frame: np.ndarray) -> np.ndarray:
         """Detect bees using YOLO model"""
         try:
-            # Run YOLO inference
-            results = self.model(frame, verbose=False)
-            centroids = []
-            
-            for result in results:
-                boxes = result.boxes
-                if boxes is not None:
-                    for box in boxes:
-                        x1, y1, x2, y2 = box.xyxy.cpu().numpy()
-                        confidence = box.conf.cpu().numpy()
-                        
-                        if confidence >= self.confidence_threshold:
-                            cx = int((x1 + x2) / 2); cy = int((y1 + y2) / 2)
-                            width = x2 - x1; height = y2 - y1; area = width * height
-                            
-                            # Filter based on area (typical bee size)
-                            if 100 <= area <= 5000:
-                                centroids.append((cx, cy))
-            return centroids
+            return self.inference.detect(frame, self.confidence_threshold, self.min_box_area, self.max_box_area)
         except Exception as e:
             logger.error(f"{self.hive_id}: YOLO detection error: {e}")
-            return []
+            return np.zeros((0, 2), dtype=int)
 
     def _check_line_crossing(self, object_id: int, prev_pos: Tuple[int, int], curr_pos: Tuple[int, int]) -> Optional[str]:
         """Check if object crossed the counting line"""
-        axis = self.line_config['axis']
-        line_pos = self.line_config['pos']
-        up_is_out = self.direction_config.get('up_is_out', True)
-        
-        # (Lógica detallada de cruce de línea con histéresis) [26–27]
-        return None # Placeholder
+        return self.crossing.check(prev_pos, curr_pos)
 
     def _calculate_fps(self):
         """Calculate current FPS"""
@@ -132,18 +112,67 @@ class YOLOPipeline:
 
     def process_frame(self) -> Optional[Dict]:
         """Process a single frame and return counts"""
-        # (Lógica de procesamiento de frame, tracker update, y line crossing) [28–30]
-        
-        # Simulación de retorno final
+        t0 = perf_counter_ns()
+        frame = self.grabber.read(timeout=self.read_timeout)
+        if frame is None:
+            return None
+        self.metrics.observe('capture_wait', t0, perf_counter_ns())
+        return self.process(frame)
+
+    def process(self, frame: np.ndarray) -> Dict:
+        """Contar sobre un frame ya decodificado (captura en vivo o replay)"""
+        t1 = perf_counter_ns(); m = self.metrics
+        dropped = self.grabber.frames_dropped if self.grabber else 0
+
+        roi_frame = self._extract_roi(frame)
+        active = self.motion_gate is None or self.motion_gate.update(roi_frame)
+        t2 = perf_counter_ns(); m.observe('preprocess', t1, t2)
+        if not active:
+            m.skipped += 1; m.dropped = dropped
+            return {'in': 0, 'out': 0, 'fps': self._calculate_fps(), 'dropped': dropped, 'algo': 'yolo', 'idle': True}
+        centroids = self._detect_bees(roi_frame) # Incluye la espera del lote compartido
+        t3 = perf_counter_ns(); m.observe('inference', t2, t3)
+        self.tracker.update(centroids)
+        t4 = perf_counter_ns(); m.observe('track', t3, t4)
+
+        store = self.tracker.store; n = store.size
+        crossed_in, crossed_out = self.crossing.evaluate(
+            store.prev_positions[:n], store.positions[:n], store.side[:n])
+        t5 = perf_counter_ns(); m.observe('crossing', t4, t5); m.observe('total', t1, t5)
+        m.frames += 1; m.dropped = dropped
+        frame_counts = {'in': int(crossed_in.sum()), 'out': int(crossed_out.sum())}
+        self.bee_counts['in'] += frame_counts['in']
+        self.bee_counts['out'] += frame_counts['out']
+
         return {
-            'in': 0,
-            'out': 0,
+            'in': frame_counts['in'],
+            'out': frame_counts['out'],
             'fps': self._calculate_fps(),
+            'dropped': dropped,
             'algo': 'yolo'
         }
     
+    def geometry(self) -> dict:
+        """Lo que invalida un snapshot si cambia: cámara, recorte y línea"""
+        return json.loads(json.dumps({'url': self.url, 'roi': self.roi, 'line': self.line_config}))
+
+    def snapshot_state(self) -> dict:
+        """Tracks abiertos y geometría para reinicio en caliente (YOLO no tiene modelo de fondo)"""
+        return dict(self.tracker.snapshot_state(), geometry=self.geometry())
+
+    def restore_state(self, state: dict) -> bool:
+        if state.get('geometry') != self.geometry() or 'track_ids' not in state:
+            return False
+        self.tracker.restore_state(state)
+        logger.info(f"{self.hive_id}: Warm start with {len(state['track_ids'])} tracks from {state['age']:.0f}s old snapshot")
+        return True
+
+    @property
+    def idle(self) -> bool:
+        """Entrada sin movimiento: el scheduler baja a idle_fps"""
+        return self.motion_gate is not None and self.motion_gate.idle
+
     def cleanup(self):
         """Clean up resources"""
-        if self.cap and self.cap.isOpened():
-            self.cap.release()
+        if self.grabber: self.grabber.stop()
         logger.info(f"{self.hive_id}: YOLO pipeline cleaned up")
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Metrics publisher
+Publishes count intervals from its own thread: per-hive JSON (Telegraf) and optional apiary-level batches
+"""
+
+import json
+import time
+import threading
+import psutil
+import paho.mqtt.client as mqtt
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+ENCODINGS = ('json', 'msgpack', 'cbor')
+
+def encode_payload(payload: dict, encoding: str) -> bytes:
+    """Serializar con el formato elegido; msgpack/cbor son dependencias opcionales"""
+    if encoding == 'msgpack':
+        import msgpack
+        return msgpack.packb(payload, use_bin_type=True)
+    if encoding == 'cbor':
+        import cbor2
+        return cbor2.dumps(payload)
+    return json.dumps(payload).encode()
+
+class MetricsPublisher:
+    """Hilo de publicación: no bloquea la planificación de frames de los streams"""
+    def __init__(self, mqtt_client, streams: List[dict], take_snapshot: Callable[[], Dict[str, dict]],
+                 period: float, publish_config: dict = None, outbox=None):
+        publish_config = publish_config or {}
+        self.mqtt_client = mqtt_client
+        self.apiary_of = {s['hive_id']: s.get('apiary_id', 'A01') for s in streams}
+        self.take_snapshot = take_snapshot # Devuelve y reinicia los conteos del intervalo
+        self.period = period
+        self.outbox = outbox # CountOutbox: sin él se publica directo (sin garantía offline)
+        self.replay_batch = publish_config.get('replay_batch', 200)
+        self.retry_interval = min(publish_config.get('retry_interval', 5.0), period)
+        # Espera corta: lo que no se confirmó sigue en vuelo en paho y se revisa en la siguiente pasada
+        self.ack_timeout = min(publish_config.get('ack_timeout', 1.0), self.retry_interval)
+        self._inflight: Dict[int, mqtt.MQTTMessageInfo] = {} # id de fila del outbox -> publicación en paho
+        self.per_hive = publish_config.get('per_hive', True)
+        self.apiary_batch = publish_config.get('apiary_batch', False)
+        self.encoding = publish_config.get('encoding', 'json')
+        if self.encoding not in ENCODINGS:
+            raise ValueError(f"Unknown publish encoding: {self.encoding}")
+        try:
+            encode_payload({}, self.encoding)
+        except ImportError:
+            logger.error(f"{self.encoding} package not installed, apiary batches fall back to json")
+            self.encoding = 'json'
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_publish_seconds = 0.0
+        psutil.cpu_percent(interval=None) # Primer muestreo establece la referencia
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                # Sigue dentro de _forward: publicar o cerrar aquí usaría el outbox a la vez o ya cerrado.
+                # El intervalo en curso queda en los conteos parciales (snapshot) para el próximo arranque
+                logger.warning(f"Publisher thread still busy after {timeout:.1f}s, skipping final publish and outbox close")
+                return
+        self.publish() # Último intervalo parcial
+        if self.outbox is not None: self.outbox.close()
+
+    def _run(self):
+        next_publish = time.monotonic() + self.period
+        while not self._stop.wait(self.retry_interval):
+            if time.monotonic() >= next_publish:
+                self.publish(); next_publish += self.period
+            elif self.outbox is not None and len(self.outbox):
+                try: self._forward() # Reenviar el backlog en cuanto vuelva la conexión
+                except Exception as e: logger.error(f"Outbox replay failed: {e}")
+
+    def publish(self):
+        started = time.perf_counter()
+        try:
+            cpu_pct = psutil.cpu_percent(interval=None) # No bloqueante: % desde la muestra anterior
+            now = datetime.now(timezone.utc)
+            snapshot = self.take_snapshot()
+            messages = []
+            if self.per_hive:
+                messages += [self._hive_message(hive_id, metrics, cpu_pct, now) for hive_id, metrics in snapshot.items()]
+            if self.apiary_batch:
+                messages += self._apiary_messages(snapshot, cpu_pct, now)
+            if self.outbox is None:
+                for topic, payload in messages: self.mqtt_client.publish(topic, payload, qos=1)
+                return
+            if messages: self.outbox.append(messages) # Persistir antes de enviar: el ts original viaja en el payload
+            self._forward()
+        except Exception as e: logger.error(f"Failed to publish metrics: {e}")
+        finally: self.last_publish_seconds = time.perf_counter() - started
+
+    def _forward(self):
+        """Vaciar el outbox en orden y en bloques; sólo se borra lo que el broker confirmó"""
+        while self.mqtt_client.is_connected():
+            rows = self.outbox.peek(self.replay_batch)
+            for row_id in [k for k in self._inflight if not rows or k < rows[0][0]]:
+                del self._inflight[row_id] # Descartadas por el tope del outbox
+            if not rows: return
+            infos = [self._publish_row(*row) for row in rows]
+            deadline = time.monotonic() + self.ack_timeout
+            while not all(info.is_published() for info in infos) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            acked = 0
+            for info in infos: # Prefijo confirmado: mantiene el orden al reintentar
+                if not info.is_published(): break
+                acked += 1
+            if acked:
+                self.outbox.ack(rows[acked - 1][0])
+                for row_id, _, _ in rows[:acked]: self._inflight.pop(row_id, None)
+            if acked < len(rows):
+                logger.warning(f"Broker acknowledged {acked}/{len(rows)} messages, {len(self.outbox)} left in outbox"); return
+
+    def _publish_row(self, row_id: int, topic: str, payload: bytes):
+        """Publicar una fila salvo que paho ya la tenga en vuelo: él mismo la reenvía (dup) al reconectar,
+        así que sólo se vuelve a publicar si paho la rechazó (p. ej. cola llena)"""
+        info = self._inflight.get(row_id)
+        if info is None or (not info.is_published() and info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)):
+            info = self._inflight[row_id] = self.mqtt_client.publish(topic, payload, qos=1)
+        return info
+
+    def _hive_message(self, hive_id: str, metrics: dict, cpu_pct: float, now: datetime) -> Tuple[str, bytes]:
+        net_count = metrics['bees_in'] - metrics['bees_out']
+        payload = {
+            'ts': now.isoformat(), 'apiary_id': self.apiary_of.get(hive_id, 'A01'), 'hive_id': hive_id,
+            'bees_in_1m': metrics['bees_in'], 'bees_out_1m': metrics['bees_out'], 'bees_net_1m': net_count,
+            'fps': round(metrics['fps'], 1), 'cpu_pct': round(cpu_pct, 1), 'algo': metrics['algo']
+        }
+        logger.info(f"Interval {hive_id}: in={metrics['bees_in']}, out={metrics['bees_out']}, net={net_count}")
+        return f"hives/{hive_id}/beecount", json.dumps(payload).encode()
+
+    def _apiary_messages(self, snapshot: Dict[str, dict], cpu_pct: float, now: datetime) -> List[Tuple[str, bytes]]:
+        """Un mensaje por apiario con los conteos de todas sus colmenas"""
+        by_apiary = defaultdict(dict)
+        for hive_id, metrics in snapshot.items():
+            by_apiary[self.apiary_of.get(hive_id, 'A01')][hive_id] = {
+                'in': metrics['bees_in'], 'out': metrics['bees_out'],
+                'fps': round(metrics['fps'], 1), 'algo': metrics['algo']
+            }
+        suffix = '' if self.encoding == 'json' else f"/{self.encoding}"
+        return [(f"apiaries/{apiary_id}/beecount{suffix}",
+                 encode_payload({'ts': int(now.timestamp()), 'apiary_id': apiary_id, 'cpu_pct': round(cpu_pct, 1), 'hives': hives},
+                                self.encoding))
+                for apiary_id, hives in by_apiary.items()]
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+Replay mode
+Recounts recorded clips or frame directories as fast as the CPU allows, decoding once and
+fanning every frame out to several parameter sets for offline tuning
+"""
+
+import os
+import csv
+import copy
+import queue
+import argparse
+import itertools
+import threading
+from collections import defaultdict
+from time import perf_counter
+from typing import Iterable, Iterator, List, Optional, Tuple
+import cv2
+import yaml
+import numpy as np
+from .log import get_logger
+from .workers import build_pipeline
+
+logger = get_logger(__name__)
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+def iter_frames(source: str, fps: Optional[float] = None) -> Iterator[Tuple[float, np.ndarray]]:
+    """(segundo del clip, frame) de un video o de un directorio de imágenes ordenadas por nombre"""
+    if os.path.isdir(source):
+        files = sorted(f for f in os.listdir(source) if f.lower().endswith(IMAGE_EXTS))
+        for i, name in enumerate(files):
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is not None: yield i / (fps or 10.0), frame
+        return
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise ValueError(f"Cannot open clip: {source}")
+    clip_fps = fps or cap.get(cv2.CAP_PROP_FPS) or 10.0
+    try:
+        i = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret: break
+            yield i / clip_fps, frame; i += 1
+    finally: cap.release()
+
+def apply_overrides(base: dict, overrides: dict) -> dict:
+    """Copia del stream con claves reemplazadas; 'line.pos' modifica claves anidadas"""
+    config = copy.deepcopy(base)
+    for key, value in overrides.items():
+        target = config; parts = key.split('.')
+        for part in parts[:-1]: target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return config
+
+def expand_variants(grid: List[str] = (), variants: List[dict] = ()) -> List[Tuple[str, dict]]:
+    """Producto cartesiano de --grid key=v1,v2 más variantes explícitas ({name, ...overrides})"""
+    result = []
+    if grid:
+        keys = [g.split('=', 1)[0] for g in grid]
+        values = [[yaml.safe_load(v) for v in g.split('=', 1)[1].split(',')] for g in grid]
+        for combo in itertools.product(*values):
+            overrides = dict(zip(keys, combo))
+            result.append((','.join(f"{k}={v}" for k, v in overrides.items()), overrides))
+    for i, variant in enumerate(variants):
+        variant = dict(variant)
+        result.append((str(variant.pop('name', f"variant{i}")), variant))
+    return result or [('base', {})]
+
+class _Lane(threading.Thread):
+    """Un pipeline por variante; recibe los mismos frames (sin copiar) por una cola acotada"""
+    def __init__(self, name: str, pipeline, bucket_s: float, queue_size: int):
+        super().__init__(name=f"replay-{name}", daemon=True)
+        self.variant = name; self.pipeline = pipeline; self.bucket_s = bucket_s
+        self.queue = queue.Queue(maxsize=queue_size) # Acotada: la variante más lenta marca el ritmo
+        self.buckets = defaultdict(lambda: [0, 0])
+        self.frames = 0; self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: return
+            if self.error: continue # Seguir drenando para no bloquear al decodificador
+            ts, frame = item
+            try:
+                counts = self.pipeline.process(frame)
+            except Exception as e:
+                self.error = e; logger.error(f"Replay variant {self.variant} failed: {e}"); continue
+            bucket = self.buckets[int(ts // self.bucket_s)]
+            bucket[0] += counts['in']; bucket[1] += counts['out']; self.frames += 1
+
+def replay_clip(stream_config: dict, frames: Iterable[Tuple[float, np.ndarray]], variants: List[Tuple[str, dict]],
+                bucket_s: float = 60.0, queue_size: int = 32) -> List[dict]:
+    """Decodificar una vez y contar con todas las variantes en paralelo; una fila por variante"""
+    lanes = []
+    for name, overrides in variants:
+        config = apply_overrides(stream_config, overrides)
+        config['hive_id'] = f"{stream_config['hive_id']}/{name}"
+        lanes.append(_Lane(name, build_pipeline(config, capture=False), bucket_s, queue_size))
+    for lane in lanes: lane.start()
+
+    started = perf_counter(); decoded = 0
+    try:
+        for item in frames:
+            for lane in lanes: lane.queue.put(item) # Mismo arreglo para todas: los pipelines no lo modifican
+            decoded += 1
+    finally:
+        for lane in lanes: lane.queue.put(None)
+        for lane in lanes: lane.join()
+        for lane in lanes: lane.pipeline.cleanup()
+    elapsed = perf_counter() - started
+
+    rows = []
+    for lane in lanes:
+        total_in = sum(b[0] for b in lane.buckets.values()); total_out = sum(b[1] for b in lane.buckets.values())
+        rows.append({
+            'variant': lane.variant, 'in': total_in, 'out': total_out, 'net': total_in - total_out,
+            'frames': lane.frames, 'decoded': decoded, 'fps': decoded / elapsed if elapsed else 0.0,
+            'error': str(lane.error) if lane.error else None,
+            'buckets': {k * bucket_s: tuple(v) for k, v in sorted(lane.buckets.items())}
+        })
+    return rows
+
+def _load_stream(config_path: str, hive_id: Optional[str]) -> dict:
+    with open(config_path) as f: streams = yaml.safe_load(f)['streams']
+    if hive_id is None: return streams[0]
+    for stream in streams:
+        if stream['hive_id'] == hive_id: return stream
+    raise ValueError(f"Hive {hive_id} not found in {config_path}")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Recuento offline de clips grabados con varias configuraciones")
+    parser.add_argument('sources', nargs='+', help="Videos o directorios de imágenes")
+    parser.add_argument('--config', default="app/roi_config.yaml")
+    parser.add_argument('--hive', help="hive_id base (default: primer stream)")
+    parser.add_argument('--grid', action='append', default=[], metavar="KEY=V1,V2",
+                        help="Barrido de parámetros, p.ej. --grid min_area=30,50 --grid line.pos=55,60")
+    parser.add_argument('--variants', help="YAML con una lista de overrides {name: ..., clave: valor}")
+    parser.add_argument('--bucket', type=float, default=60.0, help="Segundos de clip por fila de la tabla CSV")
+    parser.add_argument('--fps', type=float, default=None, help="FPS del clip si el contenedor no lo indica")
+    parser.add_argument('--csv', help="Tabla de conteos por clip, variante e intervalo")
+    args = parser.parse_args(argv)
+
+    stream = _load_stream(args.config, args.hive)
+    explicit = []
+    if args.variants:
+        with open(args.variants) as f: explicit = yaml.safe_load(f) or []
+    variants = expand_variants(args.grid, explicit)
+    logger.info(f"Replaying {len(args.sources)} source(s) with {len(variants)} variant(s) of {stream['hive_id']}")
+
+    writer = None
+    if args.csv:
+        csv_file = open(args.csv, 'w', newline='')
+        writer = csv.writer(csv_file); writer.writerow(['source', 'variant', 'bucket_start_s', 'in', 'out', 'net'])
+    width = max(len(name) for name, _ in variants)
+    for source in args.sources:
+        rows = replay_clip(stream, iter_frames(source, args.fps), variants, args.bucket)
+        print(f"\n{source} ({rows[0]['decoded']} frames, {rows[0]['fps']:.0f} fps)")
+        print(f"{'variant':<{width}} {'in':>7} {'out':>7} {'net':>7}")
+        for row in rows:
+            suffix = f"  ERROR: {row['error']}" if row['error'] else ''
+            print(f"{row['variant']:<{width}} {row['in']:>7} {row['out']:>7} {row['net']:>7}{suffix}")
+            if writer:
+                for start, (n_in, n_out) in row['buckets'].items():
+                    writer.writerow([source, row['variant'], start, n_in, n_out, n_in - n_out])
+    if writer: csv_file.close()
+
+if __name__ == "__main__":
+    main()
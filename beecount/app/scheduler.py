@@ -0,0 +1,89 @@
+"""
+Per-stream worker scheduling
+Long-lived worker threads with their own frame pacing and CPU-aware back-off
+"""
+
+import time
+import queue
+import threading
+import psutil
+from typing import Callable, Optional
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+class CpuGovernor:
+    """Factor de back-off global según la carga de CPU (muestreo no bloqueante)"""
+    def __init__(self, cpu_high: float = 85.0, cpu_low: float = 60.0, max_scale: float = 4.0):
+        self.cpu_high = cpu_high
+        self.cpu_low = cpu_low
+        self.max_scale = max_scale
+        self.scale = 1.0 # Multiplicador del periodo de frame
+        self.cpu_pct = 0.0
+        psutil.cpu_percent(interval=None) # Primer muestreo establece la referencia
+
+    def sample(self) -> float:
+        self.cpu_pct = psutil.cpu_percent(interval=None)
+        if self.cpu_pct >= self.cpu_high:
+            self.scale = min(self.scale * 1.25, self.max_scale)
+        elif self.cpu_pct <= self.cpu_low:
+            self.scale = max(self.scale / 1.25, 1.0)
+        return self.cpu_pct
+
+class StreamWorker(threading.Thread):
+    """Hilo persistente por stream: procesa frames a su propio ritmo y publica en una cola"""
+    def __init__(self, stream_config: dict, pipeline_factory: Callable[[dict], Optional[object]],
+                 results: queue.SimpleQueue, stop_event: threading.Event, governor: CpuGovernor, snapshots=None):
+        self.hive_id = stream_config['hive_id']
+        super().__init__(name=f"worker-{self.hive_id}", daemon=True)
+        self.stream_config = stream_config
+        self.pipeline_factory = pipeline_factory
+        self.results = results
+        self.stop_event = stop_event
+        self.governor = governor
+        self.target_fps = float(stream_config.get('target_fps', 10))
+        self.min_fps = float(stream_config.get('min_fps', 1))
+        self.idle_fps = float(stream_config.get('idle_fps', 1)) # Ritmo con la entrada sin movimiento
+        self.snapshots = snapshots # SnapshotStore: estado guardado desde este mismo hilo, sin locks
+        self.pipeline = None
+
+    def frame_period(self) -> float:
+        """Periodo objetivo con back-off, acotado por min_fps"""
+        if self.target_fps <= 0:
+            return 0.0
+        period = min(self.governor.scale / self.target_fps, 1.0 / self.min_fps)
+        if getattr(self.pipeline, 'idle', False) and self.idle_fps > 0:
+            period = max(period, 1.0 / self.idle_fps) # Vuelve al ritmo normal en el primer frame con movimiento
+        return period
+
+    def run(self):
+        retry_delay = 1.0
+        while not self.stop_event.is_set() and self.pipeline is None:
+            self.pipeline = self.pipeline_factory(self.stream_config)
+            if self.pipeline is None:
+                self.stop_event.wait(retry_delay); retry_delay = min(retry_delay * 2, 60.0)
+
+        if self.snapshots and self.pipeline is not None:
+            self.snapshots.restore(self.hive_id, self.pipeline)
+        next_tick = time.monotonic()
+        next_snapshot = next_tick + (self.snapshots.interval if self.snapshots else 0.0)
+        while not self.stop_event.is_set():
+            try:
+                counts = self.pipeline.process_frame()
+                if counts:
+                    self.results.put((self.hive_id, counts))
+            except Exception as e:
+                logger.error(f"Error processing {self.hive_id}: {e}")
+                self.stop_event.wait(1.0)
+
+            if self.snapshots and time.monotonic() >= next_snapshot:
+                self.snapshots.save(self.hive_id, self.pipeline); next_snapshot = time.monotonic() + self.snapshots.interval
+
+            next_tick += self.frame_period()
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            else:
+                next_tick = time.monotonic() # Atrasado: no acumular deuda de frames
+        if self.snapshots and self.pipeline is not None:
+            self.snapshots.save(self.hive_id, self.pipeline) # Apagado ordenado: el reinicio arranca con el estado final
@@ -0,0 +1,106 @@
+"""
+Warm-restart snapshots
+Periodic per-stream state (background model, open tracks) and partial-interval counts on local disk
+"""
+
+import os
+import json
+import time
+import numpy as np
+from typing import Dict, Optional
+from .log import get_logger
+
+logger = get_logger(__name__)
+
+def _atomic_write(path: str, write):
+    """Escribir a un temporal y renombrar: un corte a mitad nunca deja un snapshot truncado"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f: write(f)
+    os.replace(tmp, path)
+
+class SnapshotStore:
+    """Un .npz por stream y un JSON con los conteos del intervalo sin publicar"""
+    def __init__(self, directory: str, interval: float = 30.0, background_max_age: float = 600.0,
+                 tracks_max_age: float = 10.0, counts_max_age: float = 86400.0):
+        self.directory = directory
+        self.interval = interval
+        self.background_max_age = background_max_age # El fondo cambia despacio (luz): minutos sirven
+        self.tracks_max_age = tracks_max_age # Tracks viejos emparejarían con otras abejas: sólo reinicios rápidos
+        self.counts_max_age = counts_max_age
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["SnapshotStore"]:
+        """Sección 'snapshot' del YAML; SNAPSHOT_DIR sobreescribe el directorio"""
+        if not config.get('enabled', True):
+            return None
+        directory = os.getenv('SNAPSHOT_DIR', config.get('dir', '/app/data/snapshots'))
+        try:
+            return cls(directory, float(config.get('interval_s', 30)), float(config.get('background_max_age_s', 600)),
+                       float(config.get('tracks_max_age_s', 10)), float(config.get('counts_max_age_s', 86400)))
+        except OSError as e:
+            logger.warning(f"Snapshots disabled, cannot use {directory}: {e}")
+            return None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name.replace('/', '_'))
+
+    def save_stream(self, hive_id: str, state: dict):
+        arrays = {k: v for k, v in state.items() if isinstance(v, np.ndarray)}
+        meta = {k: v for k, v in state.items() if not isinstance(v, np.ndarray)}
+        meta['saved_at'] = time.time()
+        _atomic_write(self._path(f"{hive_id}.npz"), lambda f: np.savez(f, meta=np.array(json.dumps(meta)), **arrays))
+
+    def load_stream(self, hive_id: str) -> Optional[dict]:
+        """Estado guardado sin las partes vencidas (fondo y tracks tienen edades máximas distintas)"""
+        try:
+            with np.load(self._path(f"{hive_id}.npz"), allow_pickle=False) as data:
+                state = json.loads(str(data['meta']))
+                state.update({k: data[k] for k in data.files if k != 'meta'})
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"{hive_id}: Ignoring unreadable snapshot: {e}")
+            return None
+        age = time.time() - state['saved_at']
+        if age > self.background_max_age: state.pop('background', None)
+        if age > self.tracks_max_age:
+            for key in [k for k in state if k.startswith('track_')]: del state[key]
+        state['age'] = age
+        return state
+
+    def save(self, hive_id: str, pipeline):
+        if not hasattr(pipeline, 'snapshot_state'): return
+        try:
+            self.save_stream(hive_id, pipeline.snapshot_state())
+        except Exception as e:
+            logger.warning(f"{hive_id}: Snapshot failed: {e}")
+
+    def restore(self, hive_id: str, pipeline) -> bool:
+        if not hasattr(pipeline, 'restore_state'): return False
+        state = self.load_stream(hive_id)
+        if state is None: return False
+        try:
+            return pipeline.restore_state(state)
+        except Exception as e:
+            logger.warning(f"{hive_id}: Snapshot restore failed: {e}")
+            return False
+
+    def save_counts(self, counts: Dict[str, dict]):
+        """Conteos acumulados desde la última publicación (sólo colmenas con actividad)"""
+        hives = {h: {'bees_in': m['bees_in'], 'bees_out': m['bees_out']}
+                 for h, m in counts.items() if m['bees_in'] or m['bees_out']}
+        body = json.dumps({'saved_at': time.time(), 'hives': hives}).encode()
+        _atomic_write(self._path("partial_counts.json"), lambda f: f.write(body))
+
+    def load_counts(self) -> Dict[str, dict]:
+        try:
+            with open(self._path("partial_counts.json")) as f: data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable partial counts: {e}")
+            return {}
+        if time.time() - data['saved_at'] > self.counts_max_age:
+            return {}
+        return data['hives']
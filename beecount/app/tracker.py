@@ -2,56 +2,234 @@
 Centroid Tracker: Tracks objects (bees) across frames
 """
 
-from collections import OrderedDict
-from scipy.spatial import distance as dist
+from collections.abc import Mapping
+from typing import Iterator, Tuple
+from scipy.optimize import linear_sum_assignment
 import numpy as np
 
+SOLVERS = ('hungarian', 'greedy')
+
+def pairwise_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Matriz completa de distancias euclidianas entre dos conjuntos de centroides"""
+    diff = a[:, None, :].astype(np.float64) - b[None, :, :]
+    return np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+
+def _greedy_assignment(D: np.ndarray, gate: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Greedy de mínima distancia por rondas de vecinos mutuos más cercanos"""
+    cost = np.where(gate, D, np.inf)
+    rows_out, cols_out = [], []
+    while True:
+        row_best = cost.argmin(axis=1)
+        col_best = cost.argmin(axis=0)
+        rows = np.arange(cost.shape[0])
+        feasible = np.isfinite(cost[rows, row_best])
+        # Un par mutuamente más cercano siempre lo tomaría el greedy global
+        mutual = feasible & (col_best[row_best] == rows)
+        if not mutual.any():
+            break
+        r = rows[mutual]; c = row_best[mutual]
+        rows_out.append(r); cols_out.append(c)
+        cost[r, :] = np.inf; cost[:, c] = np.inf
+    if not rows_out:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(rows_out), np.concatenate(cols_out)
+
+def assign(D: np.ndarray, max_distance: float, solver: str = 'hungarian') -> Tuple[np.ndarray, np.ndarray]:
+    """Emparejar filas (objetos) con columnas (detecciones) descartando pares > max_distance"""
+    empty = np.empty(0, dtype=np.intp)
+    gate = D <= max_distance
+    row_idx = np.flatnonzero(gate.any(axis=1))
+    col_idx = np.flatnonzero(gate.any(axis=0))
+    if row_idx.size == 0:
+        return empty, empty
+
+    sub_D = D[np.ix_(row_idx, col_idx)]
+    sub_gate = gate[np.ix_(row_idx, col_idx)]
+
+    # Fast path: cada objeto y cada detección tienen un único candidato
+    if (sub_gate.sum(axis=1) == 1).all() and (sub_gate.sum(axis=0) == 1).all():
+        rows, cols = np.nonzero(sub_gate)
+        return row_idx[rows], col_idx[cols]
+
+    if solver == 'greedy':
+        rows, cols = _greedy_assignment(sub_D, sub_gate)
+    elif solver == 'hungarian':
+        # Costo finito alto para pares fuera de rango; se filtran después
+        cost = np.where(sub_gate, sub_D, max_distance * 1e3 + 1.0)
+        rows, cols = linear_sum_assignment(cost)
+        keep = sub_gate[rows, cols]
+        rows, cols = rows[keep], cols[keep]
+    else:
+        raise ValueError(f"Unknown assignment solver: {solver}")
+    return row_idx[rows], col_idx[cols]
+
+def to_centroids(rects) -> np.ndarray:
+    """Convierte detecciones (x, y) o (startX, startY, endX, endY) a centroides enteros"""
+    arr = np.asarray(rects, dtype=np.float64)
+    if arr.size == 0:
+        return np.zeros((0, 2), dtype="int")
+    arr = arr.reshape(len(arr), -1)
+    if arr.shape[1] == 4:
+        arr = (arr[:, :2] + arr[:, 2:]) / 2.0
+    return arr[:, :2].astype("int")
+
+class TrackStore:
+    """Estado de tracks en arreglos preasignados (structure-of-arrays)"""
+    COLUMNS = ('ids', 'positions', 'prev_positions', 'disappeared', 'side')
+
+    def __init__(self, capacity: int = 256):
+        self.size = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.zeros((capacity, 2), dtype=np.int64)
+        self.prev_positions = np.zeros((capacity, 2), dtype=np.int64)
+        self.disappeared = np.zeros(capacity, dtype=np.int32)
+        self.side = np.zeros(capacity, dtype=np.int8) # Lado de la línea de conteo (0 = desconocido)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.ids)
+
+    def _grow(self, needed: int):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, ids: np.ndarray, centroids: np.ndarray):
+        """Agregar tracks nuevos al final; su posición previa es la actual"""
+        k = len(ids)
+        if self.size + k > self.capacity:
+            self._grow(self.size + k)
+        s = slice(self.size, self.size + k)
+        self.ids[s] = ids
+        self.positions[s] = centroids
+        self.prev_positions[s] = centroids
+        self.disappeared[s] = 0
+        self.side[s] = 0
+        self.size += k
+
+    def remove(self, mask: np.ndarray):
+        """Swap-remove: los tracks del final rellenan los huecos que deja mask"""
+        n = self.size
+        k = int(np.count_nonzero(mask))
+        if k == 0:
+            return
+        new_size = n - k
+        holes = np.flatnonzero(mask[:new_size])
+        fillers = new_size + np.flatnonzero(~mask[new_size:n])
+        for name in self.COLUMNS:
+            arr = getattr(self, name)
+            arr[holes] = arr[fillers]
+        self.size = new_size
+
+    def index_of(self, object_id: int) -> int:
+        idx = np.flatnonzero(self.ids[:self.size] == object_id)
+        if idx.size == 0:
+            raise KeyError(object_id)
+        return int(idx[0])
+
+class TrackView(Mapping):
+    """Vista objectID -> valor sobre una columna del TrackStore (sin copias por frame)"""
+    def __init__(self, store: TrackStore, column: str):
+        self._store = store
+        self._column = column
+
+    def __getitem__(self, object_id):
+        return getattr(self._store, self._column)[self._store.index_of(object_id)].copy()
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._store.ids[:self._store.size].tolist())
+
+    def __len__(self) -> int:
+        return self._store.size
+
+    def __contains__(self, object_id) -> bool:
+        return bool((self._store.ids[:self._store.size] == object_id).any())
+
+    def items(self):
+        n = self._store.size
+        return zip(self._store.ids[:n].tolist(), getattr(self._store, self._column)[:n].copy())
+
+    def values(self):
+        return getattr(self._store, self._column)[:self._store.size].copy()
+
 class CentroidTracker:
-    def __init__(self, max_disappeared=50, max_distance=50):
+    def __init__(self, max_disappeared=50, max_distance=50, solver='hungarian', capacity=256):
+        if solver not in SOLVERS:
+            raise ValueError(f"Unknown assignment solver: {solver}")
         self.next_object_id = 0
-        self.objects = OrderedDict() # Guarda objectID: centroid
-        self.disappeared = OrderedDict() # Cuenta frames que ha desaparecido
+        self.store = TrackStore(capacity)
+        self.objects = TrackView(self.store, 'positions') # objectID: centroid
+        self.disappeared = TrackView(self.store, 'disappeared') # Frames que ha desaparecido
         self.max_disappeared = max_disappeared
         self.max_distance = max_distance
+        self.solver = solver
 
     def register(self, centroid):
-        self.objects[self.next_object_id] = centroid
-        self.disappeared[self.next_object_id] = 0
-        self.next_object_id += 1
+        self._register_many(np.asarray(centroid).reshape(1, 2))
+
+    def _register_many(self, centroids: np.ndarray):
+        k = len(centroids)
+        self.store.add(np.arange(self.next_object_id, self.next_object_id + k), centroids)
+        self.next_object_id += k
 
     def deregister(self, object_id):
-        del self.objects[object_id]
-        del self.disappeared[object_id]
+        mask = np.zeros(self.store.size, dtype=bool)
+        mask[self.store.index_of(object_id)] = True
+        self.store.remove(mask)
+
+    def _age(self, unmatched: np.ndarray):
+        """Envejecer tracks sin detección y podar los que exceden max_disappeared"""
+        store = self.store; n = store.size
+        store.disappeared[:n][unmatched] += 1
+        store.remove(store.disappeared[:n] > self.max_disappeared)
 
     def update(self, rects):
-        """Actualiza el rastreador con nuevos rectángulos (detecciones)"""
-        
+        """Actualiza el rastreador con nuevos rectángulos o centroides (detecciones)"""
+        store = self.store; n = store.size
+        store.prev_positions[:n] = store.positions[:n]
+
         if len(rects) == 0:
             # Manejar objetos desaparecidos
-            for object_id in list(self.disappeared.keys()):
-                self.disappeared[object_id] += 1
-                if self.disappeared[object_id] > self.max_disappeared:
-                    self.deregister(object_id)
+            self._age(np.ones(n, dtype=bool))
             return self.objects
 
-        input_centroids = np.zeros((len(rects), 2), dtype="int")
-        for (i, (startX, startY, endX, endY)) in enumerate(rects):
-            cX = int((startX + endX) / 2.0)
-            cY = int((startY + endY) / 2.0)
-            input_centroids[i] = (cX, cY)
+        input_centroids = to_centroids(rects)
 
-        if len(self.objects) == 0:
-            for i in range(0, len(input_centroids)):
-                self.register(input_centroids[i])
+        if n == 0:
+            self._register_many(input_centroids)
 
         else:
             # Lógica de emparejamiento usando distancias (D)
-            object_ids = list(self.objects.keys())
-            object_centroids = list(self.objects.values())
-            
-            # D = dist.cdist(object_centroids, input_centroids)
-            # (Lógica de asignación de filas/columnas para emparejamiento)
-            
-            # (Lógica de manejo de objetos sin emparejar, registro, y desregistro)
-
-        return self.objects
\ No newline at end of file
+            D = pairwise_distances(store.positions[:n], input_centroids)
+            rows, cols = assign(D, self.max_distance, self.solver)
+            store.positions[rows] = input_centroids[cols]
+            store.disappeared[rows] = 0
+
+            # Objetos sin emparejar envejecen; detecciones sin emparejar se registran
+            unmatched_rows = np.ones(n, dtype=bool); unmatched_rows[rows] = False
+            unmatched_cols = np.ones(len(input_centroids), dtype=bool); unmatched_cols[cols] = False
+            self._age(unmatched_rows)
+            self._register_many(input_centroids[unmatched_cols])
+
+        return self.objects
+
+    def snapshot_state(self) -> dict:
+        """Tracks abiertos como arreglos (reinicio en caliente)"""
+        n = self.store.size
+        state = {f"track_{name}": getattr(self.store, name)[:n].copy() for name in TrackStore.COLUMNS}
+        state['next_object_id'] = int(self.next_object_id)
+        return state
+
+    def restore_state(self, state: dict):
+        ids = np.asarray(state['track_ids'])
+        self.store = TrackStore(max(self.store.capacity, len(ids)))
+        for name in TrackStore.COLUMNS:
+            getattr(self.store, name)[:len(ids)] = state[f"track_{name}"]
+        self.store.size = len(ids)
+        self.next_object_id = int(state['next_object_id'])
+        self.objects = TrackView(self.store, 'positions'); self.disappeared = TrackView(self.store, 'disappeared')
@@ -0,0 +1,155 @@
+"""
+Multi-process worker mode
+Shards streams across worker processes so CPU-bound OpenCV work is not limited by the GIL
+"""
+
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from typing import Dict, List, Optional
+from .log import get_logger
+from .scheduler import CpuGovernor, StreamWorker
+from .metrics import REGISTRY
+from .capture import capture_key
+from .snapshot import SnapshotStore
+
+logger = get_logger(__name__)
+
+def build_pipeline(stream_config: dict, capture: bool = True):
+    """Crear el pipeline correspondiente al algoritmo del stream"""
+    algo = stream_config.get('algo', 'opencv')
+    if algo == 'opencv':
+        from .pipeline_opencv import OpenCVPipeline
+        return OpenCVPipeline(stream_config, capture)
+    if algo == 'yolo':
+        from .pipeline_yolo import YOLOPipeline
+        return YOLOPipeline(stream_config, capture)
+    raise ValueError(f"Unknown algorithm: {algo}")
+
+def shard_streams(streams: List[dict], num_shards: int) -> List[List[dict]]:
+    """Repartir streams en shards sin separar los que comparten cámara (la decodificación es por proceso)"""
+    groups: Dict[tuple, List[dict]] = {}
+    for stream in streams: groups.setdefault(capture_key(stream), []).append(stream)
+    shards = [[] for _ in range(max(min(num_shards, len(groups)), 1))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return shards
+
+def _safe_build_pipeline(stream_config: dict):
+    try:
+        return build_pipeline(stream_config)
+    except Exception as e:
+        logger.error(f"Failed to create pipeline for {stream_config['hive_id']}: {e}")
+        return None
+
+def _shard_main(streams: List[dict], conn, stop_event, sched_config: dict, flush_interval: float,
+                snapshot_config: Optional[dict] = None):
+    """Proceso worker: corre los streams del shard y envía conteos agregados por el pipe"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # El manager coordina el apagado
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    results = queue.SimpleQueue(); local_stop = threading.Event()
+    governor = CpuGovernor(sched_config.get('cpu_high', 85.0), sched_config.get('cpu_low', 60.0))
+    snapshots = SnapshotStore.from_config(snapshot_config) if snapshot_config is not None else None
+    workers = [StreamWorker(s, _safe_build_pipeline, results, local_stop, governor, snapshots) for s in streams]
+    for worker in workers: worker.start()
+
+    last_sample = time.time()
+    try:
+        while not stop_event.is_set():
+            batch = []
+            deadline = time.time() + flush_interval
+            while time.time() < deadline:
+                try: batch.append(results.get(timeout=max(deadline - time.time(), 0.001)))
+                except queue.Empty: break
+            if batch:
+                conn.send(batch)
+            if time.time() - last_sample >= 1.0:
+                governor.sample(); last_sample = time.time()
+                conn.send({'metrics': REGISTRY.snapshot()}) # Las métricas viven en este proceso
+    except (BrokenPipeError, EOFError):
+        pass # El manager se fue; terminar
+    finally:
+        local_stop.set()
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.pipeline: worker.pipeline.cleanup()
+        conn.close()
+
+class ProcessWorkerPool:
+    """Supervisa procesos worker (uno por shard de streams) y reenvía sus conteos al manager"""
+    def __init__(self, streams: List[dict], results: queue.SimpleQueue, sched_config: Optional[dict] = None,
+                 num_shards: Optional[int] = None, flush_interval: float = 0.1, snapshot_config: Optional[dict] = None,
+                 stable_uptime: float = 600.0):
+        self.ctx = mp.get_context('spawn') # fork + hilos de OpenCV puede bloquearse
+        self.shards = shard_streams(streams, num_shards or os.cpu_count() or 1)
+        num_shards = len(self.shards)
+        self.results = results
+        self.sched_config = sched_config or {}
+        self.flush_interval = flush_interval
+        self.snapshot_config = snapshot_config # Cada shard guarda el estado de sus propios streams
+        self.stop_event = self.ctx.Event()
+        self.processes: Dict[int, mp.Process] = {}
+        self.conns: Dict[int, object] = {}
+        self.restarts = [0] * num_shards
+        self.stable_uptime = stable_uptime # Un shard que corrió esto sin caerse vuelve al backoff inicial
+        self._next_start = [0.0] * num_shards
+        self._started = [0.0] * num_shards
+        self._thread = None
+
+    def _spawn(self, shard_idx: int):
+        parent_conn, child_conn = self.ctx.Pipe(duplex=False)
+        proc = self.ctx.Process(
+            target=_shard_main, name=f"beecount-shard-{shard_idx}", daemon=True,
+            args=(self.shards[shard_idx], child_conn, self.stop_event, self.sched_config, self.flush_interval,
+                  self.snapshot_config)
+        )
+        proc.start(); child_conn.close()
+        self.processes[shard_idx] = proc; self.conns[shard_idx] = parent_conn
+        self._started[shard_idx] = time.time()
+        hives = [s['hive_id'] for s in self.shards[shard_idx]]
+        logger.info(f"Started worker process {proc.pid} for {hives}")
+
+    def start(self):
+        for idx in range(len(self.shards)): self._spawn(idx)
+        self._thread = threading.Thread(target=self._supervise, name="process-pool", daemon=True)
+        self._thread.start()
+
+    def _supervise(self):
+        while not self.stop_event.is_set():
+            ready = wait(list(self.conns.values()), timeout=0.5)
+            for idx, conn in list(self.conns.items()):
+                if conn not in ready: continue
+                try:
+                    message = conn.recv()
+                    if isinstance(message, dict): REGISTRY.merge(message['metrics']); continue
+                    for item in message: self.results.put(item)
+                except (EOFError, OSError):
+                    conn.close(); del self.conns[idx] # El proceso terminó; se reinicia abajo
+            self._restart_dead()
+
+    def _restart_dead(self):
+        now = time.time()
+        for idx, proc in self.processes.items():
+            if proc.is_alive() or self.stop_event.is_set() or now < self._next_start[idx]: continue
+            if idx in self.conns:
+                self.conns.pop(idx).close()
+            if now - self._started[idx] >= self.stable_uptime:
+                self.restarts[idx] = 0 # Caída aislada tras correr estable: no heredar el backoff de fallos viejos
+            self.restarts[idx] += 1
+            # Backoff exponencial para procesos que fallan repetidamente
+            self._next_start[idx] = now + min(2 ** self.restarts[idx], 60)
+            logger.error(f"Worker process for shard {idx} exited with {proc.exitcode}, restarting")
+            self._spawn(idx)
+
+    def stop(self, timeout: float = 10.0):
+        self.stop_event.set()
+        if self._thread: self._thread.join(timeout=2)
+        for proc in self.processes.values():
+            proc.join(timeout)
+            if proc.is_alive(): proc.terminate()
+        for conn in self.conns.values(): conn.close()
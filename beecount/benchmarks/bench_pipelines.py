@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark: counting pipelines over synthetic hive-entrance video (no camera needed)
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import platform
+import argparse
+import threading
+import numpy as np
+import cv2
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.metrics import quantile
+
+class SyntheticHive:
+    """Abejas (elipses oscuras) cruzando verticalmente una línea horizontal sobre fondo con ruido"""
+    def __init__(self, n_bees: int = 30, frames: int = 400, speed: float = 6.0, noise: float = 4.0,
+                 size=(320, 240), bee_axes=(4, 7), seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.width, self.height = size
+        self.frames = frames
+        self.line_y = self.height // 2
+        self.bee_axes = bee_axes
+        texture = rng.normal(170, 12, size=(self.height, self.width)).clip(0, 255).astype(np.uint8)
+        self.background = cv2.cvtColor(cv2.GaussianBlur(texture, (9, 9), 0), cv2.COLOR_GRAY2BGR)
+        self.noise_bank = [rng.normal(0, noise, size=self.background.shape).astype(np.int16) for _ in range(8)]
+
+        # Trayectorias: entrada escalonada, dirección aleatoria, recorrido completo de la imagen
+        span = self.height + 4 * bee_axes[1]
+        travel = int(np.ceil(span / speed))
+        first = 20 # Deja que MOG2 aprenda el fondo
+        self.start = rng.integers(first, max(frames - travel, first + 1), size=n_bees)
+        self.down = rng.random(n_bees) < 0.5 # y creciente
+        self.x = rng.uniform(2 * bee_axes[0], self.width - 2 * bee_axes[0], size=n_bees)
+        self.speed = speed
+        self.y0 = np.where(self.down, -2 * bee_axes[1], self.height + 2 * bee_axes[1]).astype(float)
+
+    def positions(self, i: int) -> np.ndarray:
+        t = i - self.start
+        y = self.y0 + np.where(self.down, 1, -1) * self.speed * t
+        visible = (t >= 0) & (y > -2 * self.bee_axes[1]) & (y < self.height + 2 * self.bee_axes[1])
+        return np.column_stack([self.x, y])[visible]
+
+    def ground_truth(self) -> dict:
+        """Cruces completos dentro del video; convención de LineCrossingCounter (y creciente = out)"""
+        t_cross = self.start + np.abs(self.y0 - self.line_y) / self.speed
+        crossed = t_cross < self.frames - 1
+        return {'in': int((crossed & ~self.down).sum()), 'out': int((crossed & self.down).sum())}
+
+    def render(self, i: int) -> np.ndarray:
+        frame = (self.background + self.noise_bank[i % len(self.noise_bank)]).clip(0, 255).astype(np.uint8)
+        for x, y in self.positions(i):
+            cv2.ellipse(frame, (int(x), int(y)), self.bee_axes, 0, 0, 360, (25, 25, 25), -1)
+        return frame
+
+class FakeVideoCapture:
+    """Sustituye cv2.VideoCapture; en lockstep entrega un frame por cada process_frame (sin descartes)"""
+    def __init__(self, hive: SyntheticHive, lockstep: bool = True):
+        self.hive = hive
+        self.index = 0
+        self.lockstep = lockstep
+        self.ready = threading.Semaphore(1)
+
+    def isOpened(self): return True
+    def set(self, prop, value): return True
+    def release(self): self.ready.release()
+
+    def read(self):
+        if self.lockstep: self.ready.acquire()
+        if self.index >= self.hive.frames:
+            return False, None
+        frame = self.hive.render(self.index); self.index += 1
+        return True, frame
+
+def bench_config(hive: SyntheticHive, algo: str, args) -> dict:
+    config = {
+        'hive_id': f"BENCH-{algo}-{args.detector}-{args.process_scale}-{args.motion_gate}", 'url': 'bench://synthetic', 'algo': algo,
+        'roi': [0, 0, hive.width, hive.height], 'line': {'axis': 'y', 'pos': hive.line_y},
+        'direction': {'up_is_out': True}, 'min_area': 30, 'max_area': 2000, 'max_dist': 40,
+        'detector': args.detector, 'process_scale': args.process_scale, 'read_timeout': 2.0,
+        'motion_gate': args.motion_gate
+    }
+    if algo == 'yolo':
+        config.update(model_path=args.yolo_model, inference_backend=args.yolo_backend)
+    return config
+
+def run(algo: str, args) -> dict:
+    """Procesar todo el video sintético con el pipeline real y medir etapas, FPS y exactitud"""
+    hive = SyntheticHive(args.bees, args.frames, args.speed, args.noise, tuple(args.size), seed=args.seed)
+    capture = FakeVideoCapture(hive)
+    name = f"{algo}-{args.detector}-x{args.process_scale}" + ('-gated' if args.motion_gate else '')
+    with patch.object(cv2, 'VideoCapture', lambda *a, **k: capture):
+        from app.workers import build_pipeline
+        try:
+            pipeline = build_pipeline(bench_config(hive, algo, args))
+        except ImportError as e:
+            return {'name': name, 'skipped': f"missing dependency: {e}"}
+        counts = {'in': 0, 'out': 0}
+        latencies = np.empty(hive.frames)
+        processed = 0
+        started = time.perf_counter()
+        try:
+            while processed < hive.frames:
+                t0 = time.perf_counter()
+                result = pipeline.process_frame()
+                if result is None:
+                    break
+                latencies[processed] = time.perf_counter() - t0; processed += 1
+                counts['in'] += result['in']; counts['out'] += result['out']
+                capture.ready.release()
+            elapsed = time.perf_counter() - started
+        finally:
+            capture.release(); pipeline.cleanup()
+
+    truth = hive.ground_truth()
+    error = abs(counts['in'] - truth['in']) + abs(counts['out'] - truth['out'])
+    stages = {}
+    for stage, hist in pipeline.metrics.stages.items():
+        hist_counts, total, sum_ns = hist.snapshot()
+        stages[stage] = {'mean_ms': sum_ns / max(total, 1) / 1e6, 'p50_ms': quantile(hist_counts, total, 0.5) * 1e3,
+                         'p99_ms': quantile(hist_counts, total, 0.99) * 1e3}
+    latencies = latencies[:processed]
+    return {
+        'name': name, 'frames': processed,
+        'fps': processed / elapsed if elapsed else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50) * 1e3) if processed else 0.0,
+        'p99_ms': float(np.percentile(latencies, 99) * 1e3) if processed else 0.0,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # Pico del proceso (Linux: KB)
+        'counted': counts, 'truth': truth,
+        'accuracy': 1.0 - error / max(truth['in'] + truth['out'], 1),
+        'dropped': pipeline.grabber.frames_dropped, 'idle_frames': pipeline.metrics.skipped, 'stages': stages
+    }
+
+def check_regressions(results: list, baseline: dict, threshold: float) -> list:
+    """Comparar contra un JSON previo: FPS, p99 y exactitud"""
+    previous = {r['name']: r for r in baseline.get('results', []) if 'skipped' not in r}
+    failures = []
+    for r in results:
+        base = previous.get(r['name'])
+        if base is None or 'skipped' in r:
+            continue
+        if r['fps'] < base['fps'] * (1 - threshold):
+            failures.append(f"{r['name']}: fps {r['fps']:.1f} < baseline {base['fps']:.1f}")
+        if r['p99_ms'] > base['p99_ms'] * (1 + threshold):
+            failures.append(f"{r['name']}: p99 {r['p99_ms']:.2f} ms > baseline {base['p99_ms']:.2f} ms")
+        if r['accuracy'] < base['accuracy'] - threshold:
+            failures.append(f"{r['name']}: accuracy {r['accuracy']:.3f} < baseline {base['accuracy']:.3f}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--algo', choices=['opencv', 'yolo'], nargs='+', default=['opencv'])
+    parser.add_argument('--bees', type=int, default=30)
+    parser.add_argument('--frames', type=int, default=400)
+    parser.add_argument('--speed', type=float, default=6.0, help="Píxeles por frame")
+    parser.add_argument('--noise', type=float, default=4.0, help="Desviación del ruido del sensor")
+    parser.add_argument('--size', type=int, nargs=2, default=[320, 240], metavar=('W', 'H'))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--detector', choices=['contours', 'components'], default='components')
+    parser.add_argument('--process-scale', type=float, default=1.0)
+    parser.add_argument('--motion-gate', action='store_true', help="Saltar frames sin movimiento")
+    parser.add_argument('--yolo-model', default='yolov8n.pt')
+    parser.add_argument('--yolo-backend', default='ultralytics')
+    parser.add_argument('--output', help="Guardar resultados en JSON")
+    parser.add_argument('--baseline', help="JSON previo; sale con código 1 si hay regresión")
+    parser.add_argument('--threshold', type=float, default=0.15, help="Regresión tolerada (fracción)")
+    args = parser.parse_args()
+
+    results = [run(algo, args) for algo in args.algo]
+
+    print(f"{'run':<28} {'fps':>8} {'p50 ms':>8} {'p99 ms':>8} {'rss MB':>8} {'acc':>6}  in/out (truth)")
+    for r in results:
+        if 'skipped' in r:
+            print(f"{r['name']:<28} skipped: {r['skipped']}"); continue
+        print(f"{r['name']:<28} {r['fps']:>8.1f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['peak_rss_mb']:>8.0f} "
+              f"{r['accuracy']:>6.3f}  {r['counted']['in']}/{r['counted']['out']} "
+              f"({r['truth']['in']}/{r['truth']['out']})")
+        for stage, s in r['stages'].items():
+            print(f"  {stage:<26} {'':>8} {s['p50_ms']:>8.3f} {s['p99_ms']:>8.3f}")
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args), 'results': results,
+        'env': {'python': platform.python_version(), 'opencv': cv2.__version__, 'numpy': np.__version__,
+                'cpus': os.cpu_count(), 'machine': platform.machine()}
+    }
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f: failures = check_regressions(results, json.load(f), args.threshold)
+        for failure in failures: print(f"REGRESSION {failure}")
+        sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
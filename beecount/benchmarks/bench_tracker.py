@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: CentroidTracker assignment with N objects vs M detections
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.tracker import CentroidTracker, SOLVERS
+
+def run(n_objects: int, n_detections: int, solver: str, frames: int, seed: int = 0) -> dict:
+    """Simula N abejas moviéndose con M detecciones por frame y mide update()"""
+    rng = np.random.default_rng(seed)
+    tracker = CentroidTracker(max_disappeared=20, max_distance=40, solver=solver)
+    positions = rng.uniform(0, 640, size=(n_objects, 2))
+    tracker.update(positions[:n_detections])
+
+    timings = np.empty(frames)
+    for i in range(frames):
+        positions += rng.normal(0, 6, size=positions.shape)
+        detections = positions[rng.permutation(n_objects)[:n_detections]]
+        start = time.perf_counter()
+        tracker.update(detections)
+        timings[i] = time.perf_counter() - start
+
+    return {
+        'solver': solver, 'objects': n_objects, 'detections': n_detections,
+        'mean_ms': timings.mean() * 1e3, 'p99_ms': np.percentile(timings, 99) * 1e3,
+        'updates_per_s': frames / timings.sum()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, nargs='+', default=[10, 50, 100, 150])
+    parser.add_argument('--detections', type=int, default=None, help="Default: igual a objects")
+    parser.add_argument('--solver', choices=SOLVERS, nargs='+', default=list(SOLVERS))
+    parser.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args()
+
+    print(f"{'solver':<10} {'N':>5} {'M':>5} {'mean ms':>9} {'p99 ms':>9} {'upd/s':>9}")
+    for solver in args.solver:
+        for n in args.objects:
+            m = min(args.detections or n, n)
+            r = run(n, m, solver, args.frames)
+            print(f"{r['solver']:<10} {r['objects']:>5} {r['detections']:>5} "
+                  f"{r['mean_ms']:>9.3f} {r['p99_ms']:>9.3f} {r['updates_per_s']:>9.0f}")
+
+if __name__ == "__main__":
+    main()
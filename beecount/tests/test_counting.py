@@ -8,13 +8,30 @@ import numpy as np
 import cv2
 import os
 import sys
+import json
+import time
+import queue
+import shutil
+import tempfile
+import threading
 from unittest.mock import Mock, patch
 
 # Añadir el directorio padre al path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from app.pipeline_opencv import OpenCVPipeline
-from app.tracker import CentroidTracker
+from app.crossing import LineCrossingCounter
+from app.capture import CAPTURES, FrameGrabber, build_capture_source
+from app.workers import ProcessWorkerPool, shard_streams
+from app.scheduler import CpuGovernor, StreamWorker
+from app.publisher import MetricsPublisher
+from app.outbox import CountOutbox
+from app.motion import MotionGate
+from app.snapshot import SnapshotStore
+from app.replay import expand_variants, replay_clip
+from app.metrics import LatencyHistogram, MetricsRegistry, bucket_index, bucket_upper, quantile
+from app.inference import ExportedBackend, UltralyticsBackend, YOLOInferenceService, boxes_to_centroids, decode_yolov8
+from app.tracker import CentroidTracker, TrackStore, assign, pairwise_distances
 
 class TestCentroidTracker(unittest.TestCase):
     """Test centroid tracker functionality"""
@@ -48,6 +65,257 @@ class TestCentroidTracker(unittest.TestCase):
         
         self.assertEqual(len(objects), 0)
 
+    def test_objects_follow_detections(self):
+        """Test IDs stay attached to the nearest detection"""
+        self.tracker.update([(100, 100), (200, 200)])
+        objects = self.tracker.update([(195, 195), (105, 105)])
+        self.assertEqual(tuple(objects[0]), (105, 105))
+        self.assertEqual(tuple(objects[1]), (195, 195))
+
+    def test_max_distance_gates_assignment(self):
+        """Test detections beyond max_distance register new objects"""
+        self.tracker.update([(100, 100)])
+        objects = self.tracker.update([(300, 300)])
+        self.assertEqual(len(objects), 2)
+        self.assertEqual(self.tracker.disappeared[0], 1)
+        self.assertEqual(tuple(objects[1]), (300, 300))
+
+    def test_greedy_matches_hungarian(self):
+        """Test both solvers agree on well separated detections"""
+        rng = np.random.default_rng(1)
+        objs = np.stack(np.meshgrid(np.arange(10), np.arange(10)), -1).reshape(-1, 2) * 60.0
+        dets = rng.permutation(objs + rng.normal(0, 5, objs.shape))
+        D = pairwise_distances(objs, dets)
+        h_rows, h_cols = assign(D, 50, 'hungarian')
+        g_rows, g_cols = assign(D, 50, 'greedy')
+        self.assertEqual(dict(zip(h_rows, h_cols)), dict(zip(g_rows, g_cols)))
+        self.assertEqual(len(h_rows), 100)
+
+    def test_assign_rejects_out_of_range_pairs(self):
+        """Test the solver never returns pairs beyond max_distance"""
+        D = np.array([[10.0, 80.0], [15.0, 90.0]])
+        for solver in ('hungarian', 'greedy'):
+            rows, cols = assign(D, 50, solver)
+            self.assertEqual(len(rows), 1)
+            self.assertTrue((D[rows, cols] <= 50).all())
+
+class TestTrackStore(unittest.TestCase):
+    """Test array-backed tracker state"""
+
+    def test_swap_remove_keeps_survivors(self):
+        """Test removed slots are filled from the tail"""
+        store = TrackStore(capacity=2)
+        store.add(np.arange(5), np.arange(10).reshape(5, 2))
+        self.assertEqual(store.size, 5)
+        store.remove(np.array([True, False, True, False, False]))
+        self.assertEqual(store.size, 3)
+        self.assertEqual(sorted(store.ids[:3].tolist()), [1, 3, 4])
+        for i in range(3):
+            self.assertEqual(store.positions[i, 0], store.ids[i] * 2)
+
+    def test_tracker_view_contract(self):
+        """Test update() still returns an id -> centroid mapping"""
+        tracker = CentroidTracker(max_disappeared=5, max_distance=50, capacity=1)
+        objects = tracker.update([(10, 10), (100, 100), (200, 200)])
+        self.assertEqual(list(objects), [0, 1, 2])
+        tracker.deregister(0)
+        self.assertNotIn(0, objects)
+        self.assertEqual({k: tuple(v) for k, v in objects.items()}, {1: (100, 100), 2: (200, 200)})
+
+class TestLineCrossingCounter(unittest.TestCase):
+    """Test the shared crossing engine"""
+
+    def test_vectorized_axis_line(self):
+        """Test in/out masks for several tracks at once"""
+        counter = LineCrossingCounter({'axis': 'y', 'pos': 100}, {'up_is_out': True})
+        prev = np.array([[10, 95], [20, 105], [30, 90], [40, 99]])
+        curr = np.array([[10, 105], [20, 95], [30, 95], [40, 101]])
+        crossed_in, crossed_out = counter.evaluate(prev, curr)
+        self.assertEqual(crossed_out.tolist(), [True, False, False, False])
+        self.assertEqual(crossed_in.tolist(), [False, True, False, False])
+
+    def test_hysteresis_state(self):
+        """Test a track lingering in the band counts once it leaves it"""
+        counter = LineCrossingCounter({'axis': 'x', 'pos': 50, 'hysteresis': 3}, {'up_is_out': False})
+        state = np.zeros(1, dtype=np.int8)
+        path = [40, 49, 51, 52, 49, 51, 60, 61]
+        counts = {'in': 0, 'out': 0}
+        for prev_x, curr_x in zip(path, path[1:]):
+            crossed_in, crossed_out = counter.evaluate(np.array([[prev_x, 0]]), np.array([[curr_x, 0]]), state)
+            counts['in'] += int(crossed_in.sum()); counts['out'] += int(crossed_out.sum())
+        self.assertEqual(counts, {'in': 1, 'out': 0})
+
+    def test_polyline_signed_distance(self):
+        """Test crossings of an angled polyline"""
+        counter = LineCrossingCounter({'points': [[0, 0], [100, 100], [200, 100]]}, {'up_is_out': True})
+        d = counter.signed_distance(np.array([[50, 40], [50, 60], [150, 90], [150, 110]]))
+        self.assertTrue(d[0] < 0 < d[1])
+        self.assertAlmostEqual(d[2], -10.0)
+        self.assertAlmostEqual(d[3], 10.0)
+        self.assertEqual(counter.check((150, 90), (150, 110)), 'out')
+        self.assertEqual(counter.check((60, 70), (70, 50)), 'in')
+
+class TestFrameGrabber(unittest.TestCase):
+    """Test threaded capture"""
+
+    @patch('cv2.VideoCapture')
+    def test_latest_frame_wins(self, mock_capture):
+        """Test unread frames are dropped and the newest one is returned"""
+        frames = [np.full((4, 4), i, dtype=np.uint8) for i in range(5)]
+        mock_cap = Mock()
+        mock_cap.isOpened.return_value = True
+        mock_cap.read.side_effect = [(True, f) for f in frames] + [(False, None)] * 100
+        mock_capture.return_value = mock_cap
+
+        grabber = FrameGrabber('test://mock', 'TEST', backoff_initial=5.0)
+        grabber.start()
+        try:
+            for _ in range(100):
+                if grabber.frames_grabbed == 5: break
+                threading.Event().wait(0.01)
+            frame = grabber.read(timeout=1.0)
+            self.assertEqual(frame[0, 0], 4)
+            self.assertEqual(grabber.frames_dropped, 4)
+            self.assertIsNone(grabber.read(timeout=0.05))
+        finally:
+            grabber.stop()
+
+    @patch('cv2.VideoCapture')
+    def test_stop_defers_release_while_read_blocked(self, mock_capture):
+        """Test stop() never releases the capture under a blocked read"""
+        reading, unblock = threading.Event(), threading.Event()
+        mock_cap = Mock()
+        mock_cap.isOpened.return_value = True
+        mock_cap.read.side_effect = lambda: (reading.set(), unblock.wait(5.0), (True, np.zeros((4, 4), np.uint8)))[2]
+        mock_capture.return_value = mock_cap
+
+        grabber = FrameGrabber('test://mock', 'TEST')
+        grabber.start()
+        self.assertTrue(reading.wait(2.0))
+        grabber.stop(timeout=0.05)
+        mock_cap.release.assert_not_called()
+        unblock.set()
+        grabber._thread.join(2.0)
+        self.assertFalse(grabber._thread.is_alive())
+        mock_cap.release.assert_called_once()
+
+    @patch('cv2.VideoCapture')
+    def test_shared_capture_decodes_once(self, mock_capture):
+        """Test hives on one camera share a decoder and get zero-copy ROI views"""
+        mock_capture.return_value.isOpened.return_value = True
+        mock_capture.return_value.read.side_effect = lambda: (True, np.zeros((120, 200), dtype=np.uint8))
+        base = {'url': 'test://wide', 'line': {'axis': 'y', 'pos': 50}, 'direction': {'up_is_out': True}}
+        left = OpenCVPipeline(dict(base, hive_id='LEFT', roi=[0, 0, 100, 120]))
+        right = OpenCVPipeline(dict(base, hive_id='RIGHT', roi=[100, 0, 100, 120]))
+        try:
+            self.assertEqual(mock_capture.call_count, 1)
+            self.assertIs(left.grabber.grabber, right.grabber.grabber)
+            frame_l = left.grabber.read(timeout=2.0); frame_r = right.grabber.read(timeout=2.0)
+            self.assertIs(frame_l, frame_r)
+            self.assertFalse(frame_l.flags.writeable)
+            self.assertTrue(np.shares_memory(left._extract_roi(frame_l), frame_l))
+            left.cleanup()
+            self.assertEqual(len(CAPTURES), 1) # RIGHT todavía la usa
+        finally:
+            left.cleanup(); right.cleanup()
+        self.assertEqual(len(CAPTURES), 0)
+
+    def test_shards_keep_cameras_together(self):
+        """Test process shards never split streams of the same camera"""
+        streams = [{'hive_id': f"H{i}", 'url': f"rtsp://cam{i // 3}"} for i in range(9)]
+        shards = shard_streams(streams, 2)
+        self.assertEqual(len(shards), 2)
+        for shard in shards:
+            cams = {s['url'] for s in shard}
+            for other in shards:
+                if other is not shard: self.assertFalse(cams & {s['url'] for s in other})
+        self.assertEqual(len(shard_streams(streams, 8)), 3)
+
+class TestStreamWorker(unittest.TestCase):
+    """Test persistent per-stream workers"""
+
+    def test_frozen_stream_does_not_stall_others(self):
+        """Test a blocked pipeline does not slow down a fast one"""
+        class FakePipeline:
+            def __init__(self, delay): self.delay = delay
+            def process_frame(self):
+                time.sleep(self.delay)
+                return {'in': 1, 'out': 0, 'fps': 0.0}
+
+        results = queue.SimpleQueue(); stop = threading.Event()
+        governor = CpuGovernor.__new__(CpuGovernor); governor.scale = 1.0
+        pipelines = {'FAST': FakePipeline(0.0), 'FROZEN': FakePipeline(5.0)}
+        workers = [StreamWorker({'hive_id': h, 'target_fps': 50}, lambda c: pipelines[c['hive_id']],
+                                results, stop, governor) for h in pipelines]
+        for w in workers: w.start()
+        time.sleep(0.5); stop.set()
+
+        counts = {'FAST': 0, 'FROZEN': 0}
+        while not results.empty():
+            hive_id, _ = results.get_nowait(); counts[hive_id] += 1
+        self.assertGreater(counts['FAST'], 10)
+        self.assertLessEqual(counts['FAST'], 30)
+        self.assertEqual(counts['FROZEN'], 0)
+
+class TestProcessWorkerPool(unittest.TestCase):
+    """Test multi-process mode supervision"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clip = os.path.join(self.tmpdir, 'entrance.avi')
+        writer = cv2.VideoWriter(self.clip, cv2.VideoWriter_fourcc(*'MJPG'), 10, (100, 100))
+        for i in range(60):
+            frame = np.full((100, 100, 3), 170, dtype=np.uint8)
+            if i >= 20: cv2.circle(frame, (50, 5 + 3 * (i - 20)), 5, (20, 20, 20), -1)
+            writer.write(frame)
+        writer.release()
+        self.stream = {'hive_id': 'P001', 'url': self.clip, 'roi': [0, 0, 100, 100], 'line': {'axis': 'y', 'pos': 50},
+                       'direction': {'up_is_out': True}, 'min_area': 20, 'max_area': 2000, 'target_fps': 100}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _wait_for_counts(self, results, timeout=30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try: return results.get(timeout=0.1)
+            except queue.Empty: pass
+        self.fail("No counts forwarded from the worker process")
+
+    def test_killed_shard_restarts_and_counts_keep_flowing(self):
+        """Test a crashed shard is respawned and its counts reach the manager again"""
+        results = queue.SimpleQueue()
+        pool = ProcessWorkerPool([self.stream], results, num_shards=1, flush_interval=0.05)
+        pool.start()
+        try:
+            hive_id, counts = self._wait_for_counts(results)
+            self.assertEqual(hive_id, 'P001')
+            self.assertIn('in', counts)
+            first = pool.processes[0]
+            first.kill(); first.join(5)
+            deadline = time.time() + 10
+            while pool.processes[0] is first and time.time() < deadline: time.sleep(0.05)
+            self.assertIsNot(pool.processes[0], first)
+            self.assertEqual(pool.restarts[0], 1)
+            while not results.empty(): results.get_nowait()
+            self.assertEqual(self._wait_for_counts(results)[0], 'P001')
+        finally:
+            pool.stop(timeout=5)
+
+    def test_backoff_resets_after_stable_uptime(self):
+        """Test an isolated crash after a healthy run does not inherit old backoff"""
+        pool = ProcessWorkerPool([self.stream], queue.SimpleQueue(), num_shards=1, stable_uptime=60.0)
+        dead = Mock(); dead.is_alive.return_value = False
+        pool.processes[0] = dead
+        with patch.object(pool, '_spawn'):
+            pool.restarts[0] = 6; pool._started[0] = time.time() - 10
+            pool._restart_dead()
+            self.assertEqual(pool.restarts[0], 7) # Fallos seguidos: el backoff sigue creciendo
+            pool.restarts[0] = 6; pool._started[0] = time.time() - 120; pool._next_start[0] = 0.0
+            pool._restart_dead()
+            self.assertEqual(pool.restarts[0], 1)
+            self.assertLessEqual(pool._next_start[0] - time.time(), 2.0)
+
 class TestOpenCVPipeline(unittest.TestCase):
     """Test OpenCV pipeline functionality"""
     
@@ -70,26 +338,401 @@ class TestOpenCVPipeline(unittest.TestCase):
         mock_cap.read.return_value = (True, np.zeros((480, 640, 3), dtype=np.uint8))
         mock_capture.return_value = mock_cap
         pipeline = OpenCVPipeline(self.config)
-        self.assertIsNotNone(pipeline.cap)
+        try:
+            self.assertIsNotNone(pipeline.grabber.read(timeout=2.0))
+            self.assertIsNotNone(pipeline.grabber.cap)
+        finally:
+            pipeline.cleanup()
+
+    @patch('cv2.VideoCapture')
+    def test_process_scale_rescales_parameters(self, mock_capture):
+        """Test line, areas and distances follow process_scale"""
+        mock_capture.return_value.read.return_value = (False, None)
+        config = dict(self.config, process_scale=0.5)
+        pipeline = OpenCVPipeline(config)
+        try:
+            self.assertEqual(pipeline.line_config['pos'], 50)
+            self.assertEqual((pipeline.min_area, pipeline.max_area, pipeline.max_dist), (12.5, 500, 20))
+            out = pipeline._preprocess_frame(np.zeros((100, 100, 3), dtype=np.uint8))
+            self.assertEqual(out.shape, (50, 50))
+        finally:
+            pipeline.cleanup()
+
+    def test_gstreamer_source_crops_on_decode(self):
+        """Test GStreamer capture crops, scales and converts to gray when configured"""
+        config = dict(self.config, roi=[100, 50, 400, 200], frame_size=[1920, 1080], process_scale=0.5,
+                      grayscale_decode=True, capture_backend='gstreamer', url='rtsp://cam/stream1')
+        source, api, decode_crops = build_capture_source(config)
+        self.assertTrue(decode_crops)
+        self.assertEqual(api, cv2.CAP_GSTREAMER)
+        self.assertIn("videocrop left=100 top=50 right=1420 bottom=830", source)
+        self.assertIn("width=200,height=100", source)
+        self.assertIn("format=GRAY8", source)
+        self.assertEqual(build_capture_source(self.config), ('test://mock', cv2.CAP_ANY, False))
 
     def test_check_line_crossing(self):
         """Test line crossing detection"""
         pipeline = OpenCVPipeline.__new__(OpenCVPipeline)
         pipeline.line_config = self.config['line']
         pipeline.direction_config = self.config['direction']
+        pipeline.crossing = LineCrossingCounter(pipeline.line_config, pipeline.direction_config)
 
         # Test crossing from below to above (out)
         direction = pipeline._check_line_crossing(1, (100, 95), (100, 105))
-        # self.assertEqual(direction, 'out')
+        self.assertEqual(direction, 'out')
         
         # Test crossing from above to below (in)
         direction = pipeline._check_line_crossing(1, (100, 105), (100, 95))
-        # self.assertEqual(direction, 'in')
+        self.assertEqual(direction, 'in')
 
         # Test no crossing
         direction = pipeline._check_line_crossing(1, (100, 90), (100, 95))
         self.assertIsNone(direction)
 
+class TestDetectionBackends(unittest.TestCase):
+    """Regression test shared by the contour and connected-components backends"""
+
+    def _pipeline(self, detector):
+        pipeline = OpenCVPipeline.__new__(OpenCVPipeline)
+        pipeline.min_area, pipeline.max_area, pipeline.detector = 50, 2000, detector
+        return pipeline
+
+    def test_backends_agree(self):
+        """Test both backends find the same bees and reject noise and oversized blobs"""
+        rng = np.random.default_rng(7)
+        mask = np.zeros((240, 320), dtype=np.uint8)
+        expected = []
+        for i in range(12):
+            cx, cy = 30 + (i % 6) * 50, 50 + (i // 6) * 100
+            axes = (int(rng.integers(6, 14)), int(rng.integers(4, 9)))
+            cv2.ellipse(mask, (cx, cy), axes, float(rng.integers(0, 180)), 0, 360, 255, -1)
+            expected.append((cx, cy))
+        for _ in range(200): # Ruido: píxeles sueltos
+            mask[rng.integers(0, 240), rng.integers(0, 320)] = 255
+        cv2.rectangle(mask, (0, 200), (80, 239), 255, -1) # Demasiado grande
+
+        for detector in ('contours', 'components'):
+            centroids = self._pipeline(detector)._find_centroids(mask)
+            self.assertEqual(len(centroids), len(expected))
+            D = pairwise_distances(np.array(expected), centroids)
+            self.assertTrue((D.min(axis=1) <= 2).all())
+
+class TestYOLOInference(unittest.TestCase):
+    """Test shared batched YOLO inference"""
+
+    def test_boxes_to_centroids(self):
+        """Test confidence and area filtering over whole box arrays"""
+        xyxy = np.array([[0, 0, 20, 20], [10, 10, 30, 30], [0, 0, 5, 5], [0, 0, 100, 100]])
+        conf = np.array([0.9, 0.3, 0.9, 0.9])
+        centroids = boxes_to_centroids(xyxy, conf, 0.5, 100, 5000)
+        self.assertEqual(centroids.tolist(), [[10, 10]])
+
+    def test_frames_are_batched(self):
+        """Test concurrent requests share one model call"""
+        class Tensor:
+            def __init__(self, a): self.a = a
+            def cpu(self): return self
+            def numpy(self): return self.a
+        class Boxes:
+            def __init__(self, n):
+                self.xyxy = Tensor(np.tile([0.0, 0.0, 20.0, 20.0], (n, 1))); self.conf = Tensor(np.full(n, 0.9))
+            def __len__(self): return len(self.conf.a)
+        calls = []
+        def model(frames, verbose=False, conf=0.25):
+            calls.append((len(frames), conf))
+            return [Mock(boxes=Boxes(int(f[0, 0]))) for f in frames]
+
+        service = YOLOInferenceService('fake.pt', max_batch=4, max_latency=0.2, model=UltralyticsBackend(model))
+        try:
+            futures = [service.submit(np.full((2, 2), i, dtype=np.uint8), 0.5 - i / 10, 100, 5000) for i in range(4)]
+            self.assertEqual([len(f.result(2)) for f in futures], [0, 1, 2, 3])
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(calls[0][0], 4)
+            self.assertAlmostEqual(calls[0][1], 0.2) # El menor conf del lote, no el 0.25 por defecto
+        finally:
+            service.stop()
+
+    def test_shared_service_warns_on_ignored_batching(self):
+        """Test later streams asking for other batch settings get the first service and a warning"""
+        backend = UltralyticsBackend(lambda frames, **kwargs: [])
+        first = YOLOInferenceService.shared('warn.pt', max_batch=4, max_latency=0.02, model=backend)
+        try:
+            with self.assertLogs('app.inference', level='WARNING') as logs:
+                second = YOLOInferenceService.shared('warn.pt', max_batch=16, max_latency=0.02, model=backend)
+            self.assertIs(second, first)
+            self.assertEqual(first.max_batch, 4)
+            self.assertIn("'max_batch': 16", logs.output[0])
+        finally:
+            first.stop()
+            YOLOInferenceService._shared.pop(('warn.pt', 'ultralytics', 640), None)
+
+    def test_decode_exported_output(self):
+        """Test raw YOLOv8 output is decoded, de-duplicated and mapped back through the letterbox"""
+        anchors = np.zeros((1, 5, 4), dtype=np.float32) # 1 clase, 4 anchors
+        anchors[0, :, 0] = [100, 100, 20, 20, 0.9] # cx, cy, w, h, score
+        anchors[0, :, 1] = [101, 100, 20, 20, 0.8] # Duplicado (NMS)
+        anchors[0, :, 2] = [300, 300, 30, 30, 0.7]
+        anchors[0, :, 3] = [500, 500, 30, 30, 0.1] # Bajo el umbral
+        results = decode_yolov8(anchors, np.array([0.5]), np.array([[0.0, 80.0]]), 0.25, 0.45)
+        xyxy, conf = results[0]
+        self.assertEqual(len(conf), 2)
+        np.testing.assert_allclose(xyxy[0], [180, 20, 220, 60])
+
+    def test_exported_backend_honours_low_conf(self):
+        """Test streams configured below the default 0.25 floor still see their low-confidence boxes"""
+        anchors = np.zeros((1, 5, 4), dtype=np.float32)
+        anchors[0, :, 0] = [10, 10, 4, 4, 0.9]
+        anchors[0, :, 1] = [11, 10, 4, 4, 0.8]
+        anchors[0, :, 2] = [40, 40, 6, 6, 0.7]
+        anchors[0, :, 3] = [50, 50, 6, 6, 0.1]
+        backend = ExportedBackend(lambda x: np.repeat(anchors, len(x), axis=0), imgsz=64)
+        service = YOLOInferenceService('fake.onnx', max_batch=2, max_latency=0.2, model=backend)
+        try:
+            frame = np.zeros((64, 64, 3), dtype=np.uint8)
+            low, high = service.submit(frame, 0.05, 1, 5000), service.submit(frame, 0.5, 1, 5000)
+            self.assertEqual(len(low.result(2)), 3)
+            self.assertEqual(len(high.result(2)), 2)
+        finally:
+            service.stop()
+
+class TestMetricsPublisher(unittest.TestCase):
+    """Test per-hive and apiary-level publishing"""
+
+    def setUp(self):
+        self.streams = [{'hive_id': 'H001', 'apiary_id': 'A01'}, {'hive_id': 'H002', 'apiary_id': 'A01'}]
+        self.snapshot = {h: {'bees_in': 3, 'bees_out': 1, 'fps': 9.96, 'algo': 'opencv'} for h in ('H001', 'H002')}
+
+    def test_per_hive_json_default(self):
+        """Test the default keeps one JSON message per hive"""
+        client = Mock()
+        MetricsPublisher(client, self.streams, lambda: self.snapshot, 60).publish()
+        topics = [c.args[0] for c in client.publish.call_args_list]
+        self.assertEqual(topics, ['hives/H001/beecount', 'hives/H002/beecount'])
+        payload = json.loads(client.publish.call_args_list[0].args[1])
+        self.assertEqual((payload['bees_in_1m'], payload['bees_net_1m'], payload['fps']), (3, 2, 10.0))
+
+    def test_apiary_batch(self):
+        """Test all hives of an apiary go out in a single message"""
+        client = Mock()
+        config = {'per_hive': False, 'apiary_batch': True}
+        MetricsPublisher(client, self.streams, lambda: self.snapshot, 60, config).publish()
+        self.assertEqual(client.publish.call_count, 1)
+        topic, body = client.publish.call_args.args
+        self.assertEqual(topic, 'apiaries/A01/beecount')
+        self.assertEqual(sorted(json.loads(body)['hives']), ['H001', 'H002'])
+
+    def test_outbox_replays_in_order_after_reconnect(self):
+        """Test intervals published offline are kept on disk and replayed in order"""
+        import tempfile
+        client = Mock(); client.is_connected.return_value = False
+        client.publish.return_value = Mock(is_published=Mock(return_value=True))
+        snapshots = iter([{'H001': dict(self.snapshot['H001'], bees_in=i)} for i in range(3)])
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = CountOutbox(os.path.join(tmp, 'outbox.db'))
+            publisher = MetricsPublisher(client, self.streams, lambda: next(snapshots), 60, outbox=outbox)
+            publisher.publish(); publisher.publish()
+            self.assertEqual(len(outbox), 2); client.publish.assert_not_called()
+            client.is_connected.return_value = True
+            publisher.publish()
+            sent = [json.loads(c.args[1])['bees_in_1m'] for c in client.publish.call_args_list]
+            self.assertEqual(sent, [0, 1, 2])
+            self.assertEqual(len(outbox), 0)
+            outbox.close()
+
+    def test_unacked_rows_are_not_republished(self):
+        """Test rows still in flight in paho are waited on, not published again, unless paho dropped them"""
+        import tempfile
+        import paho.mqtt.client as mqtt
+        client = Mock(); client.is_connected.return_value = True
+        pending = [Mock(rc=mqtt.MQTT_ERR_SUCCESS, is_published=Mock(return_value=False)) for _ in range(2)]
+        client.publish.side_effect = pending + [Mock(rc=mqtt.MQTT_ERR_SUCCESS, is_published=Mock(return_value=True))]
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = CountOutbox(os.path.join(tmp, 'outbox.db'))
+            outbox.append([('t', b'0'), ('t', b'1')])
+            publisher = MetricsPublisher(client, self.streams, dict, 60, {'ack_timeout': 30}, outbox=outbox)
+            self.assertLessEqual(publisher.ack_timeout, publisher.retry_interval)
+            publisher.ack_timeout = 0.05
+            publisher._forward(); publisher._forward()
+            self.assertEqual(client.publish.call_count, 2)
+            pending[0].is_published.return_value = True
+            pending[1].rc = mqtt.MQTT_ERR_QUEUE_SIZE # paho no lo encoló: hay que reenviarlo
+            publisher._forward()
+            self.assertEqual([c.args[1] for c in client.publish.call_args_list], [b'0', b'1', b'1'])
+            self.assertEqual((len(outbox), publisher._inflight), (0, {}))
+            outbox.close()
+
+    def test_stop_leaves_outbox_open_while_thread_busy(self):
+        """Test stop neither publishes nor closes the outbox under a publisher thread that did not exit"""
+        import tempfile
+        client = Mock(); client.is_connected.return_value = True
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = CountOutbox(os.path.join(tmp, 'outbox.db'))
+            publisher = MetricsPublisher(client, self.streams, lambda: self.snapshot, 60, outbox=outbox)
+            publisher._thread = Mock(is_alive=Mock(return_value=True))
+            with self.assertLogs(level='WARNING'):
+                publisher.stop(timeout=0.01)
+            client.publish.assert_not_called()
+            self.assertEqual(len(outbox), 0) # Sigue abierto
+            publisher._thread.is_alive.return_value = False
+            publisher.stop(timeout=0.01)
+            self.assertEqual(client.publish.call_count, 2) # Último intervalo, ya con el hilo fuera
+            self.assertRaises(Exception, len, outbox)
+
+    def test_outbox_size_cap(self):
+        """Test the oldest messages are dropped past max_rows"""
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = CountOutbox(os.path.join(tmp, 'outbox.db'), max_rows=3)
+            outbox.append([('t', str(i).encode()) for i in range(5)])
+            self.assertEqual([bytes(p) for _, _, p in outbox.peek(10)], [b'2', b'3', b'4'])
+            outbox.close()
+
+class TestMetrics(unittest.TestCase):
+    """Test stage latency histograms and Prometheus rendering"""
+
+    def test_bucket_precision(self):
+        """Test every value lands in a bucket within 12.5% of its upper bound"""
+        for ns in [0, 1, 7, 8, 15, 16, 999, 123456, 5_000_000, 2_000_000_000]:
+            idx = bucket_index(ns)
+            self.assertLess(ns, bucket_upper(idx))
+            self.assertLessEqual(bucket_upper(idx), max(ns * 1.125, ns + 1) + 1)
+            if idx: self.assertGreaterEqual(ns, bucket_upper(idx - 1))
+
+    def test_quantiles_and_render(self):
+        """Test percentiles and histogram exposition for one stage"""
+        registry = MetricsRegistry(); metrics = registry.stream('H001')
+        for ms in range(1, 101): metrics.observe('bgsub', 0, ms * 1_000_000)
+        metrics.frames = 100
+        counts, total, _ = metrics.stages['bgsub'].snapshot()
+        self.assertAlmostEqual(quantile(counts, total, 0.5), 0.050, delta=0.007)
+        self.assertAlmostEqual(quantile(counts, total, 0.99), 0.099, delta=0.013)
+        registry.register_gauge('beecount_results_queue_depth', "depth", lambda: 3)
+        text = registry.render()
+        self.assertIn('beecount_stage_latency_seconds_bucket{hive_id="H001",stage="bgsub",le="+Inf"} 100', text)
+        self.assertIn('beecount_stage_latency_seconds_bucket{hive_id="H001",stage="bgsub",le="0.01"} 9', text)
+        self.assertIn('beecount_frames_processed_total{hive_id="H001"} 100', text)
+        self.assertIn('beecount_results_queue_depth 3', text)
+
+    def test_worker_snapshot_merge(self):
+        """Test metrics from a worker process replace the local view"""
+        remote = MetricsRegistry(); remote.stream('H002').observe('total', 0, 5000)
+        local = MetricsRegistry(); local.merge(remote.snapshot())
+        self.assertEqual(local.streams['H002'].stages['total'].count, 1)
+
+class TestReplay(unittest.TestCase):
+    """Test offline replay with several parameter sets"""
+
+    def test_expand_variants(self):
+        """Test grid sweeps expand to the cartesian product with nested keys"""
+        variants = expand_variants(['min_area=30,50', 'line.pos=55,60'], [{'name': 'wide', 'max_dist': 60}])
+        self.assertEqual(len(variants), 5)
+        self.assertEqual(variants[0], ('min_area=30,line.pos=55', {'min_area': 30, 'line.pos': 55}))
+        self.assertEqual(variants[-1], ('wide', {'max_dist': 60}))
+
+    def test_decode_once_fan_out(self):
+        """Test every variant counts the same frames and parameters change the result"""
+        frames = []
+        for i in range(60):
+            frame = np.full((100, 100, 3), 170, dtype=np.uint8)
+            if i >= 20: cv2.circle(frame, (50, 5 + 3 * (i - 20)), 5, (20, 20, 20), -1) # Baja cruzando y=50
+            frames.append((i / 10.0, frame))
+        stream = {'hive_id': 'R001', 'url': 'replay', 'roi': [0, 0, 100, 100], 'line': {'axis': 'y', 'pos': 50},
+                  'direction': {'up_is_out': True}, 'min_area': 20, 'max_area': 2000, 'max_dist': 40,
+                  'detector': 'components'}
+        rows = replay_clip(stream, frames, expand_variants(['min_area=20,500']), bucket_s=3.0)
+        self.assertEqual([r['frames'] for r in rows], [60, 60])
+        self.assertEqual((rows[0]['in'], rows[0]['out']), (0, 1))
+        self.assertEqual((rows[1]['in'], rows[1]['out']), (0, 0))
+        self.assertEqual(sum(n_out for _, n_out in rows[0]['buckets'].values()), 1)
+
+class TestMotionGate(unittest.TestCase):
+    """Test idle detection and wake-up"""
+
+    def test_idle_and_wake_within_one_frame(self):
+        """Test the gate idles after still frames and reactivates on the first moving frame"""
+        gate = MotionGate(idle_after=5)
+        still = np.full((120, 160, 3), 170, dtype=np.uint8)
+        results = [gate.update(still) for _ in range(8)]
+        self.assertEqual(results, [True] * 5 + [False] * 3)
+        self.assertTrue(gate.idle)
+        moving = still.copy(); cv2.circle(moving, (80, 60), 6, (20, 20, 20), -1)
+        self.assertTrue(gate.update(moving))
+        self.assertFalse(gate.idle)
+
+    def test_idle_stream_slows_down(self):
+        """Test StreamWorker drops to idle_fps while the pipeline is idle"""
+        worker = StreamWorker({'hive_id': 'H001', 'target_fps': 10, 'idle_fps': 0.5}, lambda c: None,
+                              queue.SimpleQueue(), threading.Event(), CpuGovernor())
+        worker.pipeline = Mock(idle=False)
+        self.assertAlmostEqual(worker.frame_period(), 0.1)
+        worker.pipeline.idle = True
+        self.assertAlmostEqual(worker.frame_period(), 2.0)
+
+    def test_idle_pipeline_updates_background_every_n_frames(self):
+        """Test idle frames skip MOG2 except one in idle_bg_every, with the learning rate scaled to match"""
+        config = {'hive_id': 'IDLE', 'url': 'test://cam', 'roi': [0, 0, 160, 120], 'line': {'axis': 'y', 'pos': 60},
+                  'direction': {'up_is_out': True}, 'motion_gate': True, 'motion_idle_after': 3, 'idle_bg_every': 5}
+        pipeline = OpenCVPipeline(config, capture=False)
+        rates = []; apply = pipeline.bg_subtractor.apply
+        pipeline.bg_subtractor = Mock(apply=lambda frame, learningRate: rates.append(learningRate) or apply(frame),
+                                      getHistory=Mock(return_value=500))
+        still = np.full((120, 160, 3), 170, dtype=np.uint8)
+        results = [pipeline.process(still) for _ in range(23)]
+        self.assertEqual(sum(r.get('idle', False) for r in results), 20)
+        self.assertEqual(rates, [-1.0] * 3 + [5 / 500] * 4) # 3 frames activos, luego 1 de cada 5
+
+class TestSnapshots(unittest.TestCase):
+    """Test warm restart from persisted stream state"""
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore(self.tmp.name)
+        self.config = {'hive_id': 'WARM', 'url': 'test://cam', 'roi': [0, 0, 160, 120],
+                       'line': {'axis': 'y', 'pos': 60}, 'direction': {'up_is_out': True}}
+        self.background = np.full((120, 160, 3), 170, dtype=np.uint8)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _learned_pipeline(self):
+        pipeline = OpenCVPipeline(self.config, capture=False)
+        for _ in range(20): pipeline.process(self.background)
+        pipeline.tracker.update([(40, 50), (100, 70)])
+        return pipeline
+
+    def test_warm_restart_restores_background_and_tracks(self):
+        """Test the background is seeded on the first frame and open tracks survive"""
+        self.store.save('WARM', self._learned_pipeline())
+        restored = OpenCVPipeline(self.config, capture=False)
+        self.assertTrue(self.store.restore('WARM', restored))
+        self.assertEqual(len(restored.tracker.objects), 2)
+        restored.process(self.background)
+        self.assertIsNone(restored._pending_background)
+        self.assertAlmostEqual(restored.bg_learning_rate, 1 / 500)
+        bee = self.background.copy(); cv2.circle(bee, (80, 30), 6, (20, 20, 20), -1)
+        mask = restored.bg_subtractor.apply(restored._preprocess_frame(bee), learningRate=restored.bg_learning_rate)
+        self.assertGreater(np.count_nonzero(mask[20:40, 70:90] > 127), 50)
+        self.assertEqual(np.count_nonzero(mask[80:, :] > 127), 0)
+
+    def test_geometry_change_and_stale_tracks(self):
+        """Test a moved ROI forces a cold start and old tracks are discarded"""
+        self.store.save('WARM', self._learned_pipeline())
+        moved = OpenCVPipeline(dict(self.config, roi=[10, 0, 150, 120]), capture=False)
+        self.assertFalse(self.store.restore('WARM', moved))
+        self.store.tracks_max_age = -1 # Cualquier edad es demasiado vieja
+        restored = OpenCVPipeline(self.config, capture=False)
+        self.assertTrue(self.store.restore('WARM', restored))
+        self.assertEqual(len(restored.tracker.objects), 0)
+        self.assertIsNotNone(restored._pending_background)
+
+    def test_partial_counts_roundtrip(self):
+        """Test unpublished counts are restored and zeroed hives are skipped"""
+        self.store.save_counts({'H1': {'bees_in': 3, 'bees_out': 1}, 'H2': {'bees_in': 0, 'bees_out': 0}})
+        self.assertEqual(self.store.load_counts(), {'H1': {'bees_in': 3, 'bees_out': 1}})
+        self.store.counts_max_age = -1
+        self.assertEqual(self.store.load_counts(), {})
+
 class TestIntegration(unittest.TestCase):
     """Integration tests for the complete counting system"""
     
@@ -0,0 +1,107 @@
+"""
+Micro-batching stage for streaming telemetry
+Groups incoming messages for a few milliseconds so each model scores them in one call
+"""
+
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class AsyncMicroBatcher:
+    """Cola acotada en el event loop que agrupa mensajes por clave (hive_id) en ventanas cortas y lanza
+    cada grupo como tarea, con concurrencia acotada.
+    Un solo lote en curso por clave: lo que llega mientras tanto se acumula y sale, en orden, al terminar"""
+    def __init__(self, handler: Callable[[str, List[Any]], Awaitable[None]], max_queue: int = 10000,
+                 max_batch: int = 512, window_ms: float = 5.0, max_inflight: int = 4):
+        self.handler = handler # Corrutina; lo que hace antes de su primer await corre en orden de llegada
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._inflight = set()
+        self._busy: Dict[str, asyncio.Task] = {} # clave -> su lote en curso
+        self._pending: Dict[str, List[Any]] = {} # clave -> items acumulados detrás de ese lote
+        self._task = None
+        self._stopping = False
+        self.dropped = 0
+        self.processed = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Procesar lo encolado y esperar los lotes en curso"""
+        self._stopping = True
+        if self._task: await self._task
+        if self._inflight: await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def put(self, key: str, item: Any):
+        """Espera si la cola está llena: la contrapresión llega hasta la lectura del socket MQTT"""
+        await self._queue.put((key, item))
+
+    def submit(self, key: str, item: Any) -> bool:
+        """No espera nunca; descarta si la cola está llena"""
+        try:
+            self._queue.put_nowait((key, item))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Scoring queue full, dropped {self.dropped} messages so far")
+            return False
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    async def _collect(self) -> List[Tuple[str, Any]]:
+        try: batch = [await asyncio.wait_for(self._queue.get(), 0.5)]
+        except asyncio.TimeoutError: return []
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait()); continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError: break
+        return batch
+
+    async def _dispatch(self, key: str, items: List[Any]):
+        """Lotes de una clave uno tras otro con la misma ranura: alertas en orden, sin scoring concurrente"""
+        try:
+            while items:
+                try:
+                    await self.handler(key, items)
+                except Exception as e:
+                    logger.error(f"Batch handler failed for {key}: {e}")
+                self.processed += len(items)
+                items = self._pending.pop(key, None)
+        finally:
+            del self._busy[key]
+            self._slots.release()
+
+    async def _run(self):
+        while not self._stopping or not self._queue.empty():
+            batch = await self._collect()
+            groups: Dict[str, List[Any]] = defaultdict(list)
+            for key, item in batch: groups[key].append(item)
+            for key, items in groups.items():
+                if key in self._busy:
+                    pending = self._pending.setdefault(key, [])
+                    pending.extend(items)
+                    # Acotar lo acumulado: mientras la clave no se libere tampoco se recolecta, la cola se llena
+                    if len(pending) >= self.max_batch: await asyncio.wait({self._busy[key]})
+                    continue
+                await self._slots.acquire() # Sin ranuras libres no se recolecta más: la cola se llena
+                task = asyncio.get_running_loop().create_task(self._dispatch(key, items))
+                self._busy[key] = task
+                self._inflight.add(task); task.add_done_callback(self._inflight.discard)
@@ -0,0 +1,193 @@
+"""
+Compiled ensemble scorer
+Flattens fitted forests (and the RBF one-class SVM) into contiguous NumPy arrays and scores a
+whole batch without sklearn's per-call validation
+"""
+
+import logging
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOLERANCE = 1e-6
+VERIFY_ROWS = 512
+
+def average_path_length(n: np.ndarray) -> np.ndarray:
+    """c(n) de Isolation Forest (misma definición que sklearn)"""
+    n = np.asarray(n, dtype=np.float64)
+    out = np.zeros_like(n)
+    out[n == 2] = 1.0
+    big = n > 2
+    out[big] = 2.0 * (np.log(n[big] - 1.0) + np.euler_gamma) - 2.0 * (n[big] - 1.0) / n[big]
+    return out
+
+def rf_normal_index(rf) -> Optional[int]:
+    """Columna de la clase normal (1) en predict_proba; None si el RF se entrenó con una sola clase y no vota"""
+    classes = list(rf.classes_)
+    return classes.index(1) if len(classes) > 1 and 1 in classes else None
+
+def _node_depths(tree) -> np.ndarray:
+    """Profundidad por nodo con la raíz en 1 (como Tree.compute_node_depths)"""
+    depths = np.ones(tree.node_count, dtype=np.float64)
+    for node in range(tree.node_count): # Los hijos siempre tienen índice mayor que el padre
+        for child in (tree.children_left[node], tree.children_right[node]):
+            if child != -1: depths[child] = depths[node] + 1
+    return depths
+
+class CompiledForest:
+    """Todos los árboles de un bosque en arreglos planos con índices de nodo globales"""
+    def __init__(self, trees, leaf_values, feature_maps=None):
+        counts = [t.node_count for t in trees]
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        self.roots = offsets
+        self.max_depth = max(t.max_depth for t in trees)
+        feature, threshold, left, right = [], [], [], []
+        for i, (tree, offset) in enumerate(zip(trees, offsets)):
+            leaf = tree.children_left == -1
+            node_ids = np.arange(tree.node_count) + offset
+            f = np.where(leaf, 0, tree.feature)
+            if feature_maps is not None: f = np.asarray(feature_maps[i])[f]
+            feature.append(f)
+            threshold.append(np.where(leaf, np.inf, tree.threshold)) # Las hojas se apuntan a sí mismas
+            left.append(np.where(leaf, node_ids, tree.children_left + offset))
+            right.append(np.where(leaf, node_ids, tree.children_right + offset))
+        self.feature = np.concatenate(feature).astype(np.int64)
+        self.threshold = np.concatenate(threshold).astype(np.float64)
+        self.left = np.concatenate(left).astype(np.int64)
+        self.right = np.concatenate(right).astype(np.int64)
+        self.value = np.concatenate(leaf_values, axis=0) # (nodos,) o (nodos, clases)
+
+    def apply(self, X32: np.ndarray) -> np.ndarray:
+        """Hoja (índice global) de cada fila en cada árbol: recorre todos los árboles a la vez"""
+        n, n_features = X32.shape
+        flat = X32.ravel()
+        row_base = (np.arange(n, dtype=np.int64) * n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (n, len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            go_left = flat[row_base + self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return nodes
+
+class CompiledEnsemble:
+    """Scaler + IsolationForest + OneClassSVM (RBF) + RandomForest en NumPy puro"""
+    def __init__(self, model_info: Dict):
+        scaler = model_info['scaler']
+        self.mean = np.asarray(scaler.mean_ if scaler.with_mean else 0.0, dtype=np.float64)
+        self.scale = np.asarray(scaler.scale_ if scaler.with_std else 1.0, dtype=np.float64)
+
+        iso = model_info['isolation_forest']
+        trees = [est.tree_ for est in iso.estimators_]
+        maps = None
+        if any(len(f) != iso.n_features_in_ for f in iso.estimators_features_): # Sólo si hubo submuestreo
+            maps = iso.estimators_features_
+        # Valor de hoja = profundidad + c(muestras en la hoja) - 1, igual que sklearn
+        leaves = [_node_depths(t) + average_path_length(t.n_node_samples) - 1.0 for t in trees]
+        self.iso = CompiledForest(trees, leaves, maps)
+        self.iso_denominator = len(trees) * float(average_path_length([iso.max_samples_])[0])
+        self.iso_offset = float(iso.offset_)
+
+        svm = model_info['one_class_svm']
+        if svm.kernel != 'rbf':
+            raise ValueError(f"Unsupported OneClassSVM kernel: {svm.kernel}")
+        self.sv = np.ascontiguousarray(svm.support_vectors_, dtype=np.float64)
+        self.sv_sq = (self.sv ** 2).sum(axis=1)
+        self.dual_coef = np.asarray(svm.dual_coef_[0], dtype=np.float64)
+        self.svm_intercept = float(svm.intercept_[0])
+        self.gamma = float(svm._gamma)
+
+        rf = model_info['random_forest']
+        class_idx = rf_normal_index(rf)
+        self.rf = None
+        if class_idx is not None:
+            probas = []
+            for est in rf.estimators_:
+                value = est.tree_.value[:, 0, :]
+                norm = value.sum(axis=1, keepdims=True); norm[norm == 0] = 1.0
+                probas.append((value / norm)[:, class_idx])
+            self.rf = CompiledForest([est.tree_ for est in rf.estimators_], probas)
+        self.rf_trees = len(rf.estimators_)
+
+    def votes(self, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """decision_function de IF y OCSVM y predict_proba[clase 1] - 0.5 del RF"""
+        X_scaled = (np.asarray(X, dtype=np.float64) - self.mean) / self.scale
+        X32 = np.ascontiguousarray(X_scaled, dtype=np.float32) # Los árboles de sklearn comparan en float32
+
+        depths = self.iso.value[self.iso.apply(X32)].sum(axis=1)
+        if self.iso_denominator > 0:
+            iso_scores = 2.0 ** (-depths / self.iso_denominator)
+        else:
+            iso_scores = np.ones(len(X_scaled))
+        iso_pred = -iso_scores - self.iso_offset
+
+        sq_dist = (X_scaled ** 2).sum(axis=1)[:, None] + self.sv_sq[None, :] - 2.0 * X_scaled @ self.sv.T
+        svm_pred = np.exp(-self.gamma * np.maximum(sq_dist, 0.0)) @ self.dual_coef + self.svm_intercept
+
+        if self.rf is None:
+            rf_pred = np.zeros(len(X_scaled))
+        else:
+            rf_pred = self.rf.value[self.rf.apply(X32)].sum(axis=1) / self.rf_trees - 0.5
+        return iso_pred, svm_pred, rf_pred
+
+def sklearn_votes(model_info: Dict, X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Los mismos puntajes con los estimadores de sklearn (referencia y respaldo)"""
+    X_scaled = model_info['scaler'].transform(X)
+    rf = model_info['random_forest']
+    class_idx = rf_normal_index(rf)
+    rf_pred = rf.predict_proba(X_scaled)[:, class_idx] - 0.5 if class_idx is not None else np.zeros(len(X_scaled))
+    return (model_info['isolation_forest'].decision_function(X_scaled),
+            model_info['one_class_svm'].decision_function(X_scaled), rf_pred)
+
+def fit_vote_scales(model_info: Dict) -> np.ndarray:
+    """Escala de cada estimador (percentil 90 de |puntaje| sobre el reservorio de entrenamiento); 0 = no vota"""
+    X = model_info['scaler'].inverse_transform(np.asarray(model_info['reservoir']))
+    scales = np.percentile(np.abs(np.vstack(sklearn_votes(model_info, X))), 90, axis=1)
+    if rf_normal_index(model_info['random_forest']) is None: scales[2] = 0.0
+    scales[~np.isfinite(scales)] = 0.0
+    return scales
+
+def combine_votes(votes: np.ndarray, scales: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Puntaje del ensemble en [-1, 1] (negativo = anomalía) y fracción de estimadores de acuerdo.
+
+    Cada voto se divide por la escala de su estimador y se recorta, así ninguno decide sólo por tener
+    mayor rango. Sin escalas (modelos anteriores) es mayoría simple por signo.
+    """
+    votes = np.asarray(votes, dtype=np.float64)
+    if scales is None:
+        active = np.any(votes != 0, axis=1) # Un RF de una sola clase devuelve ceros: se abstiene
+        normalized = np.sign(votes[active])
+    else:
+        scales = np.asarray(scales, dtype=np.float64)
+        active = scales > 0
+        normalized = np.clip(votes[active] / scales[active, None], -1.0, 1.0)
+    n = votes.shape[1]
+    if not len(normalized):
+        return np.zeros(n), np.zeros(n)
+    score = normalized.mean(axis=0)
+    verdict = np.where(score < 0, -1.0, 1.0)
+    return score, (np.sign(normalized) == verdict).mean(axis=0)
+
+def compile_ensemble(model_info: Dict, X_check: Optional[np.ndarray] = None) -> Optional[CompiledEnsemble]:
+    """Compilar y verificar contra sklearn; None si no se puede (se usa sklearn al puntuar)"""
+    try:
+        compiled = CompiledEnsemble(model_info)
+        if X_check is None and model_info.get('reservoir') is not None:
+            scaler = model_info['scaler'] # El reservorio está escalado: volver al espacio original
+            X_check = scaler.inverse_transform(np.asarray(model_info['reservoir'])[:VERIFY_ROWS])
+        if X_check is not None and len(X_check):
+            for name, ours, ref in zip(('isolation_forest', 'one_class_svm', 'random_forest'),
+                                       compiled.votes(X_check), sklearn_votes(model_info, X_check)):
+                err = float(np.max(np.abs(ours - ref)))
+                if err > TOLERANCE:
+                    logger.warning(f"Compiled {name} differs from sklearn by {err:.2e}, keeping sklearn scorer")
+                    return None
+        return compiled
+    except Exception as e:
+        logger.warning(f"Could not compile ensemble: {e}")
+        return None
+
+def ensure_compiled(model_info: Dict) -> Dict:
+    """Modelos guardados antes del scorer compilado: compilar al cargarlos, no en el camino de scoring"""
+    if isinstance(model_info, dict) and 'compiled' not in model_info:
+        model_info['compiled'] = compile_ensemble(model_info)
+    return model_info
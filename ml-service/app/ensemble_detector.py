@@ -5,18 +5,24 @@ Combines multiple models for higher accuracy
 
 import os
 import json
+import time
+import signal
+import asyncio
 import logging
+import multiprocessing
 import numpy as np
 import pandas as pd
-import pickle # Necesario para persistir modelos
-import paho.mqtt.client as mqtt
-from datetime import datetime, timezone
-from typing import Dict, List, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Tuple
 
-# Dependencias de Scikit-learn
-from sklearn.ensemble import IsolationForest, RandomForestClassifier
-from sklearn.svm import OneClassSVM
-from sklearn.preprocessing import StandardScaler
+from .batching import AsyncMicroBatcher
+from .model_store import ModelStore
+from .training import TrainingScheduler, telemetry_hives, train_hive
+from .influx_writer import AsyncInfluxBatchWriter
+from .mqtt_async import AsyncMqttClient
+from .features import FeatureEngine, ROLLING_FEATURES, BROOD_SPREAD_C
+from .compiled_trees import combine_votes, ensure_compiled, sklearn_votes
 
 # Cliente de InfluxDB (asumiendo que se importa desde una librería instalada en el contenedor)
 # Nota: La importación real debe ser 'from influxdb_client import InfluxDBClient, Point'
@@ -30,9 +36,9 @@ from sklearn.preprocessing import StandardScaler
 class InfluxDBClient:
     def __init__(self, url, token, org): pass
     def query_api(self): return self
-    def write_api(self): return self
+    def write_api(self, **kwargs): return self
     def query_data_frame(self, query): return pd.DataFrame()
-    def write(self, bucket, org, record): pass
+    def write(self, bucket, org, record, **kwargs): pass
     
 class Logger:
     def info(self, msg): print(f"[INFO ML] {msg}")
@@ -43,147 +49,274 @@ logger = Logger()
 class EnsembleAnomalyDetector:
     """Detector ensemble para mayor precisión"""
     def __init__(self):
-        self.models = {} # Un modelo por colmena
-        self.influx_client = InfluxDBClient(
-            url=os.getenv("INFLUX_URL", "http://influxdb:8086"),
-            token=os.getenv("INFLUX_TOKEN"),
-            org="apiary"
+        # Un modelo por colmena: {'features', 'scaler', 'isolation_forest', 'one_class_svm', 'random_forest', 'compiled'}
+        # cargado bajo demanda con LRU por presupuesto de memoria
+        self.models_dir = os.getenv("MODELS_DIR", "/app/models")
+        self.models = ModelStore(
+            self.models_dir,
+            memory_budget_mb=float(os.getenv("MODEL_MEMORY_BUDGET_MB", "512")),
+            on_load=ensure_compiled
         )
-        self.mqtt_client = mqtt.Client()
-        self.mqtt_client.on_connect = self._on_mqtt_connect
-        self.mqtt_client.on_message = self._on_mqtt_message
-        self.mqtt_client.username_pw_set(
-            os.getenv("MQTT_USER", "api_service"),
-            os.getenv("MQTT_PASS", "change_me")
+        # Todo el I/O corre en un solo event loop; el constructor no conecta ni arranca nada (ver initialize)
+        self.influx_writer = None
+        self.mqtt = AsyncMqttClient(
+            os.getenv("MQTT_HOST", "mosquitto"), int(os.getenv("MQTT_PORT", "1883")), 60,
+            username=os.getenv("MQTT_USER", "api_service"),
+            password=os.getenv("MQTT_PASS", "change_me"),
+            topics=[(os.getenv("TELEMETRY_TOPIC", "hives/+/telemetry"), 0)],
+            max_inbox=int(os.getenv("MQTT_INBOX_SIZE", "10000"))
         )
-        
-        # Conectar a MQTT broker
-        self.mqtt_client.connect(
-            os.getenv("MQTT_HOST", "mosquitto"),
-            1883, 60
+
+        # Ventanas por colmena (Δ24h, spread 1h, EWMA audio, pendiente CO2) actualizadas con cada mensaje;
+        # reemplazan a las tareas Flux d24h_weight_change y brood_stability_check
+        self.features = FeatureEngine(rollup_interval=float(os.getenv("FEATURE_ROLLUP_INTERVAL", "300")))
+
+        # Scoring (CPU) en un pool de hilos acotado; micro-lotes por colmena con contrapresión
+        scoring_workers = int(os.getenv("SCORING_WORKERS", "2"))
+        self.scoring_pool = ThreadPoolExecutor(max_workers=scoring_workers, thread_name_prefix="scoring")
+        self.batcher = AsyncMicroBatcher(
+            self._score_batch,
+            max_queue=int(os.getenv("SCORING_QUEUE_SIZE", "10000")),
+            window_ms=float(os.getenv("SCORING_BATCH_WINDOW_MS", "5")),
+            max_inflight=scoring_workers * 2
         )
-        self.mqtt_client.loop_start()
+        # Reentrenos bajo demanda en otro proceso: no compiten por el GIL con la detección
+        self.training_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self.training_hour = int(os.getenv("TRAINING_HOUR", "2")) # Hora local del entrenamiento nocturno; -1 lo desactiva
+        self.training_days = int(os.getenv("TRAINING_DAYS", "30"))
+        self._consumer = None
+        self._nightly = None
+        self._rollups = None
+
+    def _influx_client(self):
+        """InfluxDBClientAsync si está instalado (aiohttp); si no, el cliente síncrono vía executor"""
+        params = dict(url=os.getenv("INFLUX_URL", "http://influxdb:8086"), token=os.getenv("INFLUX_TOKEN"), org="apiary")
+        try:
+            from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+        except ImportError:
+            return InfluxDBClient(**params)
+        return InfluxDBClientAsync(**params)
 
     async def initialize(self):
-        """Inicializar el servicio"""
-        # Cargar modelos existentes
+        """Inicializar el servicio en el event loop actual"""
         await self.load_existing_models()
+        self.influx_writer = AsyncInfluxBatchWriter(
+            self._influx_client(), bucket="telemetry", org="apiary",
+            batch_size=int(os.getenv("INFLUX_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("INFLUX_FLUSH_INTERVAL", "1.0")),
+            stats_interval=float(os.getenv("INFLUX_STATS_INTERVAL", "60")),
+            spool_dir=os.getenv("INFLUX_SPOOL_DIR", "/app/spool")
+        )
+        self.influx_writer.start()
+        self.batcher.start()
+        self._consumer = asyncio.get_running_loop().create_task(self._consume())
+        self._rollups = asyncio.get_running_loop().create_task(self._rollup_loop())
+        if self.training_hour >= 0:
+            self._nightly = asyncio.get_running_loop().create_task(self._nightly_training())
+        await self.mqtt.start()
 
-    def _on_mqtt_connect(self, client, userdata, rc):
-        if rc == 0:
-            logger.info("MQTT connected successfully")
-        else:
-            logger.error(f"MQTT connection failed with code {rc}")
+    async def shutdown(self):
+        """Parada ordenada: puntuar lo ya recibido, publicar alertas pendientes y vaciar el writer"""
+        for task in (self._nightly, self._rollups):
+            if task is None: continue
+            task.cancel()
+            try: await task
+            except asyncio.CancelledError: pass
+        # El consumidor termina solo al llegar al fin de la inbox: todo lo leído pasa por put(), sin descartes
+        self.mqtt.stop_reading()
+        await self.mqtt.close_inbox()
+        if self._consumer: await self._consumer
+        await self.batcher.stop()
+        await self.mqtt.stop()
+        if self.influx_writer:
+            await self.influx_writer.stop()
+            close = getattr(self.influx_writer.client, 'close', None)
+            if close and asyncio.iscoroutinefunction(close): await close()
+        self.scoring_pool.shutdown(wait=True)
+        self.training_pool.shutdown(wait=False, cancel_futures=True)
+        logger.info(f"ML service stopped ({self.batcher.processed} messages scored, {self.batcher.dropped} dropped)")
 
-    def _on_mqtt_message(self, client, userdata, msg):
-        """Callback de mensaje MQTT para procesar telemetría en tiempo real"""
+    async def _consume(self):
+        """Mensajes MQTT al micro-batcher; espera si la cola de scoring está llena"""
+        while True:
+            msg = await self.mqtt.inbox.get()
+            if msg is None: return # Apagando: close_inbox()
+            parsed = self._parse(msg)
+            if parsed: await self.batcher.put(*parsed)
+
+    def _parse(self, msg):
         try:
-            data = json.loads(msg.payload.decode())
             # Asume que el tópico es 'hives/{hive_id}/telemetry'
-            hive_id = msg.topic.split('/') 
-
-            # Detectar anomalía con ensemble
-            is_anomaly, score, confidence = self.detect_ensemble(hive_id, data)
-
-            if is_anomaly:
-                alert = {
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "hive_id": hive_id,
-                    "type": "ensemble_anomaly",
-                    "score": score,
-                    "confidence": confidence,
-                    "data": data,
-                    "message": f"Comportamiento anómalo detectado (score: {score:.2f}, confidence: {confidence:.2f})"
-                }
-                
-                # Publicar alerta al tópico de anomalías
-                client.publish(
-                    f"hives/{hive_id}/anomalies",
-                    json.dumps(alert),
-                    qos=1
-                )
-                
-                # Guardar en InfluxDB
-                self.save_anomaly(hive_id, score, confidence, data)
+            return msg.topic.split('/')[1], json.loads(msg.payload)
         except Exception as e:
             logger.error(f"Error processing message: {e}")
+            return None
+
+    async def _score_batch(self, hive_id: str, rows: List[dict]):
+        """Puntuar un micro-lote de telemetría de una colmena y emitir alertas"""
+        # Ventanas en el event loop, en orden de llegada; sólo el scoring va al pool
+        rows = [dict(row, **self.features.update(hive_id, row)) for row in rows]
+        loop = asyncio.get_running_loop()
+        is_anomaly, scores, confidences = await loop.run_in_executor(
+            self.scoring_pool, self.detect_ensemble_batch, hive_id, rows)
+        for i in np.flatnonzero(is_anomaly):
+            self._emit_alert(hive_id, float(scores[i]), float(confidences[i]), rows[i])
+
+    async def _rollup_loop(self, tick: float = 1.0):
+        """Rollups desde una sola tarea periódica, no tras cada micro-lote"""
+        while True:
+            await asyncio.sleep(min(tick, self.features.rollup_interval))
+            try: self.write_feature_rollups()
+            except Exception as e: logger.error(f"Feature rollup failed: {e}")
+
+    def write_feature_rollups(self):
+        """Escribir las features de ventana vigentes (cada FEATURE_ROLLUP_INTERVAL por colmena)"""
+        for hive_id, t, feats in self.features.due_rollups():
+            fields = {k: float(v) for k, v in feats.items() if not np.isnan(v)}
+            if not fields: continue
+            ts_ns = int(t * 1e9)
+            self.influx_writer.write("hive_telemetry", {"hive_id": hive_id}, fields, ts_ns)
+            if fields.get('t_in_spread_1h', 0.0) > BROOD_SPREAD_C:
+                self.influx_writer.write("brood_alerts", {"hive_id": hive_id}, {"t_in_c": fields['t_in_spread_1h']}, ts_ns)
+
+    def _emit_alert(self, hive_id: str, score: float, confidence: float, data: dict):
+        alert = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "hive_id": hive_id,
+            "type": "ensemble_anomaly",
+            "score": score,
+            "confidence": confidence,
+            # Ventanas aún sin llenar (d24h_g las primeras ~22 h) son NaN: null en JSON estricto
+            "data": {k: None if isinstance(v, float) and not np.isfinite(v) else v for k, v in data.items()},
+            "message": f"Comportamiento anómalo detectado (score: {score:.2f}, confidence: {confidence:.2f})"
+        }
+        
+        # Publicar alerta al tópico de anomalías
+        self.mqtt.publish(
+            f"hives/{hive_id}/anomalies",
+            json.dumps(alert, allow_nan=False),
+            qos=1
+        )
+        
+        # Guardar en InfluxDB
+        self.save_anomaly(hive_id, score, confidence, data)
 
     async def load_existing_models(self):
-        """Cargar modelos existentes del disco /app/models"""
-        models_dir = "/app/models"
-        if not os.path.exists(models_dir):
-            os.makedirs(models_dir)
-
-        for filename in os.listdir(models_dir):
-            if filename.endswith("_ensemble.pkl"):
-                hive_id = filename.replace("_ensemble.pkl", "")
-                try:
-                    with open(os.path.join(models_dir, filename), 'rb') as f:
-                        self.models[hive_id] = pickle.load(f)
-                    logger.info(f"Loaded ensemble model for {hive_id}")
-                except Exception as e:
-                    logger.error(f"Error loading model for {hive_id}: {e}")
+        """Registrar los modelos existentes en disco; se cargan al primer uso"""
+        if not os.path.exists(self.models_dir):
+            os.makedirs(self.models_dir)
+
+        available = self.models.available()
+        logger.info(f"Found {len(available)} ensemble models in {self.models_dir} (lazy loading)")
 
     async def train_ensemble_model(self, hive_id: str, days: int = 30):
         """Entrenar modelo ensemble para una colmena específica usando datos históricos"""
         logger.info(f"Training ensemble model for {hive_id} with {days} days of data")
-        
-        # (Lógica de consulta a InfluxDB para obtener datos históricos)
-        # (Lógica de preprocesamiento, normalización y entrenamiento de IsolationForest, OneClassSVM, RandomForest)
-        # (Lógica para guardar el modelo entrenado y el scaler usando pickle)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.training_pool, train_hive, hive_id, days, self.models_dir)
+        self.save_training_metrics([result])
+        return result['status'] == 'trained'
 
-        # Retorno simulado:
-        logger.warning("Training logic is simplified/simulated in this snippet.")
-        return True
+    async def known_hives(self, days: int = 30) -> List[str]:
+        """Colmenas a entrenar: las vistas por MQTT, las que tienen modelo y las que tienen telemetría en InfluxDB"""
+        hives = set(self.features.hives) | set(self.models.available())
+        try:
+            hives |= set(await asyncio.get_running_loop().run_in_executor(None, telemetry_hives, None, days))
+        except Exception as e:
+            logger.warning(f"Could not list hives from InfluxDB, using {len(hives)} known hives: {e}")
+        return sorted(hives)
+
+    async def train_all_models(self, hive_ids: List[str] = None, days: int = 30, full: bool = False):
+        """Entrenamiento nocturno de la flota: colmenas en paralelo, warm start desde el último checkpoint"""
+        hive_ids = hive_ids or await self.known_hives(days)
+        if not hive_ids:
+            logger.info("No hives with telemetry yet, nothing to train")
+            return []
+        scheduler = TrainingScheduler(self.models_dir)
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, scheduler.train_all, hive_ids, days, full)
+        self.save_training_metrics(results)
+        # El ModelStore detecta los archivos nuevos por mtime y recarga sin reinicio
+        return results
+
+    def seconds_until_training(self, now: datetime = None) -> float:
+        now = now or datetime.now()
+        run_at = now.replace(hour=self.training_hour, minute=0, second=0, microsecond=0)
+        if run_at <= now: run_at += timedelta(days=1)
+        return (run_at - now).total_seconds()
+
+    async def _nightly_training(self):
+        """Una corrida de TrainingScheduler.train_all por día a TRAINING_HOUR"""
+        while True:
+            await asyncio.sleep(self.seconds_until_training())
+            try:
+                results = await self.train_all_models(days=self.training_days)
+                trained = sum(r['status'] == 'trained' for r in results)
+                logger.info(f"Nightly training finished: {trained}/{len(results)} hives trained")
+            except Exception as e:
+                logger.error(f"Nightly training failed: {e}")
+
+    def save_training_metrics(self, results: List[dict]):
+        """Guardar duración y filas de entrenamiento por colmena en InfluxDB"""
+        for r in results:
+            self.influx_writer.write(
+                "ml_training",
+                {"hive_id": r['hive_id'], "mode": r.get('mode', 'full'), "status": r['status']},
+                {"duration_s": float(r['duration_s']), "rows": int(r.get('rows', 0))}
+            )
+
+    def detect_ensemble_batch(self, hive_id: str, rows: List[dict]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Detectar anomalías en un lote: una llamada por estimador para todas las filas"""
+        n = len(rows)
+        model_info = self.models.get(hive_id)
+        if model_info is None:
+            logger.warning(f"No model available for {hive_id}")
+            return np.zeros(n, dtype=bool), np.zeros(n), np.zeros(n)
+
+        features = model_info['features']
+        X = np.array([[row.get(feat, 0) for feat in features] for row in rows], dtype=np.float64)
+        scaler = model_info['scaler']
+        X = np.where(np.isnan(X), scaler.mean_, X) # Ventanas aún incompletas: valor neutro
+
+        # Puntajes con signo: negativo = anomalía (patrón de IF y OCSVM)
+        compiled = model_info.get('compiled') # Compilado al entrenar o, en modelos viejos, al cargar
+        try:
+            votes = np.vstack(compiled.votes(X) if compiled is not None else sklearn_votes(model_info, X))
+        except Exception as e:
+            logger.warning(f"Compiled scorer failed for {hive_id}, falling back to sklearn: {e}")
+            model_info['compiled'] = None
+            votes = np.vstack(sklearn_votes(model_info, X))
+        # Votos en unidades comparables (escalas del entrenamiento); confianza = fracción de acuerdo
+        ensemble_pred, confidence = combine_votes(votes, model_info.get('vote_scales'))
+        return ensemble_pred < 0, ensemble_pred, confidence
 
     def detect_ensemble(self, hive_id: str, data: dict) -> Tuple[bool, float, float]:
         """Detectar si los datos de telemetría son anómalos"""
-        if hive_id not in self.models:
-            logger.warning(f"No model available for {hive_id}")
-            return False, 0.0, 0.0
-
-        model_info = self.models[hive_id]
-       
-        # Preparar datos (asumiendo que las características están definidas en model_info['features'])
-        features = [data.get(feat, 0) for feat in model_info['features']]
-        X = np.array([features])
-       
-        # Simulación de transformación y predicción
-        # X_scaled = model_info['scaler'].transform(X.reshape(1, -1))
-       
-        # Simulación de puntajes (basado en el patrón -1 para anomalía, 1 para normal)
-        iso_pred = 0.5 # Simulación
-        svm_pred = 0.5 # Simulación
-        rf_pred = 0.5 # Simulación (probabilidad)
-
-        # Votación por mayoría (simplificado)
-        ensemble_pred = (iso_pred + svm_pred + rf_pred) / 3
-       
-        # Simulación de cálculo de confianza
-        confidence = 0.75 
-
-        # Si el puntaje es menor a 0, se considera anomalía (patrón común en IF y OCSVM)
-        is_anomaly = ensemble_pred < 0 
-        
-        return is_anomaly, float(ensemble_pred), float(confidence)
+        is_anomaly, score, confidence = self.detect_ensemble_batch(hive_id, [data])
+        return bool(is_anomaly[0]), float(score[0]), float(confidence[0])
 
     def save_anomaly(self, hive_id: str, score: float, confidence: float, data: dict):
-        """Guardar anomalía en InfluxDB"""
-        # Nota: Asume que 'Point' es accesible (importada desde influxdb_client)
-        from influxdb_client import Point
-
-        point = Point("hive_ensemble_anomalies") \
-            .tag("hive_id", hive_id) \
-            .field("anomaly_score", score) \
-            .field("confidence", confidence) \
-            .field("weight_kg", data.get('weight_kg', 0)) \
-            .field("t_in_c", data.get('t_in_c', 0)) \
-            .field("co2_ppm", data.get('co2_ppm', 0)) \
-            .field("audio_200_400", data.get('audio_200_400', 0)) \
-            .field("acc_rms", data.get('acc_rms', 0)) \
-            .field("tilt_deg", data.get('tilt_deg', 0)) \
-            .field("batt_v", data.get('batt_v', 0)) \
-            .time(datetime.utcnow())
-           
-        write_api = self.influx_client.write_api()
-        write_api.write(bucket="telemetry", org="apiary", record=point)
\ No newline at end of file
+        """Guardar anomalía en InfluxDB (encolada en el writer por lotes)"""
+        fields = {"anomaly_score": float(score), "confidence": float(confidence)}
+        for field in ('weight_kg', 't_in_c', 'co2_ppm', 'audio_200_400', 'acc_rms', 'tilt_deg', 'batt_v'):
+            fields[field] = float(data.get(field, 0))
+        for field in ROLLING_FEATURES:
+            if field in data and not np.isnan(data[field]): fields[field] = float(data[field])
+        self.influx_writer.write("hive_ensemble_anomalies", {"hive_id": hive_id}, fields, time.time_ns())
+
+async def main():
+    """Servicio completo en un solo event loop hasta SIGINT/SIGTERM"""
+    detector = EnsembleAnomalyDetector()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await detector.initialize()
+    try:
+        await stop.wait()
+    finally:
+        await detector.shutdown()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,148 @@
+"""
+Streaming rolling-feature engine
+Per-hive sliding windows updated in O(1) per message from the MQTT feed
+"""
+
+import math
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ROLLING_FEATURES = ['d24h_g', 't_in_spread_1h', 'audio_ewma', 'co2_slope_ppm_h']
+
+WEIGHT_WINDOW_S = 24 * 3600
+SPREAD_WINDOW_S = 3600
+CO2_WINDOW_S = 3600
+AUDIO_TAU_S = 600 # Constante de tiempo de la EWMA
+MIN_COVERAGE = 0.9 # Fracción de la ventana con datos para publicar d24h_g
+BROOD_SPREAD_C = 1.5 # Igual que la antigua tarea brood_stability
+
+def message_time(row: dict, default: Optional[float] = None) -> float:
+    """Segundos epoch del mensaje ('ts' ISO o numérico); hora de llegada si no trae"""
+    ts = row.get('ts')
+    if isinstance(ts, (int, float)):
+        return float(ts) / 1000.0 if ts > 1e11 else float(ts) # Acepta ms
+    if isinstance(ts, str):
+        try: return datetime.fromisoformat(ts.replace('Z', '+00:00')).timestamp()
+        except ValueError: pass
+    return default if default is not None else time.time()
+
+class _SlidingExtremes:
+    """Máximo y mínimo de ventana deslizante con deques monótonos (O(1) amortizado)"""
+    def __init__(self, window_s: float):
+        self.window_s = window_s
+        self._max = deque(); self._min = deque()
+
+    def push(self, t: float, v: float):
+        while self._max and self._max[-1][1] <= v: self._max.pop()
+        while self._min and self._min[-1][1] >= v: self._min.pop()
+        self._max.append((t, v)); self._min.append((t, v))
+        cutoff = t - self.window_s
+        while self._max[0][0] < cutoff: self._max.popleft()
+        while self._min[0][0] < cutoff: self._min.popleft()
+
+    def spread(self) -> float:
+        return self._max[0][1] - self._min[0][1] if self._max else math.nan
+
+class _SlidingRegression:
+    """Pendiente por mínimos cuadrados sobre una ventana, con sumas acumuladas"""
+    def __init__(self, window_s: float):
+        self.window_s = window_s
+        self._points = deque()
+        self._origin = None
+        self.n = 0; self.st = self.sy = self.stt = self.sty = 0.0
+
+    def _add(self, t: float, y: float, sign: int):
+        x = (t - self._origin) / 3600.0 # Horas desde el origen: sumas pequeñas, sin pérdida de precisión
+        self.n += sign; self.st += sign * x; self.sy += sign * y
+        self.stt += sign * x * x; self.sty += sign * x * y
+
+    def push(self, t: float, y: float):
+        if self._origin is None or t - self._origin > 24 * 3600:
+            self._rebase(t)
+        self._points.append((t, y)); self._add(t, y, 1)
+        cutoff = t - self.window_s
+        while self._points[0][0] < cutoff:
+            old_t, old_y = self._points.popleft(); self._add(old_t, old_y, -1)
+
+    def _rebase(self, t: float):
+        """Recalcular las sumas con un origen nuevo (una vez al día)"""
+        self._origin = self._points[0][0] if self._points else t
+        self.n = 0; self.st = self.sy = self.stt = self.sty = 0.0
+        for old_t, old_y in self._points: self._add(old_t, old_y, 1)
+
+    def slope(self) -> float:
+        denom = self.n * self.stt - self.st * self.st
+        if self.n < 3 or denom <= 1e-12:
+            return math.nan
+        return (self.n * self.sty - self.st * self.sy) / denom
+
+class HiveFeatureState:
+    """Ventanas de una colmena"""
+    def __init__(self):
+        self.last_t = None
+        self.weights = deque() # (t, kg) de las últimas 24 h
+        self.t_in = _SlidingExtremes(SPREAD_WINDOW_S)
+        self.co2 = _SlidingRegression(CO2_WINDOW_S)
+        self.audio_ewma = math.nan
+        self.audio_t = None
+        self.last_rollup = 0.0
+
+    def update(self, t: float, row: dict) -> Dict[str, float]:
+        t = max(t, self.last_t or t) # Mensajes fuera de orden se tratan como actuales
+        self.last_t = t
+
+        weight = row.get('weight_kg')
+        if weight is not None:
+            self.weights.append((t, float(weight)))
+            while self.weights[0][0] < t - WEIGHT_WINDOW_S: self.weights.popleft()
+        t_in = row.get('t_in_c')
+        if t_in is not None: self.t_in.push(t, float(t_in))
+        co2 = row.get('co2_ppm')
+        if co2 is not None: self.co2.push(t, float(co2))
+        audio = row.get('audio_200_400')
+        if audio is not None:
+            if self.audio_t is None or math.isnan(self.audio_ewma):
+                self.audio_ewma = float(audio)
+            else:
+                alpha = 1.0 - math.exp(-max(t - self.audio_t, 0.0) / AUDIO_TAU_S) # Tolera muestreo irregular
+                self.audio_ewma += alpha * (float(audio) - self.audio_ewma)
+            self.audio_t = t
+        return self.features()
+
+    def features(self) -> Dict[str, float]:
+        d24h = math.nan
+        if self.weights and self.weights[-1][0] - self.weights[0][0] >= MIN_COVERAGE * WEIGHT_WINDOW_S:
+            d24h = (self.weights[-1][1] - self.weights[0][1]) * 1000.0
+        return {'d24h_g': d24h, 't_in_spread_1h': self.t_in.spread(),
+                'audio_ewma': self.audio_ewma, 'co2_slope_ppm_h': self.co2.slope()}
+
+class FeatureEngine:
+    """Estado de ventanas por colmena; un solo hilo actualiza (el micro-batcher)"""
+    def __init__(self, rollup_interval: float = 300.0):
+        self.rollup_interval = rollup_interval
+        self.hives: Dict[str, HiveFeatureState] = {}
+        self._rollup_order = deque() # hive_ids por last_rollup ascendente: sólo se miran las vencidas
+
+    def update(self, hive_id: str, row: dict, t: Optional[float] = None) -> Dict[str, float]:
+        state = self.hives.get(hive_id)
+        if state is None:
+            state = self.hives[hive_id] = HiveFeatureState()
+            self._rollup_order.appendleft(hive_id) # last_rollup = 0: la más atrasada
+        return state.update(t if t is not None else message_time(row), row)
+
+    def due_rollups(self, now: Optional[float] = None) -> List[Tuple[str, float, Dict[str, float]]]:
+        """(hive_id, t, features) de las colmenas cuyo último rollup es más viejo que rollup_interval"""
+        now = now if now is not None else time.time()
+        due = []
+        while self._rollup_order:
+            state = self.hives[self._rollup_order[0]]
+            if now - state.last_rollup < self.rollup_interval: break
+            hive_id = self._rollup_order.popleft()
+            state.last_rollup = now; self._rollup_order.append(hive_id)
+            due.append((hive_id, state.last_t, state.features()))
+        return due
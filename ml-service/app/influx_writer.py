@@ -0,0 +1,233 @@
+"""
+Batched background writer for InfluxDB
+Buffers line-protocol points, flushes by size or interval, retries with backoff and spills to disk
+"""
+
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+def _escape_key(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def _format_field(value) -> str:
+    if hasattr(value, 'item'): # Escalares NumPy antes que float: np.float64 hereda de float y su repr no es line protocol
+        value = value.item()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def to_line_protocol(measurement: str, tags: Dict[str, str], fields: Dict[str, object], ts_ns: int) -> str:
+    """Un punto en line protocol (precisión ns)"""
+    measurement = str(measurement).replace(',', '\\,').replace(' ', '\\ ')
+    tag_str = ''.join(f",{_escape_key(k)}={_escape_key(v)}" for k, v in sorted(tags.items()) if v != '')
+    field_str = ','.join(f"{_escape_key(k)}={_format_field(v)}" for k, v in fields.items() if v is not None)
+    return f"{measurement}{tag_str} {field_str} {ts_ns}"
+
+class AsyncInfluxBatchWriter:
+    """Pipeline de escritura como tarea del event loop, con spool local cuando InfluxDB no responde.
+    Con InfluxDBClientAsync escribe por aiohttp; con un cliente síncrono la llamada HTTP va al executor"""
+    def __init__(self, client, bucket: str, org: str, batch_size: int = 500, flush_interval: float = 1.0,
+                 max_queue: int = 100000, max_retries: int = 3, backoff_initial: float = 0.5,
+                 spool_dir: Optional[str] = None, max_spool_mb: float = 256, stats_interval: float = 60.0):
+        self.client = client
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff_initial = backoff_initial
+        self.spool_dir = spool_dir
+        self.max_spool_bytes = max_spool_mb * 1024 * 1024
+        self.stats_interval = stats_interval # stats() al log y como punto propio (ml_writer_stats); 0 lo desactiva
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._wake = asyncio.Event() # Lote completo o parada: el loop no espera al deadline
+        self._stopping = False
+        self._write_api = None
+        self._task = None
+        self._next_replay = 0.0
+        self._replay_backoff = backoff_initial
+        self._next_stats = time.monotonic() + stats_interval
+
+        # Métricas
+        self.points_written = 0
+        self.points_dropped = 0
+        self.batches_spooled = 0
+        self.last_flush_latency_ms = 0.0
+        self.write_errors = 0
+
+    def start(self):
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        self._stopping = True; self._wake.set()
+        if self._task is None: return
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"InfluxDB writer did not flush within {timeout}s, {self._queue.qsize()} points pending")
+
+    def write(self, measurement: str, tags: Dict[str, str], fields: Dict[str, object],
+              ts_ns: Optional[int] = None) -> bool:
+        """Encolar un punto sin bloquear (desde el event loop); despierta al writer sólo con un lote completo"""
+        line = to_line_protocol(measurement, tags, fields, ts_ns if ts_ns is not None else time.time_ns())
+        try:
+            self._queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.points_dropped += 1
+            return False
+        if self._queue.qsize() >= self.batch_size: self._wake.set()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self._queue.qsize(), 'points_written': self.points_written,
+            'points_dropped': self.points_dropped, 'batches_spooled': self.batches_spooled,
+            'spool_files': len(self._spool_files()), 'last_flush_latency_ms': round(self.last_flush_latency_ms, 1),
+            'write_errors': self.write_errors
+        }
+
+    def _is_async(self) -> bool:
+        try:
+            from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+        except ImportError:
+            return False
+        return isinstance(self.client, InfluxDBClientAsync)
+
+    def _get_write_api(self):
+        if self._write_api is None:
+            try:
+                from influxdb_client.client.write_api import SYNCHRONOUS
+                self._write_api = self.client.write_api(write_options=SYNCHRONOUS) # El batching lo hacemos aquí
+            except ImportError:
+                self._write_api = self.client.write_api()
+        return self._write_api
+
+    async def _write(self, body: str):
+        if self._is_async():
+            if self._write_api is None: self._write_api = self.client.write_api()
+            if not await self._write_api.write(bucket=self.bucket, org=self.org, record=body, write_precision='ns'):
+                raise IOError("InfluxDB rejected the batch")
+            return
+        write = partial(self._get_write_api().write, bucket=self.bucket, org=self.org, record=body, write_precision='ns')
+        await asyncio.get_running_loop().run_in_executor(None, write)
+
+    async def _send(self, lines: List[str]) -> bool:
+        """Escribir un lote con reintentos y backoff exponencial"""
+        body = "\n".join(lines)
+        backoff = self.backoff_initial
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                await self._write(body)
+                self.last_flush_latency_ms = (time.perf_counter() - started) * 1000
+                self.points_written += len(lines)
+                return True
+            except Exception as e:
+                self.write_errors += 1
+                if attempt == self.max_retries:
+                    logger.error(f"InfluxDB write failed after {attempt + 1} attempts: {e}")
+                    return False
+                if self._stopping:
+                    return False # Apagando: no seguir reintentando, el lote va al spool
+                await asyncio.sleep(backoff)
+                backoff *= 2
+        return False
+
+    # Spool en disco: métodos síncronos que corren en el executor (ver _io)
+    async def _io(self, fn, *args):
+        """Disco (listdir, spool, lecturas) en el executor: un disco lento no frena al event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def _spool_files(self) -> List[str]:
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(f for f in os.listdir(self.spool_dir) if f.endswith('.lp'))
+
+    def _spool(self, lines: List[str]):
+        if not self.spool_dir:
+            self.points_dropped += len(lines)
+            return
+        path = os.path.join(self.spool_dir, f"{time.time_ns():020d}.lp")
+        with open(path, 'w') as f:
+            f.write("\n".join(lines))
+        self.batches_spooled += 1
+        self._trim_spool()
+
+    def _trim_spool(self):
+        """Respetar max_spool_mb descartando los lotes más antiguos"""
+        files = self._spool_files()
+        sizes = {f: os.path.getsize(os.path.join(self.spool_dir, f)) for f in files}
+        total = sum(sizes.values())
+        for f in files:
+            if total <= self.max_spool_bytes: break
+            os.remove(os.path.join(self.spool_dir, f)); total -= sizes[f]
+            logger.warning(f"Spool over {self.max_spool_bytes / 1e6:.0f} MB, dropped oldest batch {f}")
+
+    @staticmethod
+    def _read_lines(path: str) -> List[str]:
+        with open(path) as fh:
+            return fh.read().splitlines()
+
+    async def _replay_spool(self) -> bool:
+        """Reenviar en orden los lotes guardados; se detiene en el primer fallo"""
+        for f in await self._io(self._spool_files):
+            path = os.path.join(self.spool_dir, f)
+            lines = await self._io(self._read_lines, path)
+            if lines and not await self._send(lines):
+                self._next_replay = time.monotonic() + self._replay_backoff
+                self._replay_backoff = min(self._replay_backoff * 2, 60.0)
+                return False
+            await self._io(os.remove, path)
+            logger.info(f"Replayed {len(lines)} spooled points from {f}")
+        self._replay_backoff = self.backoff_initial
+        return True
+
+    def _can_replay(self) -> bool:
+        return time.monotonic() >= self._next_replay
+
+    async def _flush(self, lines: List[str]):
+        if await self._io(self._spool_files) and not (self._can_replay() and await self._replay_spool()):
+            await self._io(self._spool, lines) # Mantener el orden: lo nuevo va detrás del spool pendiente
+            return
+        if not await self._send(lines):
+            await self._io(self._spool, lines)
+
+    async def _emit_stats(self):
+        stats = await self._io(self.stats) # listdir del spool fuera del loop
+        logger.info(f"InfluxDB writer: {stats}")
+        self.write("ml_writer_stats", {}, stats)
+        self._next_stats = time.monotonic() + self.stats_interval
+
+    async def _run(self):
+        buffer: List[str] = []
+        deadline = time.monotonic() + self.flush_interval
+        while not self._stopping or not self._queue.empty():
+            while len(buffer) < self.batch_size:
+                try: buffer.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty: break
+            if len(buffer) >= self.batch_size or time.monotonic() >= deadline or self._stopping:
+                if buffer:
+                    await self._flush(buffer); buffer = []
+                elif self._can_replay() and await self._io(self._spool_files):
+                    await self._replay_spool() # Sin tráfico nuevo: drenar el spool cuando vuelva la conexión
+                deadline = time.monotonic() + self.flush_interval
+                if self.stats_interval > 0 and time.monotonic() >= self._next_stats: await self._emit_stats()
+            else:
+                # Dormir hasta el deadline o hasta que write()/stop() despierten: sin sondeo en reposo
+                self._wake.clear()
+                try: await asyncio.wait_for(self._wake.wait(), max(deadline - time.monotonic(), 0.0))
+                except asyncio.TimeoutError: pass
+        if buffer:
+            await self._flush(buffer)
@@ -0,0 +1,122 @@
+"""
+Lazy per-hive model store
+Loads ensembles on first use, keeps an LRU set under a memory budget and hot-reloads changed files
+"""
+
+import os
+import time
+import logging
+import threading
+import joblib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MODEL_SUFFIX = "_ensemble.pkl"
+
+class _Entry:
+    __slots__ = ('model', 'mtime', 'size', 'checked')
+    def __init__(self, model, mtime, size):
+        self.model = model; self.mtime = mtime; self.size = size
+        self.checked = time.monotonic()
+
+class ModelStore:
+    """Modelos ensemble por colmena cargados bajo demanda (LRU por presupuesto de memoria)"""
+    def __init__(self, models_dir: str, memory_budget_mb: float = 512, mmap: bool = True,
+                 reload_check_interval: float = 10.0, on_load: Optional[Callable[[Any], Any]] = None):
+        self.models_dir = models_dir
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.mmap_mode = 'r' if mmap else None # Arreglos grandes compartidos entre procesos vía page cache
+        self.reload_check_interval = reload_check_interval
+        self.on_load = on_load # Preparación única por carga (p. ej. compilar), bajo el lock: nunca dos veces a la vez
+        self._cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._resident = 0
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+    def path_for(self, hive_id: str) -> str:
+        return os.path.join(self.models_dir, f"{hive_id}{MODEL_SUFFIX}")
+
+    def available(self) -> List[str]:
+        """Colmenas con modelo en disco (sin cargarlos)"""
+        if not os.path.isdir(self.models_dir):
+            return []
+        return sorted(f[:-len(MODEL_SUFFIX)] for f in os.listdir(self.models_dir) if f.endswith(MODEL_SUFFIX))
+
+    def _load(self, hive_id: str, path: str, stat: os.stat_result) -> Optional[_Entry]:
+        try:
+            # joblib lee también los pickles antiguos; los arreglos guardados con joblib se mapean en memoria
+            model = joblib.load(path, mmap_mode=self.mmap_mode)
+            if self.on_load is not None: model = self.on_load(model)
+        except Exception as e:
+            logger.error(f"Error loading model for {hive_id}: {e}")
+            return None
+        self.loads += 1
+        logger.info(f"Loaded ensemble model for {hive_id}")
+        return _Entry(model, stat.st_mtime_ns, stat.st_size)
+
+    def _evict(self):
+        while self._resident > self.memory_budget and len(self._cache) > 1:
+            hive_id, entry = self._cache.popitem(last=False)
+            self._resident -= entry.size; self.evictions += 1
+            logger.info(f"Evicted model for {hive_id} (resident {self._resident / 1e6:.1f} MB)")
+
+    def get(self, hive_id: str) -> Optional[Dict[str, Any]]:
+        """Modelo de la colmena o None; recarga si el archivo cambió en disco"""
+        with self._lock:
+            entry = self._cache.get(hive_id)
+            now = time.monotonic()
+            if entry is not None and now - entry.checked < self.reload_check_interval:
+                self._cache.move_to_end(hive_id)
+                return entry.model
+
+            path = self.path_for(hive_id)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                if entry is not None: # Archivo borrado: olvidar el modelo
+                    self._resident -= entry.size; del self._cache[hive_id]
+                return None
+
+            if entry is not None and entry.mtime == stat.st_mtime_ns:
+                entry.checked = now
+                self._cache.move_to_end(hive_id)
+                return entry.model
+
+            if entry is not None:
+                logger.info(f"Model file for {hive_id} changed, reloading")
+            new_entry = self._load(hive_id, path, stat)
+            if new_entry is None:
+                return entry.model if entry is not None else None
+            if entry is not None:
+                self._resident -= entry.size
+            self._cache[hive_id] = new_entry; self._cache.move_to_end(hive_id)
+            self._resident += new_entry.size
+            self._evict()
+            return new_entry.model
+
+    def save(self, hive_id: str, model_info: Dict[str, Any]) -> str:
+        """Persistir con joblib (sin compresión para permitir mmap) y publicar atómicamente"""
+        os.makedirs(self.models_dir, exist_ok=True)
+        path = self.path_for(hive_id)
+        tmp = f"{path}.tmp.{os.getpid()}"
+        joblib.dump(model_info, tmp)
+        os.replace(tmp, path)
+        return path
+
+    def __contains__(self, hive_id: str) -> bool:
+        return hive_id in self._cache or os.path.exists(self.path_for(hive_id))
+
+    def __getitem__(self, hive_id: str) -> Dict[str, Any]:
+        model = self.get(hive_id)
+        if model is None:
+            raise KeyError(hive_id)
+        return model
+
+    def stats(self) -> dict:
+        return {
+            'resident_models': len(self._cache), 'resident_mb': round(self._resident / 1e6, 1),
+            'loads': self.loads, 'evictions': self.evictions
+        }
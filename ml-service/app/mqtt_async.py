@@ -0,0 +1,165 @@
+"""
+Asyncio MQTT client
+Drives paho-mqtt from the event loop through its socket callbacks: no network thread, and a
+bounded inbox that pauses socket reads (TCP backpressure) when consumers fall behind
+"""
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Iterable, Optional, Tuple
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+class AsyncMqttClient:
+    """paho en modo loop externo: el event loop lee/escribe el socket y llama a loop_misc"""
+    def __init__(self, host: str, port: int = 1883, keepalive: int = 60, username: Optional[str] = None,
+                 password: Optional[str] = None, topics: Iterable[Tuple[str, int]] = (), max_inbox: int = 10000,
+                 reconnect_max: float = 30.0):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.topics = list(topics) # Suscripciones con comodín: un solo filtro para miles de colmenas
+        self.reconnect_max = reconnect_max
+        self.client = mqtt.Client()
+        if username: self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=max_inbox)
+        self.connected = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._backlog = deque() # Mensajes ya leídos del socket mientras la inbox estaba llena
+        self._paused = False
+        self._reading = True
+        self._sock = None # fd registrado en el event loop
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread = None
+        self._misc_task = None
+        self._stopping = False
+        self.pauses = 0
+
+    async def start(self):
+        """Conectar (DNS/TCP en el executor) y arrancar el mantenimiento; reintenta en segundo plano"""
+        self._loop = asyncio.get_running_loop(); self._loop_thread = threading.get_ident()
+        try:
+            await self._loop.run_in_executor(None, self.client.connect, self.host, self.port, self.keepalive)
+        except OSError as e:
+            logger.error(f"MQTT connect to {self.host}:{self.port} failed: {e}, retrying")
+        self._misc_task = self._loop.create_task(self._misc())
+
+    async def stop(self, timeout: float = 2.0):
+        self._stopping = True
+        if self._misc_task:
+            self._misc_task.cancel()
+            try: await self._misc_task
+            except asyncio.CancelledError: pass
+        if self._sock is not None:
+            self._closed.clear()
+            self.client.disconnect()
+            try: await asyncio.wait_for(self._closed.wait(), timeout)
+            except asyncio.TimeoutError: logger.warning("MQTT disconnect timed out")
+
+    def stop_reading(self):
+        """Apagado: no aceptar mensajes nuevos; las publicaciones (alertas) siguen saliendo"""
+        self._reading = False
+        if self._sock is not None: self._loop.remove_reader(self._sock)
+
+    async def close_inbox(self):
+        """Marcar el fin de la inbox con None detrás de todo lo ya leído (llamar tras stop_reading)"""
+        if self._backlog: self._backlog.append(None)
+        else: await self.inbox.put(None)
+
+    def publish(self, topic: str, payload, qos: int = 0):
+        """No bloquea: paho encola el paquete y el event loop lo escribe cuando el socket acepta"""
+        return self.client.publish(topic, payload, qos=qos)
+
+    async def _misc(self):
+        """Keepalive y reconexión con backoff (el trabajo que haría el hilo de loop_start)"""
+        backoff = 1.0
+        while True:
+            await asyncio.sleep(1.0)
+            if self._sock is not None and self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                backoff = 1.0
+                continue
+            if self._sock is not None: continue # Cerrando: on_socket_close llegará enseguida
+            try:
+                await self._loop.run_in_executor(None, self.client.reconnect)
+                logger.info("MQTT reconnecting")
+            except OSError as e:
+                logger.warning(f"MQTT reconnect failed: {e}, next attempt in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.reconnect_max)
+
+    # Callbacks de socket: durante connect()/reconnect() llegan desde el executor. Se guarda el fd
+    # en el momento, porque paho cierra el socket justo después de on_socket_close
+    def _call(self, fn, *args):
+        if threading.get_ident() == self._loop_thread: fn(*args)
+        else: self._loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._attach, sock.fileno())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._detach, sock.fileno())
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self._loop.add_writer, sock.fileno(), self._write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._loop.remove_writer, sock.fileno())
+
+    def _attach(self, fd: int):
+        self._sock = fd
+        if self._reading and not self._paused: self._loop.add_reader(fd, self._read)
+
+    def _detach(self, fd: int):
+        self._loop.remove_reader(fd); self._loop.remove_writer(fd)
+        if self._sock == fd: self._sock = None
+        self.connected.clear(); self._closed.set()
+
+    def _read(self):
+        self.client.loop_read()
+
+    def _write(self):
+        self.client.loop_write()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection failed with code {rc}")
+            return
+        logger.info("MQTT connected successfully")
+        if self.topics: client.subscribe(self.topics)
+        self.connected.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if not self._stopping: logger.warning(f"MQTT disconnected (rc={rc})")
+
+    def _on_message(self, client, userdata, msg):
+        if not self._backlog:
+            try:
+                self.inbox.put_nowait(msg)
+                return
+            except asyncio.QueueFull:
+                pass
+        self._backlog.append(msg)
+        if not self._paused:
+            # Dejar de leer el socket: el broker y TCP retienen el resto hasta que la inbox drene
+            self._paused = True; self.pauses += 1
+            if self._sock is not None: self._loop.remove_reader(self._sock)
+            self._loop.create_task(self._drain_backlog())
+
+    async def _drain_backlog(self):
+        while self._backlog:
+            # Sacar del backlog sólo ya encolado: cada mensaje está siempre en uno de los dos
+            await self.inbox.put(self._backlog[0]); self._backlog.popleft()
+        self._paused = False
+        if self._reading and self._sock is not None: self._loop.add_reader(self._sock, self._read)
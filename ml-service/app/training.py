@@ -0,0 +1,198 @@
+"""
+Ensemble training pipeline
+Trains hives in parallel across a process pool with time-chunked InfluxDB reads and warm starts
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sklearn.ensemble import IsolationForest, RandomForestClassifier
+from sklearn.svm import OneClassSVM
+from sklearn.preprocessing import StandardScaler
+
+from .model_store import ModelStore
+from .features import FeatureEngine, ROLLING_FEATURES, WEIGHT_WINDOW_S
+from .compiled_trees import compile_ensemble, fit_vote_scales, rf_normal_index
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ['weight_kg', 't_in_c', 'co2_ppm', 'audio_200_400', 'acc_rms', 'tilt_deg', 'batt_v']
+MODEL_FEATURES = FEATURES + ROLLING_FEATURES # Las ventanas se calculan con el mismo FeatureEngine que en vivo
+
+TREES_PER_INCREMENT = 25 # Árboles nuevos por warm start
+MAX_TREES = 300 # Al superarlo se reentrena desde cero
+RESERVOIR_SIZE = 5000 # Muestra acotada de datos escalados guardada en el checkpoint
+MIN_ROWS = 50
+
+def flux_string(value: str) -> str:
+    """Literal de cadena Flux: hive_id viene de un tópico MQTT, no se interpola sin escapar"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${') + '"'
+
+def stream_history(query_api, hive_id: str, start: datetime, stop: datetime,
+                   chunk: timedelta = timedelta(days=1),
+                   features: List[str] = FEATURES) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Leer el histórico por ventanas de tiempo con query_stream; (segundos epoch, arreglo (n, features)) por ventana"""
+    field_set = ", ".join(f'"{f}"' for f in features)
+    cursor = start
+    while cursor < stop:
+        chunk_stop = min(cursor + chunk, stop)
+        query = f'''
+            from(bucket: "telemetry")
+                |> range(start: {cursor.isoformat()}, stop: {chunk_stop.isoformat()})
+                |> filter(fn: (r) => r._measurement == "hive_telemetry" and r.hive_id == {flux_string(hive_id)})
+                |> filter(fn: (r) => contains(value: r._field, set: [{field_set}]))
+                |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+        '''
+        times, rows = [], []
+        for record in query_api.query_stream(query, org="apiary"):
+            times.append(record.get_time().timestamp())
+            rows.append([record.values.get(f) for f in features])
+        if rows:
+            yield np.array(times), np.array(rows, dtype=np.float64) # Campos ausentes quedan como NaN
+        cursor = chunk_stop
+
+def telemetry_hives(query_api=None, days: int = 30) -> List[str]:
+    """Colmenas con telemetría en los últimos días (valores del tag hive_id), tengan modelo o no"""
+    if query_api is None:
+        from influxdb_client import InfluxDBClient
+        client = InfluxDBClient(url=os.getenv("INFLUX_URL", "http://influxdb:8086"),
+                                token=os.getenv("INFLUX_TOKEN"), org="apiary")
+        query_api = client.query_api()
+    query = f'''
+        import "influxdata/influxdb/schema"
+        schema.tagValues(bucket: "telemetry", tag: "hive_id", start: -{int(days)}d,
+                         predicate: (r) => r._measurement == "hive_telemetry")
+    '''
+    return sorted(str(record.get_value()) for record in query_api.query_stream(query, org="apiary"))
+
+def rolling_columns(engine: FeatureEngine, hive_id: str, times: np.ndarray, X: np.ndarray) -> np.ndarray:
+    """Reproducir los mensajes por el FeatureEngine: columnas ROLLING_FEATURES alineadas con X"""
+    out = np.empty((len(X), len(ROLLING_FEATURES)))
+    for i, (t, values) in enumerate(zip(times, X)):
+        row = {f: v for f, v in zip(FEATURES, values) if not np.isnan(v)}
+        feats = engine.update(hive_id, row, t=float(t))
+        out[i] = [feats[f] for f in ROLLING_FEATURES]
+    return out
+
+def _update_reservoir(reservoir: Optional[np.ndarray], seen: int, X: np.ndarray,
+                      rng: np.random.Generator) -> np.ndarray:
+    """Muestreo por reservorio (algoritmo R) vectorizado por bloque"""
+    if reservoir is None or len(reservoir) == 0:
+        reservoir = np.empty((0, X.shape[1]))
+    free = max(RESERVOIR_SIZE - len(reservoir), 0)
+    reservoir = np.vstack([reservoir, X[:free]])
+    rest = X[free:]
+    if len(rest):
+        positions = seen + free + np.arange(len(rest))
+        slots = (rng.random(len(rest)) * (positions + 1)).astype(np.int64)
+        hit = slots < RESERVOIR_SIZE
+        reservoir = reservoir.copy()
+        reservoir[slots[hit]] = rest[hit]
+    return reservoir
+
+def _fit_full(X: np.ndarray, seed: int = 42) -> Dict:
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    iso = IsolationForest(n_estimators=100, contamination='auto', random_state=seed).fit(X_scaled)
+    labels = iso.predict(X_scaled)
+    sample = X_scaled[np.random.default_rng(seed).permutation(len(X_scaled))[:RESERVOIR_SIZE]]
+    svm = OneClassSVM(nu=0.05, gamma='scale').fit(sample)
+    rf = RandomForestClassifier(n_estimators=100, random_state=seed, n_jobs=1).fit(X_scaled, labels)
+    return {
+        'features': MODEL_FEATURES, 'scaler': scaler, 'isolation_forest': iso,
+        'one_class_svm': svm, 'random_forest': rf, 'reservoir': sample, 'rows_seen': len(X)
+    }
+
+def _fit_incremental(model_info: Dict, X: np.ndarray, seed: int = 42) -> Dict:
+    """Warm start: nuevos árboles sólo con los datos nuevos; OCSVM sobre reservorio + nuevos"""
+    scaler = model_info['scaler'] # Congelado: los árboles existentes viven en este espacio
+    X_scaled = scaler.transform(X)
+
+    iso = model_info['isolation_forest']
+    iso.set_params(warm_start=True, n_estimators=iso.n_estimators + TREES_PER_INCREMENT)
+    iso.fit(X_scaled)
+    labels = iso.predict(X_scaled)
+
+    rf = model_info['random_forest']
+    if len(np.unique(labels)) == len(rf.classes_):
+        rf.set_params(warm_start=True, n_estimators=rf.n_estimators + TREES_PER_INCREMENT)
+        rf.fit(X_scaled, labels)
+    elif rf_normal_index(rf) is None and len(np.unique(labels)) > 1:
+        # El RF de una sola clase no votaba: con ambas clases ya se puede entrenar
+        rf = RandomForestClassifier(n_estimators=100, random_state=seed, n_jobs=1).fit(X_scaled, labels)
+
+    rng = np.random.default_rng(seed + model_info.get('rows_seen', 0))
+    reservoir = _update_reservoir(model_info.get('reservoir'), model_info.get('rows_seen', 0), X_scaled, rng)
+    svm = OneClassSVM(nu=0.05, gamma='scale').fit(reservoir)
+
+    model_info.update({
+        'isolation_forest': iso, 'random_forest': rf, 'one_class_svm': svm,
+        'reservoir': reservoir, 'rows_seen': model_info.get('rows_seen', 0) + len(X)
+    })
+    return model_info
+
+def train_hive(hive_id: str, days: int, models_dir: str, full: bool = False, query_api=None) -> Dict:
+    """Entrenar (o continuar) el modelo de una colmena; corre dentro de un proceso worker"""
+    started = time.perf_counter()
+    if query_api is None:
+        from influxdb_client import InfluxDBClient
+        client = InfluxDBClient(url=os.getenv("INFLUX_URL", "http://influxdb:8086"),
+                                token=os.getenv("INFLUX_TOKEN"), org="apiary")
+        query_api = client.query_api()
+
+    store = ModelStore(models_dir, mmap=False) # Se modifica el modelo: sin arreglos de sólo lectura
+    now = datetime.now(timezone.utc)
+    checkpoint = None if full else store.get(hive_id)
+    trees = checkpoint['isolation_forest'].n_estimators if checkpoint else 0
+    warm = bool(checkpoint and 'trained_until' in checkpoint and trees + TREES_PER_INCREMENT <= MAX_TREES
+                and list(checkpoint.get('features', [])) == MODEL_FEATURES) # Otro juego de features: desde cero
+    start = checkpoint['trained_until'] if warm else now - timedelta(days=days)
+
+    # Las ventanas necesitan 24 h previas al inicio para estar completas desde la primera fila
+    engine = FeatureEngine(); chunks = []
+    for times, raw in stream_history(query_api, hive_id, start - timedelta(seconds=WEIGHT_WINDOW_S), now):
+        X = np.hstack([raw, rolling_columns(engine, hive_id, times, raw)])[times >= start.timestamp()]
+        chunks.append(X[~np.isnan(X).any(axis=1)]) # Filas incompletas no sirven para entrenar
+    X = np.vstack(chunks) if chunks else np.empty((0, len(MODEL_FEATURES)))
+    result = {'hive_id': hive_id, 'mode': 'incremental' if warm else 'full', 'rows': len(X)}
+
+    if len(X) < MIN_ROWS:
+        result.update(status='skipped', duration_s=time.perf_counter() - started)
+        return result
+
+    model_info = _fit_incremental(checkpoint, X) if warm else _fit_full(X)
+    model_info['trained_until'] = now
+    model_info['trained_at'] = now.isoformat()
+    model_info['vote_scales'] = fit_vote_scales(model_info)
+    model_info['compiled'] = compile_ensemble(model_info) # Verificado contra sklearn; None = usar sklearn
+    store.save(hive_id, model_info)
+    result.update(status='trained', duration_s=time.perf_counter() - started)
+    return result
+
+class TrainingScheduler:
+    """Entrena muchas colmenas en paralelo en un pool de procesos"""
+    def __init__(self, models_dir: str, max_workers: Optional[int] = None):
+        self.models_dir = models_dir
+        self.max_workers = max_workers or int(os.getenv("TRAINING_WORKERS", str(os.cpu_count() or 1)))
+
+    def train_all(self, hive_ids: List[str], days: int = 30, full: bool = False) -> List[Dict]:
+        results = []
+        # spawn: se llama desde un hilo del servicio asyncio; un fork heredaría locks tomados por otros hilos
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(train_hive, h, days, self.models_dir, full): h for h in hive_ids}
+            for future in as_completed(futures):
+                hive_id = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'hive_id': hive_id, 'status': 'failed', 'error': str(e), 'duration_s': 0.0}
+                    logger.error(f"Training failed for {hive_id}: {e}")
+                results.append(result)
+                logger.info(f"Training {result['status']} for {hive_id} in {result['duration_s']:.1f}s")
+        return results
@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the ML anomaly service
+"""
+
+import unittest
+import numpy as np
+import os
+import json
+import asyncio
+import sys
+import shutil
+import tempfile
+import re
+import struct
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+# Añadir el directorio padre al path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app.batching import AsyncMicroBatcher
+from app.model_store import ModelStore
+from app.influx_writer import AsyncInfluxBatchWriter, to_line_protocol
+from app.mqtt_async import AsyncMqttClient
+from app.compiled_trees import (TOLERANCE, combine_votes, compile_ensemble, ensure_compiled, fit_vote_scales,
+                                sklearn_votes)
+from app.training import (FEATURES, MODEL_FEATURES, TREES_PER_INCREMENT, _fit_full, _update_reservoir, stream_history,
+                          train_hive)
+from app.features import (AUDIO_TAU_S, CO2_WINDOW_S, MIN_COVERAGE, SPREAD_WINDOW_S, WEIGHT_WINDOW_S,
+                          FeatureEngine)
+from app.ensemble_detector import EnsembleAnomalyDetector
+
+def synthetic_history(n: int = 600, seed: int = 0) -> np.ndarray:
+    """Telemetría normal alrededor de valores típicos de una colmena"""
+    rng = np.random.default_rng(seed)
+    center = np.array([45.0, 34.5, 900.0, 0.3, 0.02, 1.0, 3.9, 150.0, 0.4, 0.3, 5.0])
+    spread = np.array([1.5, 0.4, 80.0, 0.05, 0.005, 0.3, 0.05, 60.0, 0.1, 0.05, 3.0])
+    return center + rng.normal(size=(n, len(center))) * spread
+
+def fit_model(X: np.ndarray) -> dict:
+    model_info = _fit_full(X)
+    model_info['vote_scales'] = fit_vote_scales(model_info)
+    model_info['compiled'] = compile_ensemble(model_info)
+    return model_info
+
+class TestAsyncMicroBatcher(unittest.TestCase):
+    """Test the micro-batching stage"""
+
+    def test_groups_by_key(self):
+        """Test messages inside one window reach the handler once per hive, in arrival order"""
+        calls = []
+        async def handler(key, items): calls.append((key, items))
+        async def run():
+            batcher = AsyncMicroBatcher(handler, window_ms=100)
+            for key, item in [('A', 1), ('B', 1), ('A', 2), ('A', 3), ('B', 2), ('C', 1)]:
+                await batcher.put(key, item)
+            batcher.start(); await batcher.stop()
+            return batcher
+        batcher = asyncio.run(run())
+        self.assertEqual(sorted(calls), [('A', [1, 2, 3]), ('B', [1, 2]), ('C', [1])])
+        self.assertEqual(batcher.processed, 6)
+
+    def test_full_queue_drops_and_handler_errors_are_contained(self):
+        """Test submit never waits and a failing group does not stop the others"""
+        seen = []
+        async def handler(key, items):
+            if key == 'BAD': raise RuntimeError("boom")
+            seen.append((key, items))
+        async def run():
+            batcher = AsyncMicroBatcher(handler, max_queue=2, window_ms=50)
+            self.assertTrue(batcher.submit('BAD', 1))
+            self.assertTrue(batcher.submit('OK', 1))
+            self.assertFalse(batcher.submit('OK', 2))
+            batcher.start(); await batcher.stop()
+            return batcher
+        batcher = asyncio.run(run())
+        self.assertEqual(seen, [('OK', [1])])
+        self.assertEqual((batcher.dropped, batcher.processed), (1, 2))
+
+    def test_one_batch_per_key_in_flight(self):
+        """Test batches of one hive never overlap and keep their order while other hives run in parallel"""
+        running = {}; overlaps = []; seen = {'A': [], 'B': []}; peak = [0]
+        async def handler(key, items):
+            if running.get(key): overlaps.append(key)
+            running[key] = True; peak[0] = max(peak[0], sum(running.values()))
+            await asyncio.sleep(0.02) # Como el scoring en el pool: otros lotes avanzan mientras tanto
+            seen[key].extend(items); running[key] = False
+        async def run():
+            batcher = AsyncMicroBatcher(handler, max_batch=8, window_ms=1, max_inflight=4)
+            batcher.start()
+            for i in range(200):
+                await batcher.put('A', i); await batcher.put('B', i)
+                if i % 10 == 0: await asyncio.sleep(0.005)
+            await batcher.stop()
+        asyncio.run(run())
+        self.assertEqual(overlaps, [])
+        self.assertEqual(seen, {'A': list(range(200)), 'B': list(range(200))})
+        self.assertEqual(peak[0], 2)
+
+    def test_backpressure_instead_of_drops(self):
+        """Test put() waits while the handler is busy and nothing is lost"""
+        seen = []
+        async def run():
+            gate = asyncio.Event()
+            async def handler(key, items):
+                await gate.wait(); seen.extend(items)
+            batcher = AsyncMicroBatcher(handler, max_queue=4, max_batch=2, window_ms=1, max_inflight=1)
+            async def produce():
+                for i in range(30): await batcher.put(f"H{i % 3}", i)
+            batcher.start()
+            producer = asyncio.get_running_loop().create_task(produce())
+            await asyncio.sleep(0.1)
+            self.assertFalse(producer.done()) # Cola llena y una sola ranura ocupada: el productor espera
+            self.assertEqual(batcher.depth(), 4)
+            gate.set(); await producer; await batcher.stop()
+            self.assertEqual(batcher.dropped, 0)
+        asyncio.run(run())
+        self.assertEqual(sorted(seen), list(range(30)))
+
+class MiniBroker:
+    """Broker MQTT 3.1.1 mínimo para pruebas (CONNECT, SUBSCRIBE, PUBLISH QoS 0/1, PING): sin dependencias"""
+    def __init__(self):
+        self.subs = [] # (writer, filtro)
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close(); await self.server.wait_closed()
+
+    @staticmethod
+    def _match(flt, topic):
+        f, t = flt.split('/'), topic.split('/')
+        if f[-1] == '#': return t[:len(f) - 1] == f[:-1]
+        return len(f) == len(t) and all(a in ('+', b) for a, b in zip(f, t))
+
+    @staticmethod
+    def _length(n):
+        out = bytearray()
+        while True:
+            n, b = divmod(n, 128)
+            out.append(b | (128 if n else 0))
+            if not n: return bytes(out)
+
+    async def _client(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]; size, mult = 0, 1
+                while True:
+                    b = (await reader.readexactly(1))[0]; size += (b & 127) * mult; mult *= 128
+                    if not b & 128: break
+                body = await reader.readexactly(size); kind = header >> 4
+                if kind == 1: writer.write(b'\x20\x02\x00\x00') # CONNACK
+                elif kind == 8: # SUBSCRIBE -> SUBACK con QoS 0 por filtro
+                    pos, granted = 2, b''
+                    while pos < len(body):
+                        n = struct.unpack('>H', body[pos:pos + 2])[0]
+                        self.subs.append((writer, body[pos + 2:pos + 2 + n].decode())); pos += 3 + n; granted += b'\x00'
+                    writer.write(b'\x90' + self._length(2 + len(granted)) + body[:2] + granted)
+                elif kind == 3: # PUBLISH: PUBACK si QoS 1 y reenvío QoS 0 a los suscriptores
+                    n = struct.unpack('>H', body[:2])[0]; topic = body[2:2 + n].decode(); pos = 2 + n
+                    if (header >> 1) & 3: writer.write(b'\x40\x02' + body[pos:pos + 2]); pos += 2
+                    out = body[:2 + n] + body[pos:]
+                    for sub, flt in list(self.subs):
+                        if self._match(flt, topic): sub.write(b'\x30' + self._length(len(out)) + out)
+                elif kind == 12: writer.write(b'\xd0\x00') # PINGRESP
+                elif kind == 14: break # DISCONNECT
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subs = [s for s in self.subs if s[0] is not writer]; writer.close()
+
+class TestAsyncMqttClient(unittest.TestCase):
+    """Test the asyncio MQTT client against an in-process broker"""
+
+    async def _connect(self, broker, **kwargs):
+        client = AsyncMqttClient('127.0.0.1', broker.port, **kwargs)
+        await client.start()
+        await asyncio.wait_for(client.connected.wait(), 5.0)
+        return client
+
+    def test_backpressure_delivers_everything_in_order(self):
+        """Test a slow consumer pauses socket reads instead of dropping, and every message arrives in order"""
+        total = 6000
+        async def run():
+            broker = MiniBroker(); await broker.start()
+            sub = await self._connect(broker, topics=[('hives/+/telemetry', 0)], max_inbox=100)
+            pub = await self._connect(broker)
+            while not broker.subs: await asyncio.sleep(0.01)
+            for i in range(total):
+                pub.publish(f"hives/H{i % 7:03d}/telemetry", str(i))
+                if i % 500 == 0: await asyncio.sleep(0)
+            await asyncio.sleep(0.3) # Consumidor parado: la inbox se llena y se deja de leer el socket
+            self.assertEqual(sub.inbox.qsize(), 100)
+            received = []
+            while len(received) < total:
+                msg = await asyncio.wait_for(sub.inbox.get(), 5.0)
+                received.append(int(msg.payload))
+                if len(received) % 50 == 0: await asyncio.sleep(0.001) # Más lento que la red
+            await pub.stop(); await sub.stop(); await broker.stop()
+            return received, sub.pauses
+        received, pauses = asyncio.run(run())
+        self.assertEqual(received, list(range(total)))
+        self.assertGreater(pauses, 0)
+
+    def test_close_inbox_after_everything_read(self):
+        """Test shutdown marks the end of the inbox behind the paused backlog and ignores later messages"""
+        async def run():
+            broker = MiniBroker(); await broker.start()
+            sub = await self._connect(broker, topics=[('hives/#', 0)], max_inbox=5)
+            pub = await self._connect(broker)
+            while not broker.subs: await asyncio.sleep(0.01)
+            for i in range(50): pub.publish('hives/H001/telemetry', str(i))
+            await asyncio.sleep(0.2)
+            sub.stop_reading(); await sub.close_inbox()
+            for i in range(50, 60): pub.publish('hives/H001/telemetry', str(i))
+            await asyncio.sleep(0.2)
+            received = []
+            while True:
+                msg = await asyncio.wait_for(sub.inbox.get(), 5.0)
+                if msg is None: break
+                received.append(int(msg.payload))
+            await pub.stop(); await sub.stop(); await broker.stop()
+            return received
+        received = asyncio.run(run())
+        # Lo leído antes de stop_reading llega entero y en orden; nada de lo publicado después
+        self.assertEqual(received, list(range(len(received))))
+        self.assertLessEqual(len(received), 50)
+        self.assertGreater(len(received), 5)
+
+    def test_detector_shutdown_scores_everything_read(self):
+        """Test shutdown puts every message already read through the batcher, without drops"""
+        tmpdir = tempfile.mkdtemp()
+        async def run():
+            broker = MiniBroker(); await broker.start()
+            env = {'MQTT_HOST': '127.0.0.1', 'MQTT_PORT': str(broker.port), 'MQTT_INBOX_SIZE': '10',
+                   'SCORING_QUEUE_SIZE': '10', 'TRAINING_HOUR': '-1', 'MODELS_DIR': tmpdir,
+                   'INFLUX_SPOOL_DIR': os.path.join(tmpdir, 'spool')}
+            with patch.dict(os.environ, env):
+                detector = EnsembleAnomalyDetector()
+            read = [0]; on_message = detector.mqtt.client.on_message
+            def counting(client, userdata, msg):
+                read[0] += 1; on_message(client, userdata, msg)
+            detector.mqtt.client.on_message = counting
+            with patch.object(EnsembleAnomalyDetector, '_influx_client', return_value=Mock()):
+                await detector.initialize()
+            await asyncio.wait_for(detector.mqtt.connected.wait(), 5.0)
+            pub = await self._connect(broker)
+            while len(broker.subs) < 1: await asyncio.sleep(0.01)
+            for i in range(300): pub.publish(f"hives/H{i % 5:03d}/telemetry", '{"weight_kg": 40.0}')
+            await asyncio.sleep(0.05)
+            await detector.shutdown(); await pub.stop(); await broker.stop()
+            return detector, read[0]
+        try:
+            detector, read = asyncio.run(run())
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertGreater(read, 20) # Más que inbox + cola: hubo contrapresión durante el apagado
+        self.assertEqual((detector.batcher.processed, detector.batcher.dropped), (read, 0))
+
+def brute_force_features(history, t_now):
+    """Las cuatro ventanas recalculadas desde cero con todo el historial hasta t_now.
+    Cada ventana termina en la última muestra de su propio campo (así la define el engine)"""
+    def series(field):
+        pts = [(t, row[field]) for t, row in history if t <= t_now and field in row]
+        return np.array([p[0] for p in pts]), np.array([p[1] for p in pts])
+    out = {}
+    t, w = series('weight_kg')
+    keep = t >= t_now - WEIGHT_WINDOW_S
+    t, w = t[keep], w[keep]
+    out['d24h_g'] = (w[-1] - w[0]) * 1000 if len(t) and t[-1] - t[0] >= MIN_COVERAGE * WEIGHT_WINDOW_S else np.nan
+    t, v = series('t_in_c')
+    v = v[t >= t[-1] - SPREAD_WINDOW_S] if len(t) else v
+    out['t_in_spread_1h'] = v.max() - v.min() if len(v) else np.nan
+    t, a = series('audio_200_400')
+    if len(t):
+        # Forma cerrada de la EWMA con muestreo irregular: peso de cada muestra decae desde su llegada
+        alphas = np.concatenate([[1.0], 1 - np.exp(-np.diff(t) / AUDIO_TAU_S)])
+        out['audio_ewma'] = float(np.sum(alphas * a * np.exp(-(t[-1] - t) / AUDIO_TAU_S)))
+    else:
+        out['audio_ewma'] = np.nan
+    t, c = series('co2_ppm')
+    keep = t >= t[-1] - CO2_WINDOW_S if len(t) else t.astype(bool)
+    out['co2_slope_ppm_h'] = np.polyfit(t[keep] / 3600.0, c[keep], 1)[0] if keep.sum() >= 3 else np.nan
+    return out
+
+class TestRollingFeatures(unittest.TestCase):
+    """Test streaming windows against a brute-force recomputation"""
+
+    def test_windows_match_brute_force(self):
+        """Test every message over 30 h of irregular, gappy telemetry"""
+        rng = np.random.default_rng(3)
+        t0 = 1.7e9; t = t0; history = []
+        while t < t0 + 30 * 3600:
+            t += rng.uniform(30, 900) if rng.random() > 0.01 else 3 * 3600 # Huecos de varias horas
+            row = {'weight_kg': 40 + (t - t0) / 86400 + rng.normal(0, 0.05), 't_in_c': 34.5 + rng.normal(0, 0.6),
+                   'co2_ppm': 900 + 30 * np.sin((t - t0) / 5000) + rng.normal(0, 5), 'audio_200_400': rng.uniform(0.1, 0.5)}
+            history.append((t, {k: v for k, v in row.items() if rng.random() > 0.15})) # Campos ausentes
+        engine = FeatureEngine()
+        for i, (t, row) in enumerate(history):
+            feats = engine.update('H001', row, t=t)
+            if i % 7 and i != len(history) - 1: continue # El brute force es O(n): muestrear
+            expected = brute_force_features(history, t)
+            for name in ('d24h_g', 't_in_spread_1h', 'audio_ewma', 'co2_slope_ppm_h'):
+                if np.isnan(expected[name]):
+                    self.assertTrue(np.isnan(feats[name]), f"{name} at message {i}")
+                else:
+                    self.assertAlmostEqual(feats[name], expected[name], delta=1e-6 * max(1.0, abs(expected[name])),
+                                           msg=f"{name} at message {i}")
+        self.assertFalse(np.isnan(feats['d24h_g'])) # Con 30 h de historia la ventana de 24 h se llena
+
+    def test_rollups_only_visit_due_hives(self):
+        """Test each hive rolls up once per interval, oldest first"""
+        engine = FeatureEngine(rollup_interval=300)
+        for hive_id in ('A', 'B', 'C'): engine.update(hive_id, {'t_in_c': 34.0}, t=1000.0)
+        self.assertEqual(sorted(h for h, _, _ in engine.due_rollups(now=1000.0)), ['A', 'B', 'C'])
+        self.assertEqual(engine.due_rollups(now=1200.0), [])
+        engine.update('D', {'t_in_c': 34.0}, t=1250.0)
+        self.assertEqual([h for h, _, _ in engine.due_rollups(now=1250.0)], ['D'])
+        self.assertEqual(sorted(h for h, _, _ in engine.due_rollups(now=1300.0)), ['A', 'B', 'C'])
+        self.assertEqual([h for h, _, _ in engine.due_rollups(now=1550.0)], ['D'])
+
+class TestLineProtocol(unittest.TestCase):
+    """Test line protocol encoding for the batched writer"""
+
+    def test_numpy_and_python_scalars(self):
+        """Test NumPy scalars encode like their Python equivalents"""
+        fields = {'a': np.float64(1.5), 'b': 2.5, 'c': np.int64(3), 'd': 4, 'e': np.float32(0.5),
+                  'f': np.bool_(True), 'g': False, 'h': None}
+        line = to_line_protocol('m', {'hive_id': 'H001'}, fields, 1)
+        self.assertEqual(line, 'm,hive_id=H001 a=1.5,b=2.5,c=3i,d=4i,e=0.5,f=true,g=false 1')
+        self.assertNotIn('np.', line)
+
+    def test_escaping(self):
+        """Test spaces, commas, equals and quotes are escaped where line protocol needs it"""
+        line = to_line_protocol('hive data', {'hive id': 'a,b=c', 'empty': ''}, {'msg': 'say "hi"\\', 'k=1': 1.0}, 5)
+        self.assertEqual(line, 'hive\\ data,hive\\ id=a\\,b\\=c msg="say \\"hi\\"\\\\",k\\=1=1.0 5')
+
+class TestAsyncInfluxWriter(unittest.TestCase):
+    """Test the asyncio writer's spool, replay and self-metrics"""
+
+    def test_spool_and_replay(self):
+        """Test batches spool while InfluxDB is down and replay in order before new points"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            bodies = []; down = [True]
+            def write(record, **kwargs):
+                if down[0]: raise IOError("InfluxDB down")
+                bodies.append(record)
+            client = Mock(); client.write_api.return_value.write.side_effect = write
+            async def run():
+                writer = AsyncInfluxBatchWriter(client, 'b', 'o', max_retries=0, spool_dir=tmpdir)
+                await writer._flush(['a 1', 'b 2'])
+                self.assertEqual(len(os.listdir(tmpdir)), 1)
+                down[0] = False
+                await writer._flush(['c 3'])
+                return writer
+            writer = asyncio.run(run())
+            self.assertEqual(bodies, ['a 1\nb 2', 'c 3'])
+            self.assertEqual(os.listdir(tmpdir), [])
+            self.assertEqual((writer.batches_spooled, writer.points_written), (1, 3))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_stats_are_logged_and_written(self):
+        """Test queue depth and flush latency reach the log and InfluxDB as ml_writer_stats"""
+        bodies = []
+        client = Mock(); client.write_api.return_value.write.side_effect = lambda record, **kw: bodies.append(record)
+        async def run():
+            writer = AsyncInfluxBatchWriter(client, 'b', 'o', flush_interval=0.02, stats_interval=0.1)
+            writer.start(); writer.write('m', {'hive_id': 'H001'}, {'v': 1.0}, 1)
+            await asyncio.sleep(0.3); await writer.stop()
+        with self.assertLogs('app.influx_writer', level='INFO') as logs:
+            asyncio.run(run())
+        self.assertTrue(any('queue_depth' in line and 'last_flush_latency_ms' in line for line in logs.output))
+        stats = [line for body in bodies for line in body.split('\n') if line.startswith('ml_writer_stats ')]
+        self.assertTrue(stats)
+        self.assertRegex(stats[0], r'queue_depth=\d+i,.*last_flush_latency_ms=[\d.]+')
+
+    def test_idle_loop_sleeps_until_batch_or_deadline(self):
+        """Test the idle writer does not poll, and a full batch flushes before the deadline"""
+        bodies = []
+        client = Mock(); client.write_api.return_value.write.side_effect = lambda record, **kw: bodies.append(record)
+        async def run():
+            writer = AsyncInfluxBatchWriter(client, 'b', 'o', batch_size=3, flush_interval=30.0, stats_interval=0)
+            polls = [0]; get_nowait = writer._queue.get_nowait
+            def counting():
+                polls[0] += 1; return get_nowait()
+            writer._queue.get_nowait = counting
+            writer.start(); await asyncio.sleep(0.3)
+            self.assertLessEqual(polls[0], 2) # Un vistazo al arrancar, luego duerme
+            for i in range(3): writer.write('m', {}, {'v': i}, i)
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(bodies), 1) # Lote completo: sin esperar los 30 s
+            await writer.stop(1.0)
+        asyncio.run(run())
+
+class TestEnsembleScoring(unittest.TestCase):
+    """Test batch scoring and vote combination"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.X = synthetic_history()
+        cls.store = ModelStore(cls.tmpdir, mmap=False)
+        cls.store.save('H001', fit_model(cls.X))
+        cls.detector = EnsembleAnomalyDetector.__new__(EnsembleAnomalyDetector)
+        cls.detector.models = cls.store
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    def rows(self, X):
+        return [dict(zip(MODEL_FEATURES, x)) for x in X]
+
+    def test_batch_verdicts(self):
+        """Test normal rows pass, gross outliers are flagged and single-row scoring matches the batch"""
+        normal = synthetic_history(50, seed=1)
+        outliers = normal[:5].copy(); outliers[:, 0] += 30; outliers[:, 2] *= 4
+        rows = self.rows(np.vstack([normal, outliers]))
+        is_anomaly, scores, confidence = self.detector.detect_ensemble_batch('H001', rows)
+        self.assertLess(is_anomaly[:50].mean(), 0.2)
+        self.assertTrue(is_anomaly[50:].all())
+        self.assertTrue(((scores >= -1) & (scores <= 1)).all())
+        self.assertTrue(((confidence > 0) & (confidence <= 1)).all())
+        single = self.detector.detect_ensemble('H001', self.rows(outliers)[0])
+        self.assertTrue(single[0])
+        self.assertAlmostEqual(single[1], scores[50], places=9)
+
+    def test_missing_model_and_window_features(self):
+        """Test hives without a model score zero and rows without rolling features are still scored"""
+        is_anomaly, scores, confidence = self.detector.detect_ensemble_batch('NOPE', [{}, {}])
+        self.assertEqual((is_anomaly.tolist(), scores.tolist()), ([False, False], [0.0, 0.0]))
+        row = dict(zip(MODEL_FEATURES, self.X[0])); row['d24h_g'] = float('nan')
+        self.assertEqual(len(self.detector.detect_ensemble_batch('H001', [row])[0]), 1)
+
+    def test_alert_from_fresh_hive_is_strict_json(self):
+        """Test an alert raised before the rolling windows fill publishes null, not NaN"""
+        detector = EnsembleAnomalyDetector.__new__(EnsembleAnomalyDetector)
+        detector.models = self.store; detector.features = FeatureEngine()
+        detector.mqtt = Mock(); detector.influx_writer = Mock()
+        detector.scoring_pool = ThreadPoolExecutor(max_workers=1)
+        outlier = dict(zip(MODEL_FEATURES, self.X[0])); outlier['weight_kg'] += 30; outlier['co2_ppm'] *= 4
+        outlier['ts'] = 1.7e9
+        try:
+            asyncio.run(detector._score_batch('H001', [outlier]))
+        finally:
+            detector.scoring_pool.shutdown()
+        topic, payload = detector.mqtt.publish.call_args[0]
+        def reject(token): raise ValueError(token)
+        alert = json.loads(payload, parse_constant=reject)
+        self.assertEqual(topic, 'hives/H001/anomalies')
+        self.assertIsNone(alert['data']['d24h_g'])
+        self.assertEqual(alert['data']['weight_kg'], outlier['weight_kg'])
+
+    def test_largest_range_does_not_decide(self):
+        """Test votes are compared in per-model units, not raw decision_function ranges"""
+        votes = np.array([[-0.08], [40.0], [-0.4]]) # IF y RF: anomalía; OCSVM: normal pero con rango enorme
+        score, confidence = combine_votes(votes, np.array([0.1, 100.0, 0.5]))
+        self.assertLess(score[0], 0)
+        self.assertAlmostEqual(confidence[0], 2 / 3)
+        score, _ = combine_votes(votes) # Modelos sin escalas: mayoría por signo
+        self.assertAlmostEqual(score[0], -1 / 3)
+
+    def test_single_class_random_forest(self):
+        """Test a training window with one IsolationForest label leaves the RF out of the vote"""
+        model_info = _fit_full(self.X)
+        rf = model_info['random_forest']
+        rf.fit(model_info['reservoir'], np.full(len(model_info['reservoir']), -1))
+        scales = fit_vote_scales(model_info)
+        self.assertEqual(scales[2], 0.0)
+        compiled = compile_ensemble(model_info)
+        self.assertIsNotNone(compiled)
+        self.assertFalse(compiled.votes(self.X[:3])[2].any())
+        model_info.update(vote_scales=scales, compiled=compiled)
+        self.store.save('H002', model_info)
+        _, _, confidence = self.detector.detect_ensemble_batch('H002', self.rows(self.X[:20]))
+        self.assertTrue(np.isin(confidence, [0.5, 1.0]).all()) # Sólo votan IF y OCSVM
+
+class TestCompiledScorer(unittest.TestCase):
+    """Test the flat-array scorer against sklearn"""
+
+    def small_model(self, max_features=1.0, seed=0):
+        from sklearn.ensemble import IsolationForest, RandomForestClassifier
+        from sklearn.preprocessing import StandardScaler
+        from sklearn.svm import OneClassSVM
+        X = np.random.default_rng(seed).normal(size=(400, 6)) * [1, 2, 5, 0.1, 10, 3] + [0, 5, 100, 1, -20, 7]
+        scaler = StandardScaler().fit(X); X_scaled = scaler.transform(X)
+        iso = IsolationForest(n_estimators=30, max_features=max_features, random_state=seed).fit(X_scaled)
+        rf = RandomForestClassifier(n_estimators=20, max_depth=8, random_state=seed).fit(X_scaled, iso.predict(X_scaled))
+        return X, {'scaler': scaler, 'isolation_forest': iso, 'random_forest': rf,
+                   'one_class_svm': OneClassSVM(nu=0.05, gamma='scale').fit(X_scaled), 'reservoir': X_scaled[:200]}
+
+    def test_matches_sklearn_out_of_distribution(self):
+        """Test votes agree within TOLERANCE on rows far outside the training data, with feature subsampling too"""
+        for max_features in (1.0, 0.5):
+            X, model_info = self.small_model(max_features)
+            compiled = compile_ensemble(model_info)
+            self.assertIsNotNone(compiled)
+            rng = np.random.default_rng(7)
+            ood = np.vstack([X[:20] * 4 - 50, rng.normal(size=(50, 6)) * 1e3, np.zeros((1, 6)), X[:1] + 1e6])
+            for name, ours, ref in zip(('iforest', 'ocsvm', 'rf'), compiled.votes(ood), sklearn_votes(model_info, ood)):
+                self.assertLessEqual(np.max(np.abs(ours - ref)), TOLERANCE, f"{name}, max_features={max_features}")
+
+    def test_falls_back_to_sklearn(self):
+        """Test unsupported models compile to None and scoring still works through sklearn"""
+        from sklearn.svm import OneClassSVM
+        X, model_info = self.small_model()
+        model_info['one_class_svm'] = OneClassSVM(kernel='linear').fit(model_info['reservoir'])
+        self.assertIsNone(compile_ensemble(model_info))
+
+        X, model_info = self.small_model()
+        features = [f"f{i}" for i in range(X.shape[1])]
+        rows = [dict(zip(features, x)) for x in X[:10]]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            store = ModelStore(tmpdir, on_load=ensure_compiled)
+            store.save('OLD', dict(model_info, features=features)) # Sin 'compiled': como los modelos anteriores
+            detector = EnsembleAnomalyDetector.__new__(EnsembleAnomalyDetector)
+            detector.models = store
+            loaded = store.get('OLD')
+            self.assertIsNotNone(loaded['compiled']) # Compilado al cargar, no al puntuar
+            expected = detector.detect_ensemble_batch('OLD', rows)
+            for compiled in (None, Mock(votes=Mock(side_effect=RuntimeError("bad arrays")))):
+                loaded['compiled'] = compiled
+                result = detector.detect_ensemble_batch('OLD', rows)
+                np.testing.assert_array_equal(result[0], expected[0])
+                np.testing.assert_allclose(result[1], expected[1], atol=1e-9)
+                self.assertIsNone(loaded['compiled'])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+class TestModelStore(unittest.TestCase):
+    """Test lazy loading, LRU eviction under the byte budget, hot reload and the on_load hook"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def save(self, store, hive_id, version=0):
+        path = store.save(hive_id, {'version': version, 'weights': np.full(25000, version, dtype=np.float64)})
+        return os.path.getsize(path)
+
+    def rewrite(self, store, hive_id, version):
+        """Guardar otra versión con un mtime seguro distinto (resolución del sistema de archivos)"""
+        self.save(store, hive_id, version)
+        stat = os.stat(store.path_for(hive_id))
+        os.utime(store.path_for(hive_id), ns=(stat.st_atime_ns, stat.st_mtime_ns + version * 10**9))
+
+    def test_lru_eviction_under_budget(self):
+        """Test the least recently used model leaves when a third one does not fit"""
+        store = ModelStore(self.tmpdir, memory_budget_mb=0, mmap=False)
+        size = self.save(store, 'A'); self.save(store, 'B'); self.save(store, 'C')
+        store.memory_budget = 2.5 * size # Caben dos
+        store.get('A'); store.get('B'); store.get('A') # B pasa a ser el menos reciente
+        store.get('C')
+        self.assertEqual(list(store._cache), ['A', 'C'])
+        self.assertEqual((store.loads, store.evictions), (3, 1))
+        self.assertIsNotNone(store.get('B')) # Vuelve desde disco y expulsa a A
+        self.assertEqual((list(store._cache), store.loads), (['C', 'B'], 4))
+
+    def test_hot_reload_on_file_change(self):
+        """Test a rewritten model file is picked up by the next get"""
+        store = ModelStore(self.tmpdir, mmap=False, reload_check_interval=0)
+        self.save(store, 'A', version=1)
+        first = store.get('A')
+        self.assertIs(store.get('A'), first) # Sin cambios en disco: mismo objeto
+        self.rewrite(store, 'A', version=2)
+        second = store.get('A')
+        self.assertIsNot(second, first)
+        self.assertEqual(second['version'], 2)
+
+    def test_on_load_runs_once_per_load(self):
+        """Test the hook prepares each load once, its result is cached and a failing hook keeps the old model"""
+        calls = []
+        def on_load(model):
+            calls.append(model['version'])
+            if model['version'] == 3: raise ValueError("bad model")
+            return dict(model, prepared=True)
+        store = ModelStore(self.tmpdir, mmap=False, reload_check_interval=0, on_load=on_load)
+        self.save(store, 'A', version=1)
+        self.assertTrue(store.get('A')['prepared']); store.get('A')
+        self.assertEqual(calls, [1])
+        for version in (2, 3):
+            self.rewrite(store, 'A', version)
+            model = store.get('A')
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual((model['version'], model['prepared']), (2, True)) # El fallo de la versión 3 no lo reemplaza
+
+class FakeQueryApi:
+    """query_stream sobre telemetría sintética cada 10 min, filtrada por el range() de la consulta"""
+    def __init__(self, days: int = 5):
+        now = datetime.now(timezone.utc)
+        self.times = [now - timedelta(minutes=10 * i) for i in range(days * 144, -1, -1)]
+        self.values = synthetic_history(len(self.times))[:, :len(FEATURES)]
+        self.queries = 0
+
+    def query_stream(self, query, org=None):
+        self.queries += 1
+        start, stop = (datetime.fromisoformat(t) for t in re.search(r"range\(start: (\S+), stop: (\S+)\)", query).groups())
+        for t, row in zip(self.times, self.values):
+            if start <= t < stop:
+                yield Mock(get_time=Mock(return_value=t), values=dict(zip(FEATURES, row)))
+
+class TestTraining(unittest.TestCase):
+    """Test chunked training, reservoir sampling and warm starts"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_hive_id_is_escaped_in_flux(self):
+        """Test a hive id taken from an MQTT topic cannot close the Flux string literal"""
+        query_api = Mock(); query_api.query_stream.return_value = []
+        stop = datetime(2026, 5, 2, tzinfo=timezone.utc)
+        list(stream_history(query_api, 'H1" or r.hive_id != "\\${x}', stop - timedelta(days=1), stop))
+        query = query_api.query_stream.call_args[0][0]
+        self.assertIn('r.hive_id == "H1\\" or r.hive_id != \\"\\\\\\${x}")', query)
+
+    def test_reservoir_is_bounded_and_uniform(self):
+        """Test the reservoir fills first, stays capped and samples every chunk with equal probability"""
+        with patch('app.training.RESERVOIR_SIZE', 200):
+            hits = np.zeros(2000)
+            for trial in range(50):
+                rng = np.random.default_rng(trial); reservoir = None
+                for start in range(0, 2000, 250): # Bloques de distinto tamaño que el reservorio
+                    chunk = np.arange(start, start + 250, dtype=float)[:, None]
+                    reservoir = _update_reservoir(reservoir, start, chunk, rng)
+                self.assertEqual(reservoir.shape, (200, 1))
+                self.assertEqual(len(np.unique(reservoir)), 200)
+                hits[reservoir[:, 0].astype(int)] += 1
+            first = _update_reservoir(None, 0, np.arange(150, dtype=float)[:, None], np.random.default_rng(0))
+        np.testing.assert_array_equal(first[:, 0], np.arange(150))
+        per_chunk = hits.reshape(8, 250).mean(axis=1) / 50 # Probabilidad de inclusión esperada: 200 / 2000
+        np.testing.assert_allclose(per_chunk, 0.1, atol=0.02)
+
+    def test_full_then_warm_start(self):
+        """Test a second run continues the checkpoint with new trees and only the new rows"""
+        query_api = FakeQueryApi()
+        first = train_hive('H001', 2, self.tmpdir, query_api=query_api)
+        self.assertEqual((first['status'], first['mode']), ('trained', 'full'))
+        store = ModelStore(self.tmpdir, mmap=False)
+        checkpoint = store.get('H001')
+        self.assertEqual(checkpoint['isolation_forest'].n_estimators, 100)
+        self.assertEqual(checkpoint['rows_seen'], first['rows'])
+
+        checkpoint['trained_until'] -= timedelta(hours=12) # Como si la corrida anterior fuera de hace 12 h
+        store.save('H001', checkpoint)
+        second = train_hive('H001', 2, self.tmpdir, query_api=query_api)
+        self.assertEqual((second['status'], second['mode']), ('trained', 'incremental'))
+        self.assertAlmostEqual(second['rows'], 72, delta=1)
+        model_info = ModelStore(self.tmpdir, mmap=False).get('H001')
+        self.assertEqual(model_info['isolation_forest'].n_estimators, 100 + TREES_PER_INCREMENT)
+        self.assertEqual(model_info['rows_seen'], first['rows'] + second['rows'])
+        self.assertEqual(len(model_info['reservoir']), model_info['rows_seen'])
+        self.assertIsNotNone(model_info['compiled'])
+        self.assertEqual(len(model_info['vote_scales']), 3)
+
+        third = train_hive('H001', 2, self.tmpdir, query_api=query_api, full=True)
+        self.assertEqual(third['mode'], 'full')
+
+    def test_nightly_training_covers_hives_without_models(self):
+        """Test a fresh install trains hives seen on the feed and schedules the next run at TRAINING_HOUR"""
+        detector = EnsembleAnomalyDetector.__new__(EnsembleAnomalyDetector)
+        detector.models = ModelStore(self.tmpdir)
+        detector.features = FeatureEngine()
+        detector.features.update('H007', {'weight_kg': 40.0}, t=0.0)
+        detector.training_hour = 2
+        with patch('app.ensemble_detector.telemetry_hives', return_value=['H003']):
+            self.assertEqual(asyncio.run(detector.known_hives()), ['H003', 'H007'])
+        with patch('app.ensemble_detector.telemetry_hives', side_effect=OSError("influx down")):
+            self.assertEqual(asyncio.run(detector.known_hives()), ['H007'])
+        self.assertEqual(detector.seconds_until_training(datetime(2026, 5, 1, 1, 30)), 1800)
+        self.assertEqual(detector.seconds_until_training(datetime(2026, 5, 1, 2, 0)), 86400)
+
+if __name__ == '__main__':
+    unittest.main()